@@ -0,0 +1,356 @@
+"""
+Execute.py
+
+Every external binary is run through runBinary.  It enforces a wall-clock
+limit, captures standard out and standard error to files and records the exit
+code, wall time, user/system CPU time and peak memory (max RSS) of each
+invocation in RUN_LOG in the directory the binary ran in.  Each line of
+RUN_LOG is:
+
+    binary  exit_code  wall(s)  user(s)  sys(s)  max_rss(kB)  directory
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, time, subprocess, threading, signal
+import Error
+
+RUN_LOG = "pyUHBD-runs.dat"
+
+# Longest wait (s) between checks for a finished binary
+POLL_INTERVAL = 0.05
+
+
+class RunRecord:
+    """
+    Simple class that holds the outcome and resource use of one invocation.
+    """
+
+    def __init__(self,binary,job_dir):
+        """
+        Initialize class.
+        """
+
+        self.binary = binary
+        self.job_dir = job_dir
+        self.exit_code = None
+        self.wall = 0.
+        self.user = 0.
+        self.sys = 0.
+        self.max_rss = 0
+        self.timed_out = False
+        self.aborted = False
+
+    def line(self):
+        """
+        Return the RUN_LOG line for this invocation.
+        """
+
+        name = os.path.split(self.binary)[-1]
+        directory = os.path.split(os.path.normpath(self.job_dir))[-1]
+        return "%-10s %5i %10.2F %10.2F %10.2F %10i %s\n" % \
+               (name,self.exit_code,self.wall,self.user,self.sys,self.max_rss,
+                directory)
+
+
+def writeInput(stream,data):
+    """
+    Write data to stream (the standard in of a binary) and close it.  Run in its
+    own thread so a large input cannot deadlock against the binary's output.
+    """
+
+    try:
+        try:
+            stream.write(data)
+        finally:
+            stream.close()
+    except IOError:
+        # The binary was killed (or quit) before reading all of its input
+        pass
+
+
+class ProcessGuard:
+    """
+    Class that kills and reaps a process under one lock.  Once a process has
+    been reaped its pid may be reused by an unrelated process, so a kill (from
+    the timeout timer or check_line) must never be sent after the reap.
+    """
+
+    def __init__(self,process):
+        """
+        Initialize class.
+        """
+
+        self.process = process
+        self.lock = threading.Lock()
+        self.reaped = False
+
+    def kill(self):
+        """
+        Kill the process unless it has already been reaped.  Returns True if
+        the kill was sent.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.reaped:
+                return False
+            try:
+                os.kill(self.process.pid,signal.SIGKILL)
+            except OSError:
+                pass
+            return True
+        finally:
+            self.lock.release()
+
+    def poll(self,record):
+        """
+        Reap the process if it has finished, storing its exit code and resource
+        use in record.  Returns True once the process has been reaped.  Uses
+        os.wait4 where available (resource use is only recorded there).
+        """
+
+        self.lock.acquire()
+        try:
+            if hasattr(os,"wait4"):
+                try:
+                    pid, status, usage = os.wait4(self.process.pid,os.WNOHANG)
+                except OSError, value:
+                    if value[0] != 4:
+                        raise
+                    # Interrupted system call: try again
+                    return False
+                if pid == 0:
+                    return False
+
+                if os.WIFSIGNALED(status):
+                    record.exit_code = -os.WTERMSIG(status)
+                else:
+                    record.exit_code = os.WEXITSTATUS(status)
+                record.user = usage.ru_utime
+                record.sys = usage.ru_stime
+                record.max_rss = usage.ru_maxrss
+
+                # Keep subprocess from waiting for the process again
+                self.process.returncode = record.exit_code
+            else:
+                record.exit_code = self.process.poll()
+                if record.exit_code == None:
+                    return False
+
+            self.reaped = True
+            return True
+        finally:
+            self.lock.release()
+
+    def wait(self,record):
+        """
+        Wait for the process to finish and reap it (see poll).  The process is
+        polled rather than waited for, so the lock is never held while it runs;
+        the interval grows to POLL_INTERVAL, which is small next to the run
+        time of any uhbd binary.
+        """
+
+        interval = 0.001
+        while not self.poll(record):
+            time.sleep(interval)
+            interval = min(2*interval,POLL_INTERVAL)
+
+
+def tailFile(some_file,num_lines=5):
+    """
+    Return the last num_lines lines of some_file (an empty list if it does not
+    exist).
+    """
+
+    if not os.path.isfile(some_file):
+        return []
+
+    f = open(some_file,"r")
+    lines = f.readlines()
+    f.close()
+
+    return lines[-num_lines:]
+
+
+def runBinary(binary,job_dir,stdin_data=None,stdout_file=None,
+              stderr_file=None,timeout=None,check_line=None,stdout_mode="a"):
+    """
+    Run binary in job_dir.
+
+    stdin_data: string written to standard in (None: nothing)
+    stdout_file/stderr_file: files in job_dir that capture standard out and
+        error (default binary.stdout/binary.stderr, appended)
+    stdout_mode: mode used to open stdout_file ("a" or "w")
+    timeout: wall-clock limit in seconds (None: no limit)
+    check_line: function called on every line of standard out as it is
+        produced.  If it returns True the binary is killed and the record is
+        returned with aborted set; the caller decides what to raise.
+
+    Raises IOError if the binary cannot be run and Error.UhbdError if it times
+    out or exits with a non-zero code.  Returns a RunRecord.
+    """
+
+    name = os.path.split(binary)[-1]
+    if stdout_file == None:
+        stdout_file = "%s.stdout" % name
+    if stderr_file == None:
+        stderr_file = "%s.stderr" % name
+
+    record = RunRecord(binary,job_dir)
+    out = open(os.path.join(job_dir,stdout_file),stdout_mode)
+    err = open(os.path.join(job_dir,stderr_file),"a")
+    try:
+
+        if stdin_data != None:
+            stdin = subprocess.PIPE
+        else:
+            stdin = open(os.devnull,"r")
+        if check_line != None:
+            stdout = subprocess.PIPE
+        else:
+            stdout = out
+
+        start = time.time()
+        try:
+            process = subprocess.Popen([binary],stdin=stdin,stdout=stdout,
+                                       stderr=err,cwd=job_dir,close_fds=True)
+        except OSError:
+            raise IOError("Problem with binary %s" % binary)
+
+        writer = None
+        if stdin_data != None:
+            writer = threading.Thread(target=writeInput,
+                                      args=(process.stdin,stdin_data))
+            writer.start()
+        else:
+            stdin.close()
+
+        guard = ProcessGuard(process)
+        timer = None
+        if timeout != None:
+            def expire():
+                record.timed_out = guard.kill()
+            timer = threading.Timer(timeout,expire)
+            timer.start()
+
+        try:
+            if check_line != None:
+                try:
+                    for line in iter(process.stdout.readline,""):
+                        out.write(line)
+                        if check_line(line):
+                            record.aborted = True
+                            guard.kill()
+                            break
+                finally:
+                    process.stdout.close()
+        finally:
+            guard.wait(record)
+            record.wall = time.time() - start
+            if timer != None:
+                timer.cancel()
+                timer.join()
+            if writer != None:
+                writer.join()
+
+        # A binary that finished on its own just before the timer fired was
+        # not killed by it
+        if record.timed_out and record.exit_code != -signal.SIGKILL:
+            record.timed_out = False
+
+    finally:
+        out.close()
+        err.close()
+
+    g = open(os.path.join(job_dir,RUN_LOG),"a")
+    g.write(record.line())
+    g.close()
+
+    if record.aborted:
+        return record
+
+    if record.timed_out:
+        msg = "%s in %s exceeded its time limit (%g s)" % (name,job_dir,
+                                                           timeout)
+        raise Error.UhbdError(msg)
+
+    if record.exit_code != 0:
+        msg = ["%s in %s failed with exit code %i\n" % (name,job_dir,
+                                                        record.exit_code)]
+        tail = tailFile(os.path.join(job_dir,stderr_file))
+        if len(tail) > 0:
+            msg.append("tail -%i %s\n\n" % (len(tail),stderr_file))
+            msg.extend(tail)
+        raise Error.UhbdError("".join(msg))
+
+    return record
+
+
+def mergeRecords(job_dir,dir_list):
+    """
+    Append the RUN_LOG of every directory in dir_list to the RUN_LOG of
+    job_dir (i.e. before temporary site directories are removed).
+    """
+
+    merged = []
+    for d in dir_list:
+        log = os.path.join(d,RUN_LOG)
+        if os.path.isfile(log):
+            f = open(log,"r")
+            merged.extend(f.readlines())
+            f.close()
+
+    g = open(os.path.join(job_dir,RUN_LOG),"a")
+    g.writelines(merged)
+    g.close()
+
+
+def summarizeRecords(job_dir):
+    """
+    Create a summary of RUN_LOG in job_dir: calls, total wall, user and system
+    time and the peak max RSS for every binary.  Returns the summary as a
+    string.
+    """
+
+    totals = {}
+    f = open(os.path.join(job_dir,RUN_LOG),"r")
+    for line in f.readlines():
+        c = line.split()
+        if len(c) != 7:
+            continue
+        if not totals.has_key(c[0]):
+            totals[c[0]] = [0,0.,0.,0.,0]
+        t = totals[c[0]]
+        t[0] += 1
+        t[1] += float(c[2])
+        t[2] += float(c[3])
+        t[3] += float(c[4])
+        t[4] = max(t[4],int(c[5]))
+    f.close()
+
+    out = ["%-10s%8s%12s%12s%12s%14s\n" % ("binary","calls","wall(s)",
+                                           "user(s)","sys(s)","max_rss(kB)")]
+    binaries = totals.keys()
+    binaries.sort()
+    for b in binaries:
+        out.append("%-10s%8i%12.2F%12.2F%12.2F%14i\n" % tuple([b] + totals[b]))
+
+    return "".join(out)
+
+
+if __name__ == "__main__":
+
+    __usage__ =\
+    """
+    Execute.py job_dir
+
+    Summarize the binaries run in job_dir (from %s).
+    """ % RUN_LOG
+
+    if len(sys.argv) != 2 or \
+       not os.path.isfile(os.path.join(sys.argv[1],RUN_LOG)):
+        print __usage__
+        sys.exit()
+
+    print summarizeRecords(sys.argv[1]),
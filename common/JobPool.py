@@ -0,0 +1,309 @@
+"""
+JobPool.py
+
+Functions for running a list of independent calculations, either one after
+another or concurrently in a pool of worker processes or threads.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, time, traceback, threading
+
+try:
+    import multiprocessing, multiprocessing.pool
+except ImportError:
+    multiprocessing = None
+
+EXECUTORS = ["process","thread"]
+
+
+class JobResult:
+    """
+    Simple class that holds the outcome of a single job.
+    """
+
+    def __init__(self,label,success,elapsed,log_file=None,message=""):
+        """
+        Initialize class.
+        """
+
+        self.label = label
+        self.success = success
+        self.elapsed = elapsed
+        self.log_file = log_file
+        self.message = message
+
+
+class ThreadOutput:
+    """
+    File-like object that replaces sys.stdout while jobs run in threads.  Each
+    thread can point its output at its own log file; threads without a log
+    file write to the original stream.  fileno() is provided so binaries
+    spawned by a thread write to that thread's log as well.
+    """
+
+    def __init__(self,stream):
+        """
+        Initialize class.
+        """
+
+        self.stream = stream
+        self.local = threading.local()
+
+    def setLog(self,log):
+        """
+        Set (or, if log is None, clear) the log file for the current thread.
+        """
+
+        self.local.log = log
+
+    def current(self):
+        """
+        Return the file the current thread should write to.
+        """
+
+        log = getattr(self.local,"log",None)
+        if log == None:
+            return self.stream
+        return log
+
+    def write(self,data):
+        self.current().write(data)
+
+    def flush(self):
+        self.current().flush()
+
+    def fileno(self):
+        return self.current().fileno()
+
+
+def redirectOutput(log_file):
+    """
+    Point the standard out and standard error file descriptors of this process
+    at log_file.  Binaries spawned from here inherit the redirection.  Returns
+    the saved descriptors so they can be restored with restoreOutput.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    log = open(log_file,'a')
+    saved = (os.dup(1),os.dup(2))
+    os.dup2(log.fileno(),1)
+    os.dup2(log.fileno(),2)
+    log.close()
+
+    return saved
+
+
+def restoreOutput(saved):
+    """
+    Undo redirectOutput.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    os.dup2(saved[0],1)
+    os.dup2(saved[1],2)
+    os.close(saved[0])
+    os.close(saved[1])
+
+
+def runJob(job):
+    """
+    Run a single job, catching any error it raises so one bad calculation does
+    not take down the rest of the pool.  job is a tuple of (label, function,
+    argument tuple, log file).  If log_file is None, output is not redirected.
+    """
+
+    label, function, args, log_file = job
+
+    # Threads share file descriptors, so they log through ThreadOutput rather
+    # than by redirecting standard out.
+    threaded = isinstance(sys.stdout,ThreadOutput)
+    if log_file != None:
+        if threaded:
+            sys.stdout.setLog(open(log_file,'a'))
+        else:
+            saved = redirectOutput(log_file)
+
+    start = time.time()
+    try:
+        try:
+            function(*args)
+            result = JobResult(label,True,time.time() - start,log_file)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            err = "".join(traceback.format_exception(*sys.exc_info()))
+            print err
+            result = JobResult(label,False,time.time() - start,log_file,
+                               err.strip().split("\n")[-1])
+    finally:
+        if log_file != None:
+            if threaded:
+                sys.stdout.current().close()
+                sys.stdout.setLog(None)
+            else:
+                restoreOutput(saved)
+
+    return result
+
+
+def runJobs(job_list,num_jobs=1,executor="process"):
+    """
+    Run every job in job_list using num_jobs workers.  executor selects whether
+    the workers are separate processes or threads within this process; jobs
+    run in threads must not depend on the working directory.  Progress is
+    reported in the order of job_list as jobs finish.  Returns a list of
+    JobResult instances in the same order.
+    """
+
+    if executor not in EXECUTORS:
+        raise ValueError("executor must be one of %s" % ", ".join(EXECUTORS))
+
+    if num_jobs > 1 and multiprocessing == None:
+        err = "Running more than one job requires the multiprocessing module "
+        err += "(Python 2.6 or later). You are using Python %s" % \
+               sys.version.split()[0]
+        raise OSError(err)
+
+    num_jobs = min(num_jobs,len(job_list))
+    stdout = sys.stdout
+    if num_jobs > 1:
+        if executor == "thread":
+            sys.stdout = ThreadOutput(stdout)
+            pool = multiprocessing.pool.ThreadPool(num_jobs)
+        else:
+            pool = multiprocessing.Pool(num_jobs)
+        job_iterator = pool.imap(runJob,job_list)
+    else:
+        pool = None
+        job_iterator = (runJob(j) for j in job_list)
+
+    results = []
+    try:
+        try:
+            for result in job_iterator:
+                results.append(result)
+                reportProgress(result,len(results),len(job_list))
+        except KeyboardInterrupt:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+            raise
+    finally:
+        sys.stdout = stdout
+
+    if pool != None:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def mapThreads(function,arg_list,num_threads):
+    """
+    Call function(*args) for every args in arg_list using num_threads threads
+    of this process.  Output written by the worker threads goes wherever the
+    output of the calling thread goes.  Returns the return values in the order
+    of arg_list; an error raised by any call is re-raised here.
+    """
+
+    if num_threads <= 1 or multiprocessing == None:
+        return [function(*args) for args in arg_list]
+
+    if isinstance(sys.stdout,ThreadOutput):
+        log = sys.stdout.current()
+    else:
+        log = None
+
+    def runInThread(args):
+        if log != None:
+            sys.stdout.setLog(log)
+        try:
+            return function(*args)
+        finally:
+            if log != None:
+                sys.stdout.setLog(None)
+
+    pool = multiprocessing.pool.ThreadPool(min(num_threads,len(arg_list)))
+    try:
+        results = pool.map(runInThread,arg_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def callFunction(call):
+    """
+    Call function(*args) for a (function, args) tuple.  Used to pass calls
+    to worker processes.
+    """
+
+    function, args = call
+    return function(*args)
+
+
+def mapProcesses(function,arg_list,num_processes):
+    """
+    Call function(*args) for every args in arg_list using num_processes
+    worker processes.  function must be defined at the top level of a module
+    so it can be sent to the workers.  Inside a worker of a process pool
+    (which cannot start processes of its own) the calls are made one after
+    another.  Returns the return values in the order of arg_list.
+    """
+
+    if num_processes <= 1 or len(arg_list) <= 1 or multiprocessing == None \
+       or multiprocessing.current_process().daemon:
+        return [function(*args) for args in arg_list]
+
+    pool = multiprocessing.Pool(min(num_processes,len(arg_list)))
+    try:
+        results = pool.map(callFunction,[(function,args) for args in arg_list])
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def reportProgress(result,counter,total):
+    """
+    Print a one line summary of a finished job.
+    """
+
+    if result.success:
+        status = "done"
+    else:
+        status = "FAILED (%s)" % result.message
+
+    width = len("%i" % total)
+    print "[%*i/%i] %s: %s [%.1F s]" % (width,counter,total,result.label,
+                                        status,result.elapsed)
+    sys.stdout.flush()
+
+
+def summarizeJobs(results):
+    """
+    Create a summary of a set of JobResult instances.  Returns the summary as a
+    string.
+    """
+
+    failed = [r for r in results if not r.success]
+
+    out = ["%s\n" % (80*"-")]
+    out.append("%i of %i jobs succeeded, %i failed.\n" % \
+               (len(results) - len(failed),len(results),len(failed)))
+    if len(failed) > 0:
+        out.append("Failed jobs:\n")
+        for r in failed:
+            out.append("   %s: %s\n" % (r.label,r.message))
+            if r.log_file != None:
+                out.append("      (see %s)\n" % r.log_file)
+    out.append("%s\n" % (80*"-"))
+
+    return "".join(out)
@@ -6,9 +6,36 @@ A module containing functions for processing pyUHBD input files.
 
 __author__ = "Michael J. Harms"
 
-from math import sqrt
+from math import sqrt, ceil
 import os
-import SystemOps
+import SystemOps, SpatialIndex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# maxDimension splits the points into spatial blocks of at most
+# DIAMETER_BLOCK points and compares a block with at most DISTANCE_CHUNK
+# points of other blocks at once (DIAMETER_BLOCK x DISTANCE_CHUNK distances
+# in memory).
+DIAMETER_BLOCK = 64
+DISTANCE_CHUNK = 16384
+
+# Limits used by planGrid.  Grids have at most PLAN_MAX_DIME points on a side
+# and PLAN_MAX_LEVELS levels; each focused spacing is at most PLAN_MAX_RATIO
+# times finer than the one above it.  The coarse grid leaves a margin of the
+# largest extent of the molecule on every side (the default grid is three
+# times the maximum dimension) and is at least PLAN_MIN_EDGE A on a side.
+# Focused grids are at least PLAN_FOCUS_CELLS spacings of the level above on a
+# side (their boundary values come from it) and the finest is at least
+# PLAN_FINE_EDGE A on a side.
+PLAN_MAX_DIME = 65
+PLAN_MAX_LEVELS = 5
+PLAN_MAX_RATIO = 3.0
+PLAN_MIN_EDGE = 20.0
+PLAN_FOCUS_CELLS = 13
+PLAN_FINE_EDGE = 9.75
 
 
 class MangledFileError(Exception):
@@ -18,11 +45,11 @@ class MangledFileError(Exception):
 
     pass
 
-def processHis(pdb,his_tautomers,default_his=2,
+def processHis(structure,his_tautomers,default_his=2,
                valid_his={"CD1":0,"ND1":1,"NE2":2}):
     """
     Take the calc_param.his_tautomers and generate proper input for the
-    generation of an input file.  Either:
+    generation of an input file (structure is a Structure instance).  Either:
         1) An input file is specified; read the file but return an error if it
            is mangled.
         2) No input file is specified; assign every histidine a default
@@ -32,10 +59,10 @@ def processHis(pdb,his_tautomers,default_his=2,
     his_names = ["HIS","HSD","HSE"]
 
     # List of histidine residues
-    his_resid = [l for l in pdb if l[0:4] == "ATOM" and l[17:20] in his_names] 
-    his_resid = [l for l in his_resid
-                 if l[12:17] == " CA  " or l[12:17] == "CA   "]
-    his_resid = [int(l[22:26]) for l in his_resid]
+    s = structure
+    his_resid = [s.resid[i] for i in range(len(s))
+                 if s.resname[i][:3] in his_names and
+                 s.name[i] + s.altloc[i] in [" CA  ","CA   "]]
 
     # If an input file is specified...
     if his_tautomers != None:
@@ -63,8 +90,8 @@ def processHis(pdb,his_tautomers,default_his=2,
         # Make sure that the number of histidines in the input file match the
         # number in the pdb file.
         if len(his_out) != len(his_resid):
-            err = "Number of his specified in %s (%i) does not match number in"
-            err += "pdb file (%j)" 
+            err = "Number of his specified in %s (%i) does not match number "
+            err += "in pdb file (%i)"
             err = err % (his_tautomers,len(his_out),len(his_resid))
             
             raise MangledFileError(err)
@@ -76,10 +103,10 @@ def processHis(pdb,his_tautomers,default_his=2,
     return his_out
 
 
-def processCys(pdb,cys_titrate,disulfide_cutoff=3.5):
+def processCys(structure,cys_titrate,disulfide_cutoff=3.5):
     """
     Take the calc_param.cys_titrate and generate proper input for the
-    generation of an input file.  Either:
+    generation of an input file (structure is a Structure instance).  Either:
         1) An input file is specified; read the file but return an error if it
            is mangled.
         2) No input file is specified; decide whether each cysteine should
@@ -89,8 +116,10 @@ def processCys(pdb,cys_titrate,disulfide_cutoff=3.5):
     """
 
     # List of cys residues
-    cys_resid = [int(l[22:26]) for l in pdb if l[0:4] == "ATOM"
-                 and l[12:15] == "SG " and l[17:20] == "CYS"]
+    s = structure
+    cys_atoms = [i for i in range(len(s))
+                 if s.name[i][:3] == "SG " and s.resname[i][:3] == "CYS"]
+    cys_resid = [s.resid[i] for i in cys_atoms]
     num_cys = len(cys_resid)
 
     # If an input file is specified...
@@ -120,20 +149,17 @@ def processCys(pdb,cys_titrate,disulfide_cutoff=3.5):
     # If no input file is specified...
     else:
 
-        # Read in CYS SG coordinates
-        coord = [[float(l[31+8*i:38+8*i]) for i in range(3)] for l in pdb
-                 if l[0:4] == "ATOM" and l[12:15] == "SG "]
+        # CYS SG coordinates
+        coord = structure.coordinates(cys_atoms)
 
         # Define all cys within disulfide_cutoff angstroms of each other as in
         # disulfide bonds
-        cutoff_squared = disulfide_cutoff**2
         disulfide = []
-        for i in range(num_cys):
-            for j in range(i+1,num_cys):
-                r = sum([(coord[i][k] - coord[j][k])**2 for k in range(3)])
-                if r < cutoff_squared:
-                    disulfide.append(cys_resid[i])
-                    disulfide.append(cys_resid[j])
+        if num_cys > 1 and disulfide_cutoff > 0:
+            index = SpatialIndex.SpatialIndex(coord,disulfide_cutoff)
+            for i, j in index.pairs(disulfide_cutoff):
+                disulfide.append(cys_resid[i])
+                disulfide.append(cys_resid[j])
 
         # Residues not in disulfide bonds can titrate
         cys_out = [c for c in cys_resid if c not in disulfide]
@@ -141,17 +167,283 @@ def processCys(pdb,cys_titrate,disulfide_cutoff=3.5):
     return cys_out
 
 
-def processGrid(pdb,grid):
+def farthestPair(coord):
+    """
+    Return a lower bound (squared) on the maximum distance between any two
+    points in coord: the point farthest from the first point, and then the
+    point farthest from that one.
+    """
+
+    def farthest(p):
+        best, best_d = 0, -1.
+        for j, q in enumerate(coord):
+            d = sum([(p[k] - q[k])**2 for k in range(3)])
+            if d > best_d:
+                best, best_d = j, d
+        return best, best_d
+
+    a, ignore = farthest(coord[0])
+    b, d = farthest(coord[a])
+
+    return d
+
+
+def spatialBlocks(c,block_size):
+    """
+    Split the points in c (an N x 3 array) into spatially compact blocks of at
+    most block_size points by repeatedly halving along the longest axis.
+    Returns a list of arrays of point indexes.
+    """
+
+    blocks = []
+    stack = [numpy.arange(len(c))]
+    while len(stack) > 0:
+        index = stack.pop()
+        if len(index) <= block_size:
+            blocks.append(index)
+            continue
+
+        p = c[index]
+        axis = numpy.argmax(p.max(0) - p.min(0))
+        half = len(index)/2
+        order = numpy.argpartition(p[:,axis],half)
+        stack.append(index[order[:half]])
+        stack.append(index[order[half:]])
+
+    return blocks
+
+
+def blockMaxDistance(c,lower):
+    """
+    Return the maximum squared distance between any two points in c (an N x 3
+    array), given a lower bound on it.  The points are split into spatial
+    blocks; the distance between two blocks is bounded from above by their
+    bounding boxes and spheres, and only pairs of blocks that could hold a
+    pair longer than the longest found so far are compared.  Memory use is
+    linear in the number of points.
+    """
+
+    c = c - c.mean(0)
+    blocks = spatialBlocks(c,DIAMETER_BLOCK)
+    lo = numpy.array([c[b].min(0) for b in blocks])
+    hi = numpy.array([c[b].max(0) for b in blocks])
+    center = (lo + hi)/2
+    radius = numpy.array([numpy.sqrt(((c[b] - center[i])**2).sum(1).max())
+                          for i, b in enumerate(blocks)])
+    sq = (c*c).sum(1)
+
+    max_d = lower
+    for i, b in enumerate(blocks):
+
+        # Upper bounds on the squared distance from the points of block i to
+        # those of blocks i, i+1, ...
+        span = numpy.maximum(abs(hi[i] - lo[i:]),abs(hi[i:] - lo[i]))
+        box = (span*span).sum(1)
+        ball = (numpy.sqrt(((center[i:] - center[i])**2).sum(1)) +
+                radius[i] + radius[i:])**2
+        partners = numpy.nonzero(numpy.minimum(box,ball) > max_d)[0] + i
+        if len(partners) == 0:
+            continue
+
+        others = numpy.concatenate([blocks[j] for j in partners])
+        p = c[b]
+        for start in range(0,len(others),DISTANCE_CHUNK):
+            o = others[start:start + DISTANCE_CHUNK]
+            d = numpy.dot(p,-2*c[o].T)
+            d += sq[o]
+            d += sq[b][:,None]
+            k = numpy.argmax(d)
+            if d.flat[k] > max_d:
+                # Recalculate the longest pair directly
+                q = c[o[k % len(o)]] - p[k/len(o)]
+                max_d = max(max_d,float((q*q).sum()))
+
+    return max_d
+
+
+def maxDimension(coord):
+    """
+    Return the maximum distance between any two points in coord (a list of
+    (x, y, z)).  The distance between two points cannot exceed the sum of
+    their distances from the centroid, so only points far enough from the
+    centroid to be part of a pair longer than a known lower bound are
+    compared.  With NumPy the remaining points are compared block by block
+    (see blockMaxDistance), so memory use is linear in the number of points.
+    """
+
+    size = len(coord)
+    if size < 2:
+        return 0.
+
+    lower = farthestPair(coord)
+    center = [sum([c[k] for c in coord])/size for k in range(3)]
+    radius = [sqrt(sum([(c[k] - center[k])**2 for k in range(3)]))
+              for c in coord]
+    min_radius = sqrt(lower) - max(radius) - 1e-6
+    candidates = [coord[i] for i in range(size) if radius[i] >= min_radius]
+
+    if numpy != None:
+        max_d = blockMaxDistance(numpy.array(candidates,dtype=float),lower)
+    else:
+        max_d = lower
+        num = len(candidates)
+        for i in range(num):
+            p = candidates[i]
+            for j in range(i+1,num):
+                q = candidates[j]
+                d = (p[0] - q[0])**2 + (p[1] - q[1])**2 + (p[2] - q[2])**2
+                if d > max_d:
+                    max_d = d
+
+    return sqrt(max_d)
+
+
+def gridCost(grid):
+    """
+    Return the estimated cost of solving on every level of grid, relative to a
+    single grid point: sum(N**(4/3)) over the levels, N the number of points
+    (the iterations needed grow with the number of points on a side).
+    """
+
+    return sum([(g[1]*g[2]*g[3])**(4/3.) for g in grid])
+
+
+def focusLevels(coarse_spacing,finest,num_levels,max_ratio=PLAN_MAX_RATIO):
+    """
+    Return the spacings and edges of num_levels focused levels from
+    coarse_spacing down to finest in equal ratios (spacings rounded to 0.01 A,
+    as written to the uhbd input).  Edges are built from the finest level up
+    so every level contains the next.  Returns None if the ratio between
+    levels would be larger than max_ratio (if given).
+    """
+
+    ratio = (coarse_spacing/finest)**(1./num_levels)
+    if max_ratio != None and ratio > max_ratio + 1e-9:
+        return None
+
+    spacing = [round(coarse_spacing/ratio**i,2) for i in range(num_levels)]
+    spacing.append(finest)
+    for i in range(1,len(spacing)):
+        if spacing[i] >= spacing[i-1]:
+            return None
+
+    # spacing[0] is the coarse grid; levels are spacing[1:]
+    levels = []
+    edge = PLAN_FINE_EDGE
+    for i in range(num_levels,0,-1):
+        edge = max(edge,PLAN_FOCUS_CELLS*spacing[i-1])
+        dime = int(ceil(edge/spacing[i] - 1e-9)) + 1
+        edge = (dime - 1)*spacing[i]
+        levels.insert(0,[spacing[i],dime,dime,dime])
+        edge += 2*spacing[i-1]
+
+    return levels
+
+
+def planLevels(edge,offset,finest,max_ratio):
+    """
+    Return the grid levels with the lowest gridCost for a coarse grid of at
+    least edge (x, y, z) A, focused grids that fit inside it around sites up
+    to offset (x, y, z) A from its center and a finest spacing of finest.
+    Returns None if there are none within the PLAN limits and max_ratio.
+    """
+
+    best, best_cost = None, None
+    for coarse_dime in range(17,PLAN_MAX_DIME+1):
+        spacing = ceil(100*max(edge)/(coarse_dime - 1))/100.
+        if spacing <= finest:
+            spacing = finest
+        dime = [int(ceil(e/spacing - 1e-9)) + 1 for e in edge]
+        if max(dime) > PLAN_MAX_DIME:
+            continue
+        coarse = [spacing] + dime
+
+        candidates = []
+        if spacing == finest:
+            candidates.append([coarse])
+        else:
+            for num_levels in range(1,PLAN_MAX_LEVELS):
+                levels = focusLevels(spacing,finest,num_levels,max_ratio)
+                if levels == None or \
+                   max([l[1] for l in levels]) > PLAN_MAX_DIME:
+                    continue
+                half = (levels[0][1] - 1)*levels[0][0]/2.
+                if max([offset[k] + half - ((dime[k] - 1)*spacing/2. -
+                        spacing) for k in range(3)]) > 0:
+                    continue
+                candidates.append([coarse] + levels)
+
+        for grid_out in candidates:
+            cost = gridCost(grid_out)
+            if best_cost == None or cost < best_cost:
+                best, best_cost = grid_out, cost
+
+    return best
+
+
+def planGrid(structure,finest,site_index=None):
+    """
+    Choose grid levels for structure that reach a finest spacing of finest
+    (A) with the lowest gridCost.  The coarse grid is centered on the
+    centroid of the atoms; the focused grids are centered on each site (the
+    atoms in site_index, default all atoms) and must fit inside the coarse
+    grid for every site.  Every coarse grid size and number of levels within
+    the PLAN limits is tried.  If a structure is too large to reach finest
+    within PLAN_MAX_RATIO per level, the ratio limit is dropped.  Returns
+    grid_out (a nested list of grid levels).
+    """
+
+    c = structure.coord
+    size = len(structure)
+    if size == 0:
+        err = "No atoms to plan the grid with!"
+        raise MangledFileError(err)
+    finest = round(finest,2)
+    if finest <= 0:
+        err = "Finest grid spacing must be positive (not %s)!" % finest
+        raise MangledFileError(err)
+
+    # Extent of the molecule and offset of the sites from the grid center
+    extent, offset = [], []
+    if site_index == None:
+        site_index = range(size)
+    for k in range(3):
+        axis = c[k::3]
+        center = sum(axis)/size
+        extent.append(max(axis) - min(axis))
+        offset.append(max([abs(c[3*i+k] - center) for i in site_index] + [0.]))
+    edge = [max(e + 2*max(extent),PLAN_MIN_EDGE) for e in extent]
+
+    for max_ratio in [PLAN_MAX_RATIO,None]:
+        best = planLevels(edge,offset,finest,max_ratio)
+        if best != None:
+            break
+
+    if best == None:
+        err = "Unable to plan a grid reaching %.2F A within %i levels of " % \
+              (finest,PLAN_MAX_LEVELS)
+        err += "%i points!" % PLAN_MAX_DIME
+        raise MangledFileError(err)
+
+    return best
+
+
+def processGrid(structure,grid,plan_spacing=None,site_index=None):
     """
     Take the calc_param.grid and generate proper input for the generation of an
-    input file.  Either:
+    input file (structure is a Structure instance).  Either:
         1) A grid input file is specified; read the file but return an error
            if it is mangled.
         2) No grid input file is specified; generate a default grid based on the
            maximum dimension of the molecule.
+        3) plan_spacing is specified; plan the grid levels with planGrid, down
+           to a finest spacing of plan_spacing around the sites in site_index.
     Either way, the function returns grid_out (a nested list of grid levels).
     """
 
+    if plan_spacing != None:
+        return planGrid(structure,plan_spacing,site_index)
+
     # If the grid file is specified...
     if grid != None:
         grid_file = SystemOps.readFile(grid)
@@ -171,20 +463,16 @@ def processGrid(pdb,grid):
     # If the grid file is not specified...
     else:
 
-        # Load in coordinates of all Ca atoms
-        ca = [l for l in pdb if l[0:4] == "ATOM" and l[12:15] == "CA "]
-        coord = []
-        for atom in ca:
-            coord.append([float(atom[30+8*i:37+8*i]) for i in range(3)])
-        size = len(coord)
+        # Coordinates of all Ca atoms
+        ca = [i for i in range(len(structure))
+              if structure.name[i][:3] == "CA "]
+        coord = structure.coordinates(ca)
 
         # Find maximum dimension
-        d = [0. for i in range(size**2)]
-        for i in range(size):
-            for j in range(i+1,size):
-                d[i*size + j] = sum([(coord[i][k] - coord[j][k])**2
-                    for k in range(3)])
-        max_d = sqrt(max(d))
+        if len(coord) == 0:
+            err = "No CA atoms to size the grid with!  Specify a grid file."
+            raise MangledFileError(err)
+        max_d = maxDimension(coord)
 
         # Find top-level grid interval (3 * maximum dimension)/65.  If the
         # interval is less than 1.5 A, make it 1.5 A.
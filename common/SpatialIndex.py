@@ -0,0 +1,152 @@
+"""
+SpatialIndex.py
+
+A cell list over a set of coordinates (e.g. Structure.coordinates) for "which
+points are within r of X" queries.  Points are hashed into cubic cells of
+edge cell_size, so a query only looks at the cells within r of X rather than
+at every point.  Distances within a block of cells are calculated with NumPy
+if it is available.
+"""
+
+__author__ = "Michael J. Harms"
+
+from math import floor, ceil
+import Error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SpatialIndex(object):
+    """
+    Class that holds points (a list of (x, y, z) or an N x 3 array) hashed
+    into cells of edge cell_size.  Point i of the index is coord[i].  A point
+    is within r of another if their distance is strictly less than r.
+    """
+
+    def __init__(self,coord,cell_size):
+        """
+        Initialize class from coord and cell_size (Angstroms).  Queries are
+        fastest when r is about cell_size.
+        """
+
+        if cell_size <= 0:
+            err = "Cell size must be positive (not %s)!" % cell_size
+            raise Error.UhbdError(err)
+
+        self.cell_size = float(cell_size)
+        self.coord = [tuple([float(x) for x in c]) for c in coord]
+
+        cells = {}
+        for i, c in enumerate(self.coord):
+            cells.setdefault(self.cellKey(c),[]).append(i)
+        self.cells = cells
+
+        if numpy != None:
+            self.array = numpy.array(self.coord,dtype=float).reshape(-1,3)
+            for key in cells:
+                cells[key] = numpy.array(cells[key],dtype=int)
+
+    def __len__(self):
+        return len(self.coord)
+
+    def cellKey(self,point):
+        """
+        Return the cell (ix, iy, iz) that point falls in.
+        """
+
+        return tuple([int(floor(x/self.cell_size)) for x in point])
+
+    def neighborCells(self,key,reach):
+        """
+        Return the occupied cells within reach cells of key (including key).
+        """
+
+        out = []
+        for dx in range(-reach,reach+1):
+            for dy in range(-reach,reach+1):
+                for dz in range(-reach,reach+1):
+                    k = (key[0] + dx,key[1] + dy,key[2] + dz)
+                    if k in self.cells:
+                        out.append(k)
+
+        return out
+
+    def distances(self,a,b):
+        """
+        Return the squared distances between the points in a and those in b
+        (lists of point indices) as a len(a) x len(b) nested list (or array).
+        """
+
+        if numpy != None:
+            diff = self.array[a][:,None,:] - self.array[b][None,:,:]
+            return (diff**2).sum(2)
+
+        c = self.coord
+        return [[sum([(c[i][k] - c[j][k])**2 for k in range(3)]) for j in b]
+                for i in a]
+
+    def within(self,point,r):
+        """
+        Return the indices (sorted) of the points within r of point.
+        """
+
+        reach = int(ceil(r/self.cell_size))
+        key = self.cellKey(point)
+        r_squared = r**2
+
+        out = []
+        for k in self.neighborCells(key,reach):
+            members = self.cells[k]
+            if numpy != None:
+                d = ((self.array[members] - numpy.array(point))**2).sum(1)
+                out.extend(members[d < r_squared].tolist())
+            else:
+                c = self.coord
+                out.extend([i for i in members
+                            if sum([(c[i][j] - point[j])**2
+                                    for j in range(3)]) < r_squared])
+
+        out.sort()
+        return out
+
+    def pairs(self,r):
+        """
+        Return every pair of points (i, j), i < j, within r of each other.
+        """
+
+        reach = int(ceil(r/self.cell_size))
+        r_squared = r**2
+
+        out = []
+        for key in self.cells:
+            for k in self.neighborCells(key,reach):
+
+                # Each pair of cells is only compared once
+                if k < key:
+                    continue
+
+                a, b = self.cells[key], self.cells[k]
+                d = self.distances(a,b)
+                if numpy != None:
+                    ai, bj = numpy.nonzero(d < r_squared)
+                    close = zip(a[ai].tolist(),b[bj].tolist())
+                else:
+                    close = [(a[x],b[y]) for x in range(len(a))
+                             for y in range(len(b)) if d[x][y] < r_squared]
+                out.extend([(i,j) for i, j in close if k != key or i < j])
+
+        out = [(min(p),max(p)) for p in out]
+        out.sort()
+        return out
+
+
+def structureIndex(structure,index=None,cell_size=4.0):
+    """
+    Return a SpatialIndex over the atoms in index (default all) of a
+    Structure.  Point i of the SpatialIndex is atom index[i].
+    """
+
+    return SpatialIndex(structure.coordinates(index),cell_size)
@@ -0,0 +1,305 @@
+"""
+StageCache.py
+
+A content-addressed cache for the outputs of calculation stages.  Each stage is
+keyed on a hash of everything it reads (input files, binaries, parameters).
+If a stage with the same key has been run before, its outputs are copied back
+into the job directory instead of running the stage again.  The cache is
+bounded in size; the least recently used entries are evicted first.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, shutil, sys, time, hashlib, glob, tempfile
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"),".pyUHBD","cache")
+
+
+def hashFile(some_file,block_size=1048576):
+    """
+    Return the sha1 hex digest of the contents of some_file.
+    """
+
+    h = hashlib.sha1()
+    f = open(some_file,"rb")
+    block = f.read(block_size)
+    while block:
+        h.update(block)
+        block = f.read(block_size)
+    f.close()
+
+    return h.hexdigest()
+
+
+def binaryIdentity(some_bin):
+    """
+    Return a string identifying a binary by path, size and modification time.
+    (Hashing the full contents of every binary for every job is wasteful; a
+    recompile changes the size or modification time.)
+    """
+
+    stat = os.stat(some_bin)
+    return "%s %i %i" % (os.path.realpath(some_bin),stat.st_size,
+                         int(stat.st_mtime))
+
+
+def dirSize(some_dir):
+    """
+    Return the total size (bytes) of the files in some_dir.
+    """
+
+    return sum([os.path.getsize(os.path.join(some_dir,f))
+                for f in os.listdir(some_dir)])
+
+
+class StageCache:
+    """
+    Class that stores and restores stage outputs.  If cache_dir is None the
+    cache is disabled: every lookup misses and nothing is stored.
+    """
+
+    def __init__(self,cache_dir=None,max_size=5000):
+        """
+        Initialize class.  max_size is in MB.
+        """
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size*1048576
+        self.enabled = cache_dir != None
+
+        if self.enabled:
+            self.entry_dir = os.path.join(cache_dir,"entries")
+            self.log_file = os.path.join(cache_dir,"stats.log")
+            if not os.path.isdir(self.entry_dir):
+                try:
+                    os.makedirs(self.entry_dir)
+                except OSError:
+                    # Another process created it first
+                    if not os.path.isdir(self.entry_dir):
+                        raise
+
+    def key(self,stage,input_files,extra=[]):
+        """
+        Generate the key for stage from the contents of input_files and a list
+        of extra strings (binary identities, parameter values, etc.).  Returns
+        None if the cache is disabled.
+        """
+
+        if not self.enabled:
+            return None
+
+        h = hashlib.sha1()
+        h.update(stage)
+        for f in input_files:
+            h.update("\n%s %s" % (os.path.split(f)[-1],hashFile(f)))
+        for e in extra:
+            h.update("\n%s" % e)
+
+        return "%s-%s" % (stage,h.hexdigest())
+
+    def logEvent(self,event,key,size=0):
+        """
+        Record a cache event (hit, miss, store, evict) in the statistics log.
+        """
+
+        g = open(self.log_file,"a")
+        g.write("%.3F %s %s %i\n" % (time.time(),event,key,size))
+        g.close()
+
+    def restore(self,key,job_dir):
+        """
+        Copy the outputs stored under key into job_dir.  Returns True on a hit,
+        False on a miss (or if the cache is disabled).  The outputs are copied
+        into a temporary directory first and only moved into job_dir once all
+        of them have been copied, so an entry evicted part way through is a
+        miss that leaves job_dir untouched.
+        """
+
+        if not self.enabled:
+            return False
+
+        entry = os.path.join(self.entry_dir,key)
+        if not os.path.isdir(entry):
+            self.logEvent("miss",key)
+            return False
+
+        tmp_dir = tempfile.mkdtemp(prefix=".cache",dir=job_dir)
+        try:
+            try:
+                for f in os.listdir(entry):
+                    shutil.copy(os.path.join(entry,f),tmp_dir)
+            except (IOError, OSError):
+                # Entry evicted by another process while we copied it
+                self.logEvent("miss",key)
+                return False
+
+            size = dirSize(tmp_dir)
+            for f in os.listdir(tmp_dir):
+                os.rename(os.path.join(tmp_dir,f),os.path.join(job_dir,f))
+        finally:
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+
+        # Mark entry as recently used
+        try:
+            os.utime(entry,None)
+        except OSError:
+            pass
+        self.logEvent("hit",key,size)
+        print "Restored %s from cache." % key.split("-")[0]
+
+        return True
+
+    def store(self,key,job_dir,output_files):
+        """
+        Copy output_files from job_dir into the cache under key, then evict old
+        entries if the cache is over its size limit.  Entries in output_files
+        may be glob patterns (i.e. coarse.eps*).
+        """
+
+        if not self.enabled:
+            return
+
+        entry = os.path.join(self.entry_dir,key)
+        if os.path.isdir(entry):
+            return
+
+        # Build the entry in a directory of its own (other threads or
+        # processes may be storing the same key), then rename it so no one
+        # ever sees a partial entry.
+        tmp_entry = tempfile.mkdtemp(prefix=".store",dir=self.cache_dir)
+        try:
+            for pattern in output_files:
+                for f in glob.glob(os.path.join(job_dir,pattern)):
+                    shutil.copy(f,tmp_entry)
+            try:
+                os.rename(tmp_entry,entry)
+            except OSError:
+                if os.path.isdir(entry):
+                    # Another thread or process stored the same entry first
+                    return
+                raise
+        finally:
+            shutil.rmtree(tmp_entry,ignore_errors=True)
+
+        self.logEvent("store",key,dirSize(entry))
+        self.evict()
+
+    def entries(self):
+        """
+        Return a list of (last use time, size, key) for every complete entry,
+        least recently used first.
+        """
+
+        out = []
+        for key in os.listdir(self.entry_dir):
+            if ".tmp" in key:
+                continue
+            entry = os.path.join(self.entry_dir,key)
+            try:
+                out.append((os.path.getmtime(entry),dirSize(entry),key))
+            except OSError:
+                # Entry evicted by another process while we looked at it
+                pass
+        out.sort()
+
+        return out
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+        """
+
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+        for last_use, size, key in entries:
+            if total <= self.max_size:
+                break
+
+            # Rename the entry out of the way before removing it, so no process
+            # ever sees (and restores) an entry that is partly removed
+            entry = os.path.join(self.entry_dir,key)
+            evicted = "%s.tmp-evict%i" % (entry,os.getpid())
+            try:
+                os.rename(entry,evicted)
+            except OSError:
+                # Evicted by another process first
+                continue
+            shutil.rmtree(evicted,ignore_errors=True)
+            total -= size
+            self.logEvent("evict",key,size)
+
+    def report(self,since=0.):
+        """
+        Create a report of cache use (hits, misses, stores and evictions per
+        stage) for events after time since, plus the current cache size.
+        Returns the report as a string.
+        """
+
+        if not self.enabled:
+            return ""
+
+        counts = {}
+        if os.path.isfile(self.log_file):
+            f = open(self.log_file,"r")
+            for line in f.readlines():
+                c = line.split()
+                if len(c) != 4 or float(c[0]) < since:
+                    continue
+                stage = c[2].split("-")[0]
+                if not counts.has_key(stage):
+                    counts[stage] = {"hit":0,"miss":0,"store":0,"evict":0}
+                counts[stage][c[1]] += 1
+            f.close()
+
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+
+        out = ["Stage cache %s\n" % self.cache_dir]
+        out.append("   %-10s%8s%8s%8s%8s\n" % ("stage","hit","miss","store",
+                                              "evict"))
+        stages = counts.keys()
+        stages.sort()
+        for s in stages:
+            out.append("   %-10s%8i%8i%8i%8i\n" % (s,counts[s]["hit"],
+                                                  counts[s]["miss"],
+                                                  counts[s]["store"],
+                                                  counts[s]["evict"]))
+        out.append("   %i entries, %.1F of %.1F MB used\n" % \
+                   (len(entries),total/1048576.,self.max_size/1048576.))
+
+        return "".join(out)
+
+
+def openCache(calc_param):
+    """
+    Return the StageCache requested by calc_param (disabled unless
+    calc_param.cache is set).
+    """
+
+    if calc_param.cache:
+        return StageCache(calc_param.cache_dir,calc_param.cache_size)
+    return StageCache()
+
+
+if __name__ == "__main__":
+
+    __usage__ =\
+    """
+    StageCache.py [cache_dir]
+
+    Print statistics for a stage cache (default %s).
+    """ % DEFAULT_CACHE_DIR
+
+    if len(sys.argv) > 2:
+        print __usage__
+        sys.exit()
+    elif len(sys.argv) == 2:
+        cache_dir = sys.argv[1]
+    else:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    if not os.path.isdir(cache_dir):
+        print __usage__
+        sys.exit()
+
+    print StageCache(cache_dir).report(),
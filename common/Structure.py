@@ -0,0 +1,156 @@
+"""
+Structure.py
+
+A pdb file parsed once into columns.  Every step that needs to look at the
+atoms of a structure (createIndivParam, processHis, processCys, processGrid,
+writing proteinH.pdb, prepares/prepare) uses the same Structure instance
+rather than rereading and rescanning the file.  Only ATOM records are kept;
+their original lines are kept as well, so files written from a Structure are
+identical to those written from the raw text.
+"""
+
+__author__ = "Michael J. Harms"
+
+import array
+import Error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Header written at the top of proteinH.pdb (the fortran expects two lines)
+STRIPPED_HEADER = "%-79s\n" % "REMARK"
+
+
+class Structure(object):
+    """
+    Class that holds the ATOM records of a pdb file as columns: atom name
+    (columns 13-16), alternate location (17), residue name (18-21), chain
+    (22), residue number (23-26) and coordinates.  Atom and residue names are
+    kept unstripped, as in the file.
+    """
+
+    __slots__ = ["header","lines","name","altloc","resname","chain","resid",
+                 "coord"]
+
+    def __init__(self,pdb,header=None):
+        """
+        Initialize class from pdb, a list of lines.  header is the first line
+        of the file the structure is written to (default the first line of
+        pdb).
+        """
+
+        if header == None:
+            if len(pdb) > 0:
+                header = pdb[0]
+            else:
+                header = ""
+        self.header = header
+
+        self.lines = []
+        self.name = []
+        self.altloc = []
+        self.resname = []
+        self.chain = []
+        self.resid = array.array("i")
+        self.coord = array.array("d")
+        for i, l in enumerate(pdb):
+            if l[0:4] != "ATOM":
+                continue
+            try:
+                self.resid.append(int(l[22:26]))
+                self.coord.extend([float(l[30:38]),float(l[38:46]),
+                                   float(l[46:54])])
+            except ValueError:
+                err = "Mangled ATOM record (line %i):\n%s" % (i+1,l)
+                raise Error.UhbdError(err)
+            self.lines.append(l)
+            self.name.append(l[12:16])
+            self.altloc.append(l[16:17])
+            self.resname.append(l[17:21])
+            self.chain.append(l[21:22])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getstate__(self):
+        return [getattr(self,s) for s in self.__slots__]
+
+    def __setstate__(self,state):
+        for s, value in zip(self.__slots__,state):
+            setattr(self,s,value)
+
+    def coordinates(self,index=None):
+        """
+        Return the coordinates of the atoms in index (default all) as a list of
+        (x, y, z) tuples.
+        """
+
+        if index == None:
+            index = range(len(self.lines))
+        c = self.coord
+        return [(c[3*i],c[3*i+1],c[3*i+2]) for i in index]
+
+    def coordinateArray(self,index=None):
+        """
+        Return the coordinates of the atoms in index (default all) as an N x 3
+        NumPy array.  Requires numpy.
+        """
+
+        c = numpy.frombuffer(self.coord,dtype=float).reshape(-1,3)
+        if index == None:
+            return c.copy()
+        return c[numpy.asarray(index,dtype=int)]
+
+    def stripped(self):
+        """
+        Return the structure as it is written to proteinH.pdb: the ATOM
+        records only, under the REMARK header.
+        """
+
+        s = Structure([],STRIPPED_HEADER)
+        for name in self.__slots__[1:]:
+            setattr(s,name,getattr(self,name))
+
+        return s
+
+    def writeStripped(self,pdb_file):
+        """
+        Write the ATOM records to pdb_file with two REMARK lines at the top
+        and an END at the bottom (the form the uhbd fortran expects).
+        """
+
+        g = open(pdb_file,"w")
+        g.write("%-79s\n%-79s\n" % ("REMARK","REMARK"))
+        g.writelines(self.lines)
+        g.write("END")
+        g.close()
+
+
+def groupRuns(keys):
+    """
+    Split keys into runs of equal consecutive values in one pass.  Returns a
+    list of (key, [indices of the run]) in order.  A key may start more than
+    one run if its values are not consecutive.
+    """
+
+    runs = []
+    for i, k in enumerate(keys):
+        if len(runs) == 0 or runs[-1][0] != k:
+            runs.append((k,[]))
+        runs[-1][1].append(i)
+
+    return runs
+
+
+def readStructure(pdb_file,header=None):
+    """
+    Read pdb_file into a Structure.
+    """
+
+    f = open(pdb_file,"r")
+    pdb = f.readlines()
+    f.close()
+
+    return Structure(pdb,header)
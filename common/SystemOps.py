@@ -7,7 +7,8 @@ A set of functions for interacting with the native file system.
 __author__ = "Michael J. Harms"
 
 # import modules
-import os, shutil, sys
+import os, shutil, sys, subprocess
+import Execute
 
 def checkEnvironVariable(variable_name):
     """
@@ -23,17 +24,20 @@ def checkEnvironVariable(variable_name):
     return var
 
 
-def makeDir(dir):
+def makeDir(dir,wipe=True):
     """
     Create directory dir, recursively filling in directories if need be.  This
     will wipe out the directory if it exists (i.e. checking before overwrite 
-    should be done elsewhere).
+    should be done elsewhere) unless wipe is False.
     """
 
     try:
         os.mkdir(dir)
     except OSError, value:
         if value[0] == 17:
+            if not wipe:
+                return
+
             # If the directory exists, delete its contents. (This is to prevent
             # fortran "file exists" type errors).
             dir_contents = [os.path.join(dir,f) for f in os.listdir(dir)]
@@ -50,6 +54,76 @@ def makeDir(dir):
             raise IOError("Could not create directory %s!" % dir)
 
 
+def linkFile(source,destination):
+    """
+    Make destination a symbolic link to source.  Falls back on copying the
+    file on platforms without symbolic links.
+    """
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if hasattr(os,"symlink"):
+        os.symlink(os.path.abspath(source),destination)
+    else:
+        shutil.copy(source,destination)
+
+
+def linkFiles(source_dir,destination_dir,exclude=[]):
+    """
+    Link every file (not directory) in source_dir into destination_dir, except
+    those named in exclude.
+    """
+
+    file_list = [f for f in os.listdir(source_dir) if f not in exclude]
+    file_list = [f for f in file_list
+                 if os.path.isfile(os.path.join(source_dir,f))]
+    for f in file_list:
+        linkFile(os.path.join(source_dir,f),os.path.join(destination_dir,f))
+
+
+def copyFiles(source_dir,destination_dir,file_list=None,copy_dirs=False):
+    """
+    Copy the files in file_list (default every file) from source_dir into
+    destination_dir, skipping any that do not exist.  Directories are only
+    copied if copy_dirs is True.
+    """
+
+    if file_list == None:
+        file_list = os.listdir(source_dir)
+
+    for f in file_list:
+        source = os.path.join(source_dir,f)
+        destination = os.path.join(destination_dir,f)
+        if os.path.isfile(source):
+            shutil.copy(source,destination)
+        elif copy_dirs and os.path.isdir(source):
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            shutil.copytree(source,destination)
+
+
+# Background removals that may still be running (see removeDirBackground)
+removals = []
+
+def removeDirBackground(dir):
+    """
+    Remove dir and everything in it in a separate process, so the caller does
+    not wait for thousands of small files to be deleted.  Falls back on
+    removing dir in the foreground.
+    """
+
+    global removals
+
+    # Reap removals that have finished
+    removals = [r for r in removals if r.poll() == None]
+
+    try:
+        removals.append(subprocess.Popen(["rm","-rf",dir]))
+    except OSError:
+        shutil.rmtree(dir,ignore_errors=True)
+
+
 def readFile(some_file):
     """
     Reads an ascii file if it exists, removes blank lines, whitespace, and
@@ -73,27 +147,27 @@ def readFile(some_file):
         raise IOError("%s does not exist" % some_file)
 
 
-def runBin(some_bin):
+def runBin(some_bin,job_dir,timeout=None):
     """
-    Runs a binary file, checking for a variety of errors.
+    Runs a binary file in job_dir through Execute.runBinary, which captures its
+    output in job_dir/some_bin.stdout(.stderr), enforces the wall-clock limit
+    timeout (seconds) and raises an error on a non-zero exit.
     """
 
-    status = os.spawnl(os.P_WAIT,some_bin,'')
-    if status == 127:
-        err = "Problem with binary %s" % some_bin
-        raise IOError(err)
+    return Execute.runBinary(some_bin,job_dir,timeout=timeout)
 
-def runCleanup(calc_param):
+def runCleanup(calc_param,job_dir):
     """
-    Delete temporary files from a uhbd calculation.
+    Delete temporary files from a uhbd calculation in job_dir.
     """
 
     # Only if the user has not specified to keep temporary files
     if not calc_param.keep_temp:
 
         # Create list of files to delete, ignoring keep_files and directories
-        file_list = os.listdir('./')
+        file_list = os.listdir(job_dir)
         file_list = [f for f in file_list if f not in calc_param.keep_files]
+        file_list = [os.path.join(job_dir,f) for f in file_list]
         file_list = [f for f in file_list if os.path.isfile(f)]
 
         # Delete files
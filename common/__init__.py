@@ -1 +1,3 @@
-__all__ = ['ArgParser.py','ProcessInputFiles.py','SystemOps.py','Error.py']
+__all__ = ['ArgParser.py','ProcessInputFiles.py','SystemOps.py','Error.py',
+           'JobPool.py','StageCache.py','Execute.py','Structure.py',
+           'SpatialIndex.py']
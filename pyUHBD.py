@@ -12,9 +12,11 @@ __author__ = "Michael J. Harms"
 # a titration: they are already in their own directories in every calculation.
 NONSTANDARD_TITR = ["protein_dielec","ionic_strength"]
 
-import os, sys, shutil, copy
-from uhbd import ParseUhbd, GenerateUhbdInput
-from common import ProcessInputFiles, SystemOps, Error
+import os, sys, shutil, copy, time, tempfile
+from uhbd import ParseUhbd, GenerateUhbdInput, UhbdPreflight
+from uhbd import UhbdGridFunctions, UhbdSingleFunctions
+from common import ProcessInputFiles, SystemOps, Error, JobPool, StageCache
+from common import Structure
 
 invocation_path = os.getcwd()
 pyUHBD_dir = os.path.realpath(os.path.split(__file__)[0])
@@ -26,7 +28,7 @@ def setupOverride(calc_param,filename):
 
     # Create output directory
     output_dir = "%s_override" % filename[:-4]
-    SystemOps.makeDir(output_dir)
+    SystemOps.makeDir(output_dir,not calc_param.incremental)
 
     # Read in override file
     f = open(calc_param.override,'r')
@@ -65,10 +67,13 @@ def setupOverride(calc_param,filename):
 
     return output_dir
 
-def indivRun(filename,calc_param):
+def titrationPoints(filename,calc_param):
     """
-    Performs a single UHBD run.  If a variable is titrating, the titration is
-    run as well.
+    Generate the set of calculations to perform on filename: one for every
+    value of the titrating variable, or a single calculation if nothing is
+    titrating.  Output directories are created here.  Returns a list of
+    (label, output_dir, calc_param) tuples, where each calc_param is an
+    independent copy with the titrating variable set.
     """
 
     # Create fully specified path to filename
@@ -84,80 +89,141 @@ def indivRun(filename,calc_param):
                           "D%.1F" % calc_param.protein_dielec,
                           "%.1F" % calc_param.ionic_strength]
             output_dir = os.path.join(*output_dir)
-            SystemOps.makeDir(output_dir)
+            SystemOps.makeDir(output_dir,not calc_param.incremental)
 
-        # Run calculation
-        runCore(filename,output_dir,calc_param)
+        return [(None,output_dir,calc_param)]
 
-    else:
-        titr_var = calc_param.titration[0]
-        for t in calc_param.titr_values:
-
-            # Set the calc parameter that is titrating to the correct value
-            calc_param.__dict__[titr_var] = t
-
-            # Generate correct output directory name
-            if calc_param.titration[0] not in NONSTANDARD_TITR:
-                if type(t) == float:
-                    titr_dir = "%s_%.2F" % (calc_param.titration[0],t)
-                else:
-                    titr_dir = "%s_%s" % (calc_param.titration[0],t)
+    points = []
+    titr_var = calc_param.titration[0]
+    for t in calc_param.titr_values:
+
+        # Set the calc parameter that is titrating to the correct value
+        point_param = copy.copy(calc_param)
+        point_param.__dict__[titr_var] = t
+
+        # Generate correct output directory name
+        if titr_var not in NONSTANDARD_TITR:
+            if type(t) == float:
+                titr_dir = "%s_%.2F" % (titr_var,t)
             else:
-                titr_dir = ""
+                titr_dir = "%s_%s" % (titr_var,t)
+        else:
+            titr_dir = ""
 
-            # Create output directory
-            output_dir = [filename[:-4],calc_param.calc_type,
-                          "D%.1F" % calc_param.protein_dielec,
-                          "%.1F" % calc_param.ionic_strength,
-                          titr_dir]
-            output_dir = os.path.join(*output_dir)
-            SystemOps.makeDir(output_dir)
+        # Create output directory
+        output_dir = [filename[:-4],point_param.calc_type,
+                      "D%.1F" % point_param.protein_dielec,
+                      "%.1F" % point_param.ionic_strength,
+                      titr_dir]
+        output_dir = os.path.join(*output_dir)
+        SystemOps.makeDir(output_dir,not calc_param.incremental)
+
+        points.append(("%s: %s" % (titr_var,t),output_dir,point_param))
 
-            # Run uhbd
-            print "Titration %s: %s\n" % (titr_var,t),
-            runCore(filename,output_dir,calc_param)
+    return points
+
+
+def indivRun(filename,calc_param):
+    """
+    Performs a single UHBD run.  If a variable is titrating, the titration is
+    run as well.
+    """
+
+    removeSharedMaps(calc_param)
+    for label, output_dir, point_param in titrationPoints(filename,calc_param):
+        if label != None:
+            print "Titration %s\n" % label,
+        runCore(os.path.join(invocation_path,filename),output_dir,point_param)
+
+    removeSharedMaps(calc_param)
+
+
+def removeSharedMaps(calc_param):
+    """
+    Remove the coarse dielectric maps shared between the titration points of
+    a structure (see UhbdInterface.linkSharedMaps) once all points are done.
+    """
+
+    if calc_param.share_maps and not calc_param.keep_temp and \
+       os.path.isdir(calc_param.map_dir):
+        shutil.rmtree(calc_param.map_dir)
 
 
 def runCore(filename,output_dir,calc_param):
     """
-    The core operations that are done during a uhbd calculation.
+    The core operations that are done during a uhbd calculation.  Every stage
+    reads and writes files in the job directory; the working directory of the
+    process is never changed, so several calculations can share one process.
+    The job directory is output_dir, unless calc_param.scratch is set: then
+    the calculation runs in a new directory under calc_param.scratch and only
+    the files in calc_param.keep_files are copied to output_dir.
     """
 
-    # Copy pdb file to calculation directory and chdir
-    shutil.copy(filename,os.path.join(output_dir,"proteinH.pdb"))
-    os.chdir(output_dir)
+    if calc_param.scratch != None:
+        job_dir = tempfile.mkdtemp(prefix="pyUHBD-",dir=calc_param.scratch)
+        if calc_param.incremental:
+            SystemOps.copyFiles(output_dir,job_dir)
+    else:
+        job_dir = output_dir
+
+    try:
+        runJob(filename,job_dir,calc_param)
+    except:
+        # Leave everything in the output directory for debugging
+        if calc_param.scratch != None:
+            SystemOps.copyFiles(job_dir,output_dir)
+            SystemOps.removeDirBackground(job_dir)
+        raise
+
+    if calc_param.scratch != None:
+        if calc_param.keep_temp:
+            SystemOps.copyFiles(job_dir,output_dir,copy_dirs=True)
+        else:
+            SystemOps.copyFiles(job_dir,output_dir,calc_param.keep_files)
+        SystemOps.removeDirBackground(job_dir)
+    else:
+        # Delete temporary files
+        SystemOps.runCleanup(calc_param,output_dir)
 
-    # Strip down to only ATOM entries, then add dummy remarks at the top and a
-    # proper END statement at the end.
-    f = open("proteinH.pdb","r")
-    pdb = f.readlines()
-    f.close()
 
-    pdb = [l for l in pdb if l[0:4] == "ATOM"]
-    pdb.insert(0,"%-79s\n%-79s\n" % ("REMARK","REMARK"))
-    pdb.append("END")
+def runJob(filename,job_dir,calc_param):
+    """
+    Set up the input files for filename in job_dir and run the calculation.
+    """
 
-    g = open("proteinH.pdb","w")
-    g.writelines(pdb)
-    g.close()
+    # Write the ATOM entries of the structure (parsed by createIndivParam) to
+    # the calculation directory, with dummy remarks at the top and a proper END
+    # statement at the end.
+    calc_param.structure.writeStripped(os.path.join(job_dir,"proteinH.pdb"))
 
     # Set up input file (either copy manual override or generate automatically).
     if calc_param.override != None:
-        shutil.copy(calc_param.override,calc_param.inp_name)
+        shutil.copy(calc_param.override,
+                    os.path.join(job_dir,calc_param.inp_name))
     else:
-        GenerateUhbdInput.createDoinp(filename,calc_param)
+        GenerateUhbdInput.createDoinp(filename,calc_param,job_dir)
 
     # Copy parameter file into calculation directory
-    shutil.copy(calc_param.param_file,'.')
+    shutil.copy(calc_param.param_file,job_dir)
 
     # Run calculation
-    calc_param.run_uhbd(calc_param)
+    calc_param.run_uhbd(calc_param,job_dir)
+
 
-    # Delete temporary files
-    SystemOps.runCleanup(calc_param)
+def printGridPlan(structure,grid,sites):
+    """
+    Print the planned grid levels and their estimated cost next to that of the
+    default levels.
+    """
 
-    # Return to starting directory
-    os.chdir(invocation_path)
+    default = ProcessInputFiles.processGrid(structure,None)
+    cost = ProcessInputFiles.gridCost(grid)
+    default_cost = ProcessInputFiles.gridCost(default)
+
+    print "Planned grid (%i sites):" % len(sites)
+    print UhbdGridFunctions.gridSummary(grid),
+    print "   estimated cost per site %.3G (%.0F%% of the default grid), " % \
+          (cost,100*cost/default_cost) + "%.3G total" % (cost*len(sites))
 
 
 def createIndivParam(filename,calc_param):
@@ -170,44 +236,165 @@ def createIndivParam(filename,calc_param):
     # Make a copy of the instance lest we overwrite global parameters!
     indiv_calc_param = copy.copy(calc_param)
 
-    # Read in pdb file
-    f = open(filename,'r')
-    pdb = f.readlines()
-    f.close()
+    # Parse the pdb file once; every later step works from this
+    structure = Structure.readStructure(filename)
+    if len(structure) == 0:
+        raise Error.UhbdError("%s has no ATOM records!" % filename)
 
     # Find the first and last residues in the pdb file
-    residues = [int(line[22:26]) for line in pdb if line[0:4] == "ATOM"]
-    indiv_calc_param.first_residues = residues[0] - 1
-    indiv_calc_param.last_residues = residues[-1] + 1
+    indiv_calc_param.first_residues = structure.resid[0] - 1
+    indiv_calc_param.last_residues = structure.resid[-1] + 1
 
     # Set up his, cys, and grids for this pdb file
     indiv_calc_param.his_tautomers = \
-                    ProcessInputFiles.processHis(pdb,
+                    ProcessInputFiles.processHis(structure,
                                                  indiv_calc_param.his_tautomers)
     indiv_calc_param.cys_titrate = \
-                    ProcessInputFiles.processCys(pdb,
+                    ProcessInputFiles.processCys(structure,
                                                  indiv_calc_param.cys_titrate)
+    if calc_param.plan_grid != None:
+        sites = UhbdSingleFunctions.siteAtoms(structure)
+    else:
+        sites = None
     indiv_calc_param.grid = \
-                    ProcessInputFiles.processGrid(pdb,
-                                                  indiv_calc_param.grid)
+                    ProcessInputFiles.processGrid(structure,
+                                                  indiv_calc_param.grid,
+                                                  calc_param.plan_grid,sites)
+    if calc_param.plan_grid != None:
+        printGridPlan(structure,indiv_calc_param.grid,sites)
+    indiv_calc_param.structure = structure.stripped()
     indiv_calc_param.pdb_file = os.path.split(filename)[-1]
+    indiv_calc_param.map_dir = os.path.join(invocation_path,filename[:-4],
+                                            calc_param.calc_type,"maps")
+    indiv_calc_param.keep_files = calc_param.keep_files[:]
     indiv_calc_param.keep_files.append(indiv_calc_param.pdb_file)
 
     return indiv_calc_param
 
 
+def runStructure(filename,calc_param):
+    """
+    Set up and run all calculations for a single pdb file.
+    """
+
+    print "Calculation on %s" % filename
+    indiv_calc_param = createIndivParam(filename,calc_param)
+    indivRun(filename,indiv_calc_param)
+
+
+def titrationJobs(filename,calc_param):
+    """
+    Generate one job per titration point of filename.  The per-structure
+    preparation (createIndivParam) is done once and shared by all points.  The
+    log file for each point sits next to its output directory.  Returns the
+    calc_param for the structure and the list of jobs.
+    """
+
+    indiv_calc_param = createIndivParam(filename,calc_param)
+    points = titrationPoints(filename,indiv_calc_param)
+    removeSharedMaps(indiv_calc_param)
+
+    # Points that map to the same output directory would clobber each other
+    dir_list = [os.path.normpath(p[1]) for p in points]
+    for d in dir_list:
+        if dir_list.count(d) > 1:
+            err = "Titration points of %s share output directory %s!" % \
+                  (filename,d)
+            raise Error.UhbdError(err)
+
+    job_list = []
+    for label, output_dir, point_param in points:
+        if label == None:
+            job_label = filename
+        else:
+            job_label = "%s (%s)" % (filename,label)
+        log_file = "%s.log" % os.path.normpath(output_dir)
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+
+        job_list.append((job_label,runCore,
+                         (os.path.join(invocation_path,filename),output_dir,
+                          point_param),
+                         log_file))
+
+    return indiv_calc_param, job_list
+
+
+def runBatch(file_list,calc_param):
+    """
+    Run the pdb files in file_list concurrently using calc_param.jobs worker
+    processes (or threads, if calc_param.executor is "thread").  The output of
+    each job is written to a log file in its own output directory rather than
+    to the terminal.  If calc_param.parallel_titration is set, every titration
+    point of every file is an independent job; otherwise each file is one job.
+    """
+
+    job_list = []
+    setup_failures = []
+    shared_maps = []
+    for filename in file_list:
+
+        if calc_param.parallel_titration:
+            try:
+                indiv_calc_param, jobs = titrationJobs(filename,calc_param)
+                job_list.extend(jobs)
+                shared_maps.append(indiv_calc_param)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, value:
+                print "Could not set up %s: %s" % (filename,value)
+                setup_failures.append(JobPool.JobResult(filename,False,0.,
+                                                        None,str(value)))
+            continue
+
+        pdb_root = os.path.join(invocation_path,filename[:-4])
+        if not os.path.isdir(pdb_root):
+            os.makedirs(pdb_root)
+        log_file = os.path.join(pdb_root,"pyUHBD_%s.log" % calc_param.calc_type)
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+
+        job_list.append((filename,runStructure,(filename,calc_param),log_file))
+
+    print "Running %i calculations using %i %s workers." % \
+          (len(job_list),calc_param.jobs,calc_param.executor)
+    results = JobPool.runJobs(job_list,calc_param.jobs,calc_param.executor)
+    for indiv_calc_param in shared_maps:
+        removeSharedMaps(indiv_calc_param)
+    results.extend(setup_failures)
+    print JobPool.summarizeJobs(results),
+
+    return results
+
+
 def main():
     """
     Perform fdpb calculations on a set of pdb files.
     """
 
     calc_param, file_list = ParseUhbd.main()
+    start_time = time.time()
+
+    # Reject bad inputs before any calculations start
+    if calc_param.preflight:
+        reports = UhbdPreflight.preflight(file_list,calc_param)
+        print UhbdPreflight.preflightReport(reports),
+        if False in [r.success() for r in reports]:
+            sys.exit(1)
+
+    # Perform calculation on all files in file_list.  A file that fails does
+    # not stop the rest of the batch.
+    if calc_param.jobs > 1 or calc_param.parallel_titration:
+        results = runBatch(file_list,calc_param)
+    else:
+        job_list = [(f,runStructure,(f,calc_param),None) for f in file_list]
+        results = JobPool.runJobs(job_list)
+        print JobPool.summarizeJobs(results),
+
+    print StageCache.openCache(calc_param).report(start_time),
 
-    # Perform calculation on all files in file_list
-    for file in file_list:
-        print "Calculation on %s" % file
-        indiv_calc_param = createIndivParam(file,calc_param)
-        indivRun(file,indiv_calc_param)
+    if False in [r.success for r in results]:
+        sys.exit(1)
 
 # If pyUHBD is invoked from the command line, run main
 if __name__ == "__main__":
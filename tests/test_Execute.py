@@ -0,0 +1,114 @@
+"""
+test_Execute.py
+
+Tests of runBinary.  Run from the pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, signal, tempfile, time, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from common import Execute, Error
+
+
+class RunBinaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def script(self,name,body):
+        """
+        Write an executable shell script name in the job directory.
+        """
+
+        script = os.path.join(self.job_dir,name)
+        g = open(script,"w")
+        g.write("#!/bin/sh\n%s\n" % body)
+        g.close()
+        os.chmod(script,0755)
+
+        return script
+
+    def readFile(self,name):
+        f = open(os.path.join(self.job_dir,name),"r")
+        contents = f.read()
+        f.close()
+
+        return contents
+
+    def testSuccess(self):
+        binary = self.script("echo","cat; echo done")
+        record = Execute.runBinary(binary,self.job_dir,stdin_data="input\n",
+                                   timeout=30)
+        self.assertEqual(record.exit_code,0)
+        self.assertFalse(record.timed_out)
+        self.assertEqual(self.readFile("echo.stdout"),"input\ndone\n")
+        self.assertEqual(self.readFile(Execute.RUN_LOG).split()[:2],
+                         ["echo","0"])
+
+    def testFailure(self):
+        binary = self.script("fail","echo oops >&2; exit 3")
+        self.assertRaises(Error.UhbdError,Execute.runBinary,binary,
+                          self.job_dir)
+        self.assertEqual(self.readFile(Execute.RUN_LOG).split()[1],"3")
+
+    def testTimeout(self):
+        binary = self.script("hang","sleep 30")
+        start = time.time()
+        self.assertRaises(Error.UhbdError,Execute.runBinary,binary,
+                          self.job_dir,timeout=0.5)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(int(self.readFile(Execute.RUN_LOG).split()[1]),
+                         -signal.SIGKILL)
+
+    def testFinishedBeforeTimeout(self):
+        """
+        Binaries that finish at about the time limit either time out or
+        succeed, but a success is never reported as a time out.
+        """
+
+        binary = self.script("quick","exit 0")
+        for i in range(20):
+            try:
+                record = Execute.runBinary(binary,self.job_dir,timeout=0.002)
+            except Error.UhbdError:
+                continue
+            self.assertEqual(record.exit_code,0)
+            self.assertFalse(record.timed_out)
+
+    def testCheckLine(self):
+        binary = self.script("chatty","echo ok; echo BAD; sleep 30")
+        start = time.time()
+        record = Execute.runBinary(binary,self.job_dir,
+                                   check_line=lambda l: l.startswith("BAD"))
+        self.assertTrue(record.aborted)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(self.readFile("chatty.stdout"),"ok\nBAD\n")
+
+    def testCloseFds(self):
+        """
+        Binaries do not inherit the descriptors of pyUHBD (i.e. of other runs'
+        output files), which would keep a pipe open after a run finishes.
+        """
+
+        read_end, write_end = os.pipe()
+        try:
+            binary = self.script("fds","ls /proc/$$/fd")
+            Execute.runBinary(binary,self.job_dir)
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+
+        if os.path.isdir("/proc/self/fd"):
+            fds = self.readFile("fds.stdout").split()
+            self.assertFalse(str(write_end) in fds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,321 @@
+"""
+test_ProcessInputFiles.py
+
+Tests of the grid processing of pdb files.  Run from the pyUHBD
+directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, random, unittest
+from math import sqrt, ceil
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from common import ProcessInputFiles, Structure
+
+ATOM = "ATOM  %5i %-4s %-4s %4i    %8.3f%8.3f%8.3f  1.00  0.00\n"
+
+
+def pdbLines(atoms):
+    """
+    Return ATOM lines for atoms, a list of (name, residue name, residue
+    number, (x, y, z)).
+    """
+
+    return [ATOM % ((i+1,name,resname,resid) + tuple(c))
+            for i, (name, resname, resid, c) in enumerate(atoms)]
+
+
+def bruteMaxDimension(coord):
+    """
+    Return the maximum distance between any two points in coord by comparing
+    every pair.
+    """
+
+    max_d = 0.
+    for i in range(len(coord)):
+        for j in range(i+1,len(coord)):
+            max_d = max(max_d,sum([(coord[i][k] - coord[j][k])**2
+                                   for k in range(3)]))
+
+    return sqrt(max_d)
+
+
+def baselineGrid(pdb):
+    """
+    The default grid of processGrid before pdb files were parsed into a
+    Structure.  Coordinates were read from columns 31-37, 39-45 and 47-53,
+    dropping the last decimal of each field.
+    """
+
+    ca = [l for l in pdb if l[0:4] == "ATOM" and l[12:15] == "CA "]
+    coord = []
+    for atom in ca:
+        coord.append([float(atom[30+8*i:37+8*i]) for i in range(3)])
+
+    interval = (3*bruteMaxDimension(coord))/65
+    if interval < 1.5:
+        interval = 1.5
+
+    return [[interval, 65, 65, 65],
+            [1.2,      40, 40, 40],
+            [0.75,     40, 40, 40],
+            [0.25,     40, 40, 40]]
+
+
+class MaxDimensionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = ProcessInputFiles.numpy
+
+    def tearDown(self):
+        ProcessInputFiles.numpy = self.numpy
+
+    def clouds(self):
+        """
+        Return point sets of various shapes and sizes.
+        """
+
+        rng = random.Random(5)
+        out = [[],[(1.,2.,3.)],[(0.,0.,0.),(3.,4.,0.)],[(1.,1.,1.)]*10,
+               [(float(i),0.,0.) for i in range(100)]]
+        for size, shape in [(50,(10.,10.,10.)),(300,(40.,5.,5.)),
+                            (700,(20.,20.,20.))]:
+            out.append([tuple([rng.gauss(0.,s) for s in shape])
+                        for i in range(size)])
+
+        # Two distant clumps
+        out.append([(rng.gauss(0.,2.),rng.gauss(0.,2.),rng.gauss(0.,2.))
+                    for i in range(200)] +
+                   [(rng.gauss(50.,2.),rng.gauss(9.,2.),rng.gauss(0.,2.))
+                    for i in range(200)])
+
+        return out
+
+    def testBruteForce(self):
+        for coord in self.clouds():
+            self.assertAlmostEqual(ProcessInputFiles.maxDimension(coord),
+                                   bruteMaxDimension(coord),9)
+
+    def testBruteForceWithoutNumpy(self):
+        ProcessInputFiles.numpy = None
+        for coord in self.clouds():
+            self.assertAlmostEqual(ProcessInputFiles.maxDimension(coord),
+                                   bruteMaxDimension(coord),9)
+
+
+class DefaultGridTest(unittest.TestCase):
+
+    def structure(self,rng,digits):
+        """
+        Return the pdb lines of 150 residues (N, CA, C) spread over about
+        80 A, with coordinates rounded to digits decimals.
+        """
+
+        atoms = []
+        for i in range(150):
+            c = [round(rng.uniform(-40.,40.),digits) for k in range(3)]
+            for name in ["N","CA","C"]:
+                atoms.append((name,"ALA",i+1,c))
+                c = [x + 1.0 for x in c]
+
+        return pdbLines(atoms)
+
+    def testBaselineExtent(self):
+        """
+        Coordinates with two decimals give the grid of the baseline exactly.
+        """
+
+        pdb = self.structure(random.Random(6),2)
+        grid = ProcessInputFiles.processGrid(Structure.Structure(pdb),None)
+        expected = baselineGrid(pdb)
+        self.assertTrue(grid[0][0] > 1.5)
+        self.assertAlmostEqual(grid[0][0],expected[0][0],9)
+        self.assertEqual(grid[1:],expected[1:])
+
+    def testFullPrecision(self):
+        """
+        The third decimal of each coordinate is used now; the baseline dropped
+        it, which moved the coarse spacing by less than 3*2*sqrt(3)*0.01/65 A.
+        """
+
+        pdb = self.structure(random.Random(7),3)
+        s = Structure.Structure(pdb)
+        grid = ProcessInputFiles.processGrid(s,None)
+
+        ca = [i for i in range(len(s)) if s.name[i] == "CA  "]
+        self.assertAlmostEqual(grid[0][0],
+                               3*bruteMaxDimension(s.coordinates(ca))/65,9)
+        self.assertTrue(abs(grid[0][0] - baselineGrid(pdb)[0][0]) <
+                        3*2*sqrt(3)*0.01/65)
+
+    def testSmallMolecule(self):
+        pdb = pdbLines([("CA","ALA",1,(0.,0.,0.)),("CA","ALA",2,(3.8,0.,0.))])
+        grid = ProcessInputFiles.processGrid(Structure.Structure(pdb),None)
+        self.assertEqual(grid,baselineGrid(pdb))
+        self.assertEqual(grid[0][0],1.5)
+
+
+def planGeometry(coord,site_index):
+    """
+    Return the minimum coarse grid edges and the offsets of the sites from
+    the centroid that planGrid works to.
+    """
+
+    size = len(coord)
+    extent, offset = [], []
+    for k in range(3):
+        axis = [c[k] for c in coord]
+        center = sum(axis)/size
+        extent.append(max(axis) - min(axis))
+        offset.append(max([abs(coord[i][k] - center) for i in site_index]))
+    edge = [max(e + 2*max(extent),ProcessInputFiles.PLAN_MIN_EDGE)
+            for e in extent]
+
+    return edge, offset
+
+
+def validPlan(grid,edge,offset,finest,max_ratio):
+    """
+    Return whether grid meets every documented constraint of planGrid.
+    """
+
+    P = ProcessInputFiles
+    tol = 1e-9
+    if len(grid) > P.PLAN_MAX_LEVELS or abs(grid[-1][0] - finest) > tol:
+        return False
+    if max([max(g[1:]) for g in grid]) > P.PLAN_MAX_DIME:
+        return False
+    if min([(grid[0][k+1] - 1)*grid[0][0] - edge[k] for k in range(3)]) < -tol:
+        return False
+
+    for i in range(1,len(grid)):
+        parent, level = grid[i-1], grid[i]
+        level_edge = (level[1] - 1)*level[0]
+        if level[1:] != [level[1]]*3 or level[0] >= parent[0]:
+            return False
+        if max_ratio != None and parent[0] > max_ratio*level[0] + tol:
+            return False
+        if level_edge < P.PLAN_FOCUS_CELLS*parent[0] - tol:
+            return False
+
+        # Focused levels nest with a margin of one parent spacing; the first
+        # fits inside the coarse grid around every site
+        if i > 1 and level_edge + 2*parent[0] > \
+           (parent[1] - 1)*parent[0] + tol:
+            return False
+        if i == 1:
+            for k in range(3):
+                if offset[k] + level_edge/2. > \
+                   (parent[k+1] - 1)*parent[0]/2. - parent[0] + tol:
+                    return False
+
+    return (grid[-1][1] - 1)*grid[-1][0] >= P.PLAN_FINE_EDGE - tol
+
+
+def brutePlanCost(edge,offset,finest,max_ratio):
+    """
+    Return the lowest gridCost of any valid plan with a coarse grid of 17 to
+    PLAN_MAX_DIME points (the smallest spacing, to 0.01 A, that covers edge)
+    and 1 to PLAN_MAX_LEVELS - 1 focused levels.
+    """
+
+    P = ProcessInputFiles
+    best = None
+    for coarse_dime in range(17,P.PLAN_MAX_DIME+1):
+        spacing = ceil(100*max(edge)/(coarse_dime - 1))/100.
+        dime = [int(ceil(e/spacing - 1e-9)) + 1 for e in edge]
+        for num_levels in range(1,P.PLAN_MAX_LEVELS):
+            if spacing <= finest:
+                continue
+            levels = P.focusLevels(spacing,finest,num_levels,None)
+            if levels == None:
+                continue
+            grid = [[spacing] + dime] + levels
+            if validPlan(grid,edge,offset,finest,max_ratio):
+                cost = P.gridCost(grid)
+                if best == None or cost < best:
+                    best = cost
+
+    return best
+
+
+class PlanGridTest(unittest.TestCase):
+
+    def molecule(self,rng,size,span):
+        """
+        Return a Structure of size CA atoms spread over span x 0.7 span x
+        0.5 span A.
+        """
+
+        atoms = [("CA","ALA",i+1,(rng.uniform(0.,span),
+                                  rng.uniform(0.,0.7*span),
+                                  rng.uniform(0.,0.5*span)))
+                 for i in range(size)]
+
+        return Structure.Structure(pdbLines(atoms))
+
+    def testCheapest(self):
+        """
+        The plan meets every constraint and no valid plan is cheaper.
+        """
+
+        rng = random.Random(10)
+        for trial in range(12):
+            s = self.molecule(rng,rng.randint(5,150),rng.uniform(5.,50.))
+            finest = rng.choice([0.25,0.5,1.0])
+            sites = rng.sample(range(len(s)),min(len(s),5))
+            for site_index in [None,sites]:
+                grid = ProcessInputFiles.planGrid(s,finest,site_index)
+
+                if site_index == None:
+                    site_index = range(len(s))
+                edge, offset = planGeometry(s.coordinates(),site_index)
+                ratio = ProcessInputFiles.PLAN_MAX_RATIO
+                self.assertTrue(validPlan(grid,edge,offset,finest,ratio),
+                                grid)
+                self.assertAlmostEqual(ProcessInputFiles.gridCost(grid),
+                                       brutePlanCost(edge,offset,finest,
+                                                     ratio))
+
+    def testCheaperThanDefault(self):
+        """
+        For a typical protein the plan down to 0.25 A is cheaper than the
+        default levels, which also reach 0.25 A.
+        """
+
+        s = self.molecule(random.Random(11),150,40.)
+        grid = ProcessInputFiles.planGrid(s,0.25)
+        default = ProcessInputFiles.processGrid(s,None)
+        self.assertEqual(grid[-1][0],default[-1][0])
+        self.assertTrue(ProcessInputFiles.gridCost(grid) <
+                        ProcessInputFiles.gridCost(default))
+
+    def testRatioDropped(self):
+        """
+        A structure too large to reach the finest spacing at PLAN_MAX_RATIO
+        per level still gets the cheapest plan without the ratio limit.
+        """
+
+        s = self.molecule(random.Random(12),50,400.)
+        grid = ProcessInputFiles.planGrid(s,0.2)
+        edge, offset = planGeometry(s.coordinates(),range(len(s)))
+        self.assertEqual(brutePlanCost(edge,offset,0.2,
+                                       ProcessInputFiles.PLAN_MAX_RATIO),None)
+        self.assertTrue(validPlan(grid,edge,offset,0.2,None))
+        self.assertAlmostEqual(ProcessInputFiles.gridCost(grid),
+                               brutePlanCost(edge,offset,0.2,None))
+
+    def testErrors(self):
+        s = self.molecule(random.Random(13),10,10.)
+        self.assertRaises(ProcessInputFiles.MangledFileError,
+                          ProcessInputFiles.planGrid,s,0.)
+        self.assertRaises(ProcessInputFiles.MangledFileError,
+                          ProcessInputFiles.planGrid,
+                          Structure.Structure([]),0.25)
+
+
+if __name__ == "__main__":
+    unittest.main()
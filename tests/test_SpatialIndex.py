@@ -0,0 +1,121 @@
+"""
+test_SpatialIndex.py
+
+Tests of the cell list and the disulfide search built on it.  Run from the
+pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, random, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from common import SpatialIndex, ProcessInputFiles, Structure, Error
+
+ATOM = "ATOM  %5i %-4s %-4s %4i    %8.3f%8.3f%8.3f  1.00  0.00\n"
+
+
+def brutePairs(coord,r):
+    """
+    Return every pair (i, j), i < j, of points in coord closer than r by
+    comparing every pair.
+    """
+
+    out = []
+    for i in range(len(coord)):
+        for j in range(i+1,len(coord)):
+            if sum([(coord[i][k] - coord[j][k])**2 for k in range(3)]) < r**2:
+                out.append((i,j))
+
+    return out
+
+
+def baselineCys(pdb,disulfide_cutoff=3.5):
+    """
+    processCys (no input file) before the spatial index: every pair of CYS SG
+    compared, coordinates read from columns 32-38, 40-46 and 48-54.
+    """
+
+    cys_resid = [int(l[22:26]) for l in pdb
+                 if l[0:4] == "ATOM" and l[12:15] == "SG "]
+    coord = [[float(l[31+8*i:38+8*i]) for i in range(3)] for l in pdb
+             if l[0:4] == "ATOM" and l[12:15] == "SG "]
+
+    disulfide = []
+    for i, j in brutePairs(coord,disulfide_cutoff):
+        disulfide.append(cys_resid[i])
+        disulfide.append(cys_resid[j])
+
+    return [c for c in cys_resid if c not in disulfide]
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = SpatialIndex.numpy
+
+        rng = random.Random(8)
+        self.clouds = [[],[(0.,0.,0.)],[(1.,1.,1.)]*4,
+                       [(0.,0.,0.),(3.5,0.,0.),(3.4999,0.,0.)]]
+        for size, edge in [(100,10.),(200,20.),(150,100.)]:
+            self.clouds.append([tuple([rng.uniform(-edge,edge)
+                                       for k in range(3)])
+                                for i in range(size)])
+
+    def tearDown(self):
+        SpatialIndex.numpy = self.numpy
+
+    def check(self):
+        for coord in self.clouds:
+            expected = dict([(r,brutePairs(coord,r)) for r in [0.5,3.5,8.0]])
+            for cell_size in [1.0,3.5,7.0]:
+                index = SpatialIndex.SpatialIndex(coord,cell_size)
+                for r in expected:
+                    self.assertEqual(index.pairs(r),expected[r])
+                    for p in coord[:5] + [(0.5,-2.,40.)]:
+                        self.assertEqual(index.within(p,r),
+                            [i for i in range(len(coord)) if
+                             sum([(coord[i][k] - p[k])**2
+                                  for k in range(3)]) < r**2])
+
+    def testBruteForce(self):
+        self.check()
+
+    def testBruteForceWithoutNumpy(self):
+        SpatialIndex.numpy = None
+        self.check()
+
+    def testBadCellSize(self):
+        self.assertRaises(Error.UhbdError,SpatialIndex.SpatialIndex,
+                          [(0.,0.,0.)],0.)
+
+
+class DisulfideTest(unittest.TestCase):
+
+    def testBaseline(self):
+        """
+        processCys finds the same titrating cysteines as the all-pairs
+        search of the baseline, on coordinates with two decimals (the
+        baseline dropped the first character of each coordinate field, which
+        is only a blank for coordinates above -100 A).
+        """
+
+        rng = random.Random(9)
+        for trial in range(20):
+            pdb = []
+            for i in range(60):
+                c = [round(rng.uniform(-12.,12.),2) for k in range(3)]
+                pdb.append(ATOM % (2*i+1,"CA","CYS",i+1,c[0]+1.,c[1],c[2]))
+                pdb.append(ATOM % (2*i+2,"SG","CYS",i+1,c[0],c[1],c[2]))
+
+            structure = Structure.Structure(pdb)
+            cys = ProcessInputFiles.processCys(structure,None)
+            self.assertEqual(cys,baselineCys(pdb))
+            self.assertEqual(ProcessInputFiles.processCys(structure,None,5.0),
+                             baselineCys(pdb,5.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+test_StageCache.py
+
+Tests of the content-addressed stage cache.  Run from the pyUHBD directory
+with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, threading, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from common import StageCache
+
+
+def writeFile(some_file,contents):
+    """
+    Write contents to some_file.
+    """
+
+    g = open(some_file,"w")
+    g.write(contents)
+    g.close()
+
+
+def readFile(some_file):
+    """
+    Return the contents of some_file.
+    """
+
+    f = open(some_file,"r")
+    contents = f.read()
+    f.close()
+
+    return contents
+
+
+class StageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir,"cache")
+        self.cache = StageCache.StageCache(self.cache_dir)
+
+        self.job_dir = os.path.join(self.tmp_dir,"job")
+        os.mkdir(self.job_dir)
+        self.input_file = os.path.join(self.job_dir,"input.inp")
+        writeFile(self.input_file,"spacing 1.2\n")
+        writeFile(os.path.join(self.job_dir,"coarse.epsi"),"epsi map\n")
+        writeFile(os.path.join(self.job_dir,"coarse.epsj"),"epsj map\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def restoreDir(self,name):
+        """
+        Return a new, empty job directory.
+        """
+
+        some_dir = os.path.join(self.tmp_dir,name)
+        os.mkdir(some_dir)
+
+        return some_dir
+
+    def testHitAndMiss(self):
+        """
+        Stored outputs are restored under the same key; a changed input gives
+        a new key, which misses.
+        """
+
+        key = self.cache.key("uhbdini",[self.input_file],["uhbd 1 2"])
+        self.assertEqual(key,self.cache.key("uhbdini",[self.input_file],
+                                            ["uhbd 1 2"]))
+        self.assertFalse(self.cache.restore(key,self.restoreDir("first")))
+
+        self.cache.store(key,self.job_dir,["coarse.eps*"])
+        hit_dir = self.restoreDir("hit")
+        self.assertTrue(self.cache.restore(key,hit_dir))
+        self.assertEqual(sorted(os.listdir(hit_dir)),
+                         ["coarse.epsi","coarse.epsj"])
+        self.assertEqual(readFile(os.path.join(hit_dir,"coarse.epsi")),
+                         "epsi map\n")
+
+        writeFile(self.input_file,"spacing 1.0\n")
+        new_key = self.cache.key("uhbdini",[self.input_file],["uhbd 1 2"])
+        self.assertNotEqual(key,new_key)
+        miss_dir = self.restoreDir("miss")
+        self.assertFalse(self.cache.restore(new_key,miss_dir))
+        self.assertEqual(os.listdir(miss_dir),[])
+
+        report = self.cache.report()
+        self.assertTrue("uhbdini" in report and "1 entries" in report)
+
+    def testDisabled(self):
+        """
+        A cache without a directory misses and stores nothing.
+        """
+
+        cache = StageCache.StageCache()
+        key = cache.key("uhbdini",[self.input_file])
+        self.assertEqual(key,None)
+        cache.store(key,self.job_dir,["coarse.eps*"])
+        self.assertFalse(cache.restore(key,self.restoreDir("disabled")))
+
+    def testEviction(self):
+        """
+        Once the cache is over its size limit, the least recently used entries
+        are evicted.
+        """
+
+        keys = []
+        for i in range(3):
+            writeFile(self.input_file,"site %i\n" % i)
+            keys.append(self.cache.key("sites",[self.input_file]))
+            self.cache.store(keys[-1],self.job_dir,["coarse.eps*"])
+            entry = os.path.join(self.cache.entry_dir,keys[-1])
+            os.utime(entry,(1000. + i,1000. + i))
+        entry_size = self.cache.entries()[0][1]
+
+        # Using the oldest entry makes it the most recently used
+        self.assertTrue(self.cache.restore(keys[0],self.restoreDir("used")))
+
+        self.cache.max_size = 2*entry_size
+        self.cache.evict()
+        self.assertEqual(sorted([e[2] for e in self.cache.entries()]),
+                         sorted([keys[0],keys[2]]))
+        self.assertFalse(self.cache.restore(keys[1],self.restoreDir("gone")))
+        self.assertEqual(os.listdir(self.cache.entry_dir).count(keys[1]),0)
+
+    def testConcurrentStore(self):
+        """
+        Threads of one process storing the same key (i.e. titration points
+        sharing a uhbdini key) all succeed and leave one complete entry.
+        """
+
+        writeFile(os.path.join(self.job_dir,"coarse.epsk"),"x"*2000000)
+        key = self.cache.key("uhbdini",[self.input_file])
+
+        start = threading.Event()
+        errors = []
+        def store():
+            start.wait()
+            try:
+                self.cache.store(key,self.job_dir,["coarse.eps*"])
+            except Exception, value:
+                errors.append(value)
+
+        threads = [threading.Thread(target=store) for i in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors,[])
+        self.assertEqual(os.listdir(self.cache.entry_dir),[key])
+        self.assertEqual([f for f in os.listdir(self.cache_dir)
+                          if f.startswith(".store")],[])
+        restore_dir = self.restoreDir("restored")
+        self.assertTrue(self.cache.restore(key,restore_dir))
+        self.assertEqual(len(readFile(os.path.join(restore_dir,
+                                                   "coarse.epsk"))),2000000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+test_Structure.py
+
+Tests of the parsed pdb Structure.  Run from the pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, pickle, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from common import Structure, Error
+
+numpy = Structure.numpy
+
+ATOM = "ATOM  %5i %-4s%1s%-4s%1s%4i    %8.3f%8.3f%8.3f  1.00  0.00\n"
+
+PDB = ["HEADER    TEST STRUCTURE\n",
+       ATOM % (1," N  ","","ALA","A",1,-10.123,2.5,3.25),
+       ATOM % (2," CA ","","ALA","A",1,-999.5,22.125,-333.75),
+       ATOM % (3," CB ","A","HIS","A",2,1.0,2.0,3.0),
+       "HETATM    4  O   HOH A 101       1.000   2.000   3.000\n",
+       ATOM % (5," SG ","","CYS","B",2,4.0,-5.0,6.0),
+       "TER\n",
+       ATOM % (6,"HD21","","ASN","B",1234,7.0,8.0,-999.999),
+       "END\n"]
+
+
+class StructureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s = Structure.Structure(PDB)
+
+    def testColumns(self):
+        """
+        Only ATOM records are kept, split into unstripped columns.
+        """
+
+        s = self.s
+        self.assertEqual(len(s),5)
+        self.assertEqual(s.header,PDB[0])
+        self.assertEqual(s.lines,[l for l in PDB if l.startswith("ATOM")])
+        self.assertEqual(s.name,[" N  "," CA "," CB "," SG ","HD21"])
+        self.assertEqual(s.altloc,[" "," ","A"," "," "])
+        self.assertEqual(s.resname,["ALA ","ALA ","HIS ","CYS ","ASN "])
+        self.assertEqual(s.chain,["A","A","A","B","B"])
+        self.assertEqual(list(s.resid),[1,1,2,2,1234])
+
+    def testCoordinates(self):
+        """
+        Coordinates are read from the full eight column fields, including the
+        sign and the last decimal.
+        """
+
+        c = self.s.coordinates()
+        self.assertEqual(c[0],(-10.123,2.5,3.25))
+        self.assertEqual(c[1],(-999.5,22.125,-333.75))
+        self.assertEqual(c[4],(7.0,8.0,-999.999))
+        self.assertEqual(self.s.coordinates([3,0]),[c[3],c[0]])
+
+        if numpy != None:
+            self.assertTrue((self.s.coordinateArray() == c).all())
+            self.assertTrue((self.s.coordinateArray([3,0]) ==
+                             [c[3],c[0]]).all())
+
+    def testMangled(self):
+        pdb = PDB[:]
+        pdb[3] = pdb[3][:34] + "xx" + pdb[3][36:]
+        self.assertRaises(Error.UhbdError,Structure.Structure,pdb)
+
+        pdb = PDB[:]
+        pdb[3] = pdb[3][:30]
+        self.assertRaises(Error.UhbdError,Structure.Structure,pdb)
+
+    def testEmpty(self):
+        s = Structure.Structure([])
+        self.assertEqual((len(s),s.header),(0,""))
+        self.assertEqual(s.coordinates(),[])
+
+    def testPickle(self):
+        """
+        Structures are passed to worker processes by pickling.
+        """
+
+        s = pickle.loads(pickle.dumps(self.s,pickle.HIGHEST_PROTOCOL))
+        for name in Structure.Structure.__slots__:
+            self.assertEqual(getattr(s,name),getattr(self.s,name))
+
+    def testStripped(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pdb_file = os.path.join(tmp_dir,"proteinH.pdb")
+            stripped = self.s.stripped()
+            self.assertEqual(stripped.header,Structure.STRIPPED_HEADER)
+            self.assertEqual(stripped.lines,self.s.lines)
+
+            stripped.writeStripped(pdb_file)
+            f = open(pdb_file,"r")
+            lines = f.readlines()
+            f.close()
+
+            self.assertEqual(lines[:2],[Structure.STRIPPED_HEADER]*2)
+            self.assertEqual(lines[2:-1],self.s.lines)
+            self.assertEqual(lines[-1],"END")
+
+            # A written structure reads back the same
+            s = Structure.readStructure(pdb_file)
+            self.assertEqual(s.lines,self.s.lines)
+            self.assertEqual(s.coordinates(),self.s.coordinates())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testGroupRuns(self):
+        self.assertEqual(Structure.groupRuns([]),[])
+        self.assertEqual(Structure.groupRuns(list(self.s.resid)),
+                         [(1,[0,1]),(2,[2,3]),(1234,[4])])
+        self.assertEqual(Structure.groupRuns("aabba"),
+                         [("a",[0,1]),("b",[2,3]),("a",[4])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+test_UhbdHybrid.py
+
+Tests of the clustering and the hybrid.out report of the python hybrid
+titration.  Run from the pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdHybrid, UhbdPotentials
+
+numpy = UhbdHybrid.numpy
+
+POTENTIAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "data","potentials","pkaS-potentials")
+
+
+def coupledPotentials(groups,inside,between):
+    """
+    Return a Potentials instance of acidic sites in groups (a list of group
+    sizes).  Sites in the same group interact with potential inside, sites in
+    different groups with potential between.
+    """
+
+    group = numpy.repeat(numpy.arange(len(groups)),groups)
+    num_sites = len(group)
+    w = numpy.where(group[:,None] == group[None,:],inside,between)
+    w[numpy.diag_indices(num_sites)] = 0.
+    sites = [("ASP",i+1,"CG") for i in range(num_sites)]
+
+    return UhbdPotentials.Potentials(sites,4.0*numpy.ones(num_sites),
+                                     -numpy.ones(num_sites),
+                                     numpy.zeros(num_sites),
+                                     numpy.zeros(num_sites),
+                                     numpy.zeros(num_sites),w)
+
+
+def sparse(potentials):
+    """
+    Return a copy of potentials with its interaction matrix as a SparseMatrix.
+    """
+
+    rows, cols = numpy.nonzero(potentials.w)
+    w = UhbdPotentials.fromTriplets(rows,cols,potentials.w[rows,cols],
+                                    len(potentials))
+
+    return UhbdPotentials.Potentials(potentials.sites,potentials.pk_model,
+                                     potentials.charge,potentials.g_self,
+                                     potentials.g_born,potentials.g_back,w)
+
+
+class FindClustersTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is required")
+
+        self.cutoff = UhbdHybrid.CLUSTER_CUTOFF*numpy.log(10)*UhbdHybrid.R*298.
+
+    def checkPartition(self,clusters,num_sites):
+        """
+        Every site is in exactly one cluster and no cluster is too large.
+        """
+
+        members = numpy.sort(numpy.concatenate(clusters))
+        self.assertTrue((members == numpy.arange(num_sites)).all())
+        for c in clusters:
+            self.assertTrue(len(c) <= UhbdHybrid.MAX_CLUSTER)
+
+    def testLargeClusterIsSplit(self):
+        """
+        16 coupled sites (more than MAX_CLUSTER) split into their two groups.
+        """
+
+        potentials = coupledPotentials([8,8],5.0,1.5)
+        for p in [potentials,sparse(potentials)]:
+            w = UhbdHybrid.interactionMatrix(p)
+            clusters = UhbdHybrid.findClusters(w,self.cutoff)
+            self.checkPartition(clusters,16)
+            self.assertEqual([list(c) for c in clusters],
+                             [range(0,8),range(8,16)])
+
+    def testUniformClusterIsSplit(self):
+        """
+        20 equally coupled sites cannot be split into groups; they end up as
+        single sites.
+        """
+
+        potentials = coupledPotentials([20],3.0,0.)
+        w = UhbdHybrid.interactionMatrix(potentials)
+        clusters = UhbdHybrid.findClusters(w,self.cutoff)
+        self.checkPartition(clusters,20)
+
+    def testTitrateLargeCluster(self):
+        """
+        Titrating more than MAX_CLUSTER coupled sites converges, and dense and
+        sparse interaction matrices give the same result.
+        """
+
+        potentials = coupledPotentials([8,8],5.0,1.5)
+        ph = UhbdHybrid.phValues((0.,14.,1.))
+        dense = UhbdHybrid.titrate(potentials,ph,298.)
+        sparse_theta = UhbdHybrid.titrate(sparse(potentials),ph,298.)
+
+        self.assertEqual(dense.shape,(len(ph),16))
+        self.assertTrue((dense >= 0.).all() and (dense <= 1.).all())
+        self.assertTrue(abs(dense - sparse_theta).max() < 1e-6)
+
+
+def readLikePlotUhbd(hybrid_file):
+    """
+    Read the pH table of hybrid_file the way previous_releases/0.4.1/
+    plotUhbd.py reads hybrid.out.  Returns lists of pH, Z, dG(ion) and
+    dG(elec).
+    """
+
+    f = open(hybrid_file,'r')
+    hybrid = f.readlines()
+    f.close()
+
+    titr_end = hybrid.index("atom  type  resid  Group  pk(model)  pK(app)  "
+                            "DpK(app)  z  Gself  Gborn  Gback\n")
+    titr_hybrid = hybrid[2:titr_end-1]
+
+    ph, z, dg_ion, dg_elec = [], [], [], []
+    for line in titr_hybrid:
+        column = line.split()
+        ph.append(float(column[0]))
+        z.append(float(column[1]))
+        dg_ion.append(float(column[3]))
+        dg_elec.append(float(column[4]))
+
+    return ph, z, dg_ion, dg_elec
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is required")
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if hasattr(self,"tmp_dir"):
+            shutil.rmtree(self.tmp_dir)
+
+    def testIntrinsicPKa(self):
+        """
+        The intrinsic pKa is shifted by Gborn + Gback.
+        """
+
+        potentials = UhbdPotentials.Potentials([("ASP",1,"CG"),
+                                                ("LYS",2,"NZ")],
+                                               [4.0,10.4],[-1,1],[99.,99.],
+                                               [1.0,1.0],[0.5,0.5],
+                                               numpy.zeros((2,2)))
+        shift = 1.5/(numpy.log(10)*UhbdHybrid.R*298.)
+        pk_int = UhbdHybrid.intrinsicPKa(potentials,298.)
+        self.assertTrue(numpy.allclose(pk_int,[4.0 + shift,10.4 - shift]))
+
+    def testReportReadsAsHybridOut(self):
+        """
+        The report is hybrid.out, and readers of the hybrids hybrid.out find
+        one line per pH in it, with or without standard errors.
+        """
+
+        self.assertEqual(UhbdHybrid.REPORT_FILE,"hybrid.out")
+
+        hybrid_file = os.path.join(self.tmp_dir,UhbdHybrid.REPORT_FILE)
+        UhbdHybrid.runHybrid(POTENTIAL_FILE,(0.,14.,0.5),298.,hybrid_file)
+        ph, z, dg_ion, dg_elec = readLikePlotUhbd(hybrid_file)
+        self.assertTrue(numpy.allclose(ph,UhbdHybrid.phValues((0.,14.,0.5))))
+
+        # Two acids and two bases: +2 at low pH, -2 at high pH
+        self.assertAlmostEqual(z[0],2.0,2)
+        self.assertAlmostEqual(z[-1],-2.0,2)
+        self.assertEqual(dg_ion[0],0.)
+
+        potentials = UhbdPotentials.readPotentials(POTENTIAL_FILE)
+        ph = UhbdHybrid.phValues((0.,14.,0.5))
+        theta = UhbdHybrid.titrate(potentials,ph,298.)
+        errors = (0.01*numpy.ones(len(ph)),0.1*numpy.ones(len(potentials)))
+        g = open(hybrid_file,"w")
+        g.writelines(UhbdHybrid.hybridReport(potentials,ph,theta,298.,errors))
+        g.close()
+        self.assertEqual(len(readLikePlotUhbd(hybrid_file)[0]),len(ph))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+test_UhbdMonteCarlo.py
+
+Tests of the Metropolis Monte Carlo titration.  Run from the pyUHBD directory
+with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdMonteCarlo, UhbdHybrid, UhbdPotentials
+
+numpy = UhbdMonteCarlo.numpy
+
+
+def toSparse(w):
+    """
+    Return the non-zero entries of the dense matrix w as a SparseMatrix.
+    """
+
+    rows, cols = numpy.nonzero(w)
+    return UhbdPotentials.fromTriplets(rows,cols,w[rows,cols],len(w))
+
+
+class StrongPairsTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is required")
+
+    def testAgainstBruteForce(self):
+        rng = numpy.random.RandomState(3)
+        w = rng.normal(0.,1.,(40,40))
+        w = w + w.T
+        w[numpy.diag_indices(40)] = 0.
+
+        expected = [(i,j,w[i,j]) for i in range(40) for j in range(i+1,40)
+                    if abs(w[i,j]) > 1.5]
+        self.assertTrue(len(expected) > 0)
+        for matrix in [w,toSparse(w)]:
+            pairs = UhbdMonteCarlo.strongPairs(matrix,1.5)
+            self.assertEqual([(int(i),int(j)) for i, j, v in pairs],
+                             [(i,j) for i, j, v in expected])
+            self.assertTrue(numpy.allclose([v for i, j, v in pairs],
+                                           [v for i, j, v in expected]))
+
+    def testNoPairs(self):
+        self.assertEqual(UhbdMonteCarlo.strongPairs(numpy.zeros((5,5)),0.1),
+                         [])
+
+
+class DetailedBalanceTest(unittest.TestCase):
+    """
+    A chain on two strongly coupled sites (so pair moves are made) samples the
+    Boltzmann distribution over their four charge states.
+    """
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is required")
+
+        self.temperature = 298.
+        self.kT = UhbdHybrid.R*self.temperature
+        self.pk_int = numpy.array([4.0,4.5])
+        self.z = numpy.array([-1.,-1.])
+        self.ph = numpy.array([3.0,4.25,5.5])
+
+        # Charging both acids costs 2 kcal/mol (about 1.5 pK units)
+        self.w = numpy.array([[0.,2.],[2.,0.]])
+
+    def exactFractions(self):
+        """
+        Return the average charged state of each site at each pH, summed over
+        the four states.
+        """
+
+        g = self.z*numpy.log(10)*self.kT*(self.ph[:,None] -
+                                           self.pk_int[None,:])
+        out = numpy.zeros((len(self.ph),2))
+        for j in range(len(self.ph)):
+            total = 0.
+            for x in [(0,0),(1,0),(0,1),(1,1)]:
+                x = numpy.array(x,dtype=float)
+                energy = numpy.dot(g[j],x) + 0.5*numpy.dot(x,numpy.dot(self.w,
+                                                                       x))
+                weight = numpy.exp(-energy/self.kT)
+                out[j] += weight*x
+                total += weight
+            out[j] /= total
+
+        return out
+
+    def testBoltzmann(self):
+        exact = self.exactFractions()
+        cutoff = UhbdMonteCarlo.PAIR_CUTOFF*numpy.log(10)*self.kT
+        self.assertEqual(len(UhbdMonteCarlo.strongPairs(self.w,cutoff)),1)
+
+        for w in [self.w,toSparse(self.w)]:
+            blocks = UhbdMonteCarlo.runChain(self.pk_int,self.z,w,self.ph,
+                                             self.temperature,5000,1)
+            self.assertEqual(blocks.shape,(UhbdMonteCarlo.NUM_BLOCKS,3,2))
+            sampled = blocks.mean(0)
+            error = blocks.std(0)/numpy.sqrt(len(blocks))
+            self.assertTrue((abs(sampled - exact) < 0.02 + 5*error).all(),
+                            "%s vs %s" % (sampled,exact))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+test_UhbdParameters.py
+
+Tests of the compiled parameter files.  Run from the pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdParameters, UhbdFullFunctions
+from common import Error
+
+PARAM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir,"parameters")
+
+
+def baselineReadParamFile(param_file):
+    """
+    The atoms that differ between the neutral and charged forms of each
+    residue, as found by readParamFile before parameter files were compiled.
+    (Condensed from the original; the AminoAcidParameters class is replaced
+    by dictionaries.)  It never stored the last residue of the neutral and
+    charged records.
+    """
+
+    f = open(param_file)
+    param = f.readlines()
+    f.close()
+    param = [l for l in param if l[0] != "!" and l.strip() != ""]
+
+    record_table = []
+    for index, line in enumerate(param):
+        if line[0:4].lower() in ["equi","neut","char"]:
+            record_table.append(index)
+            if line[0:4].lower() == "neut":
+                neutral = len(record_table) - 1
+            elif line[0:4].lower() == "char":
+                charged = len(record_table) - 1
+    record_table.append(-1)
+
+    records = {}
+    for name, r in [("neutral",neutral),("charged",charged)]:
+        records[name] = param[record_table[r]:record_table[r+1]][2:]
+
+    # residue -> (atom list, {"neutral":{atom:data},"charged":{atom:data}})
+    all_fields = {}
+    for name in ["neutral","charged"]:
+        field = []
+        current = records[name][0].split()[0]
+        for line in records[name]:
+            if current != line.split()[0]:
+                if name == "neutral":
+                    all_fields[current] = ([l.split()[1] for l in field],
+                                           {"neutral":{},"charged":{}})
+                if current in all_fields:
+                    for l in field:
+                        c = l.split()
+                        all_fields[current][1][name][c[1]] = \
+                            [float(d) for d in c[2:5]]
+                current = line.split()[0]
+                field = [line]
+            else:
+                field.append(line)
+
+    return dict([(k,[a for a in atoms if p["charged"][a] != p["neutral"][a]])
+                 for k, (atoms, p) in all_fields.items()
+                 if p["charged"] != {}])
+
+
+class ParameterTest(unittest.TestCase):
+
+    def setUp(self):
+        UhbdParameters._loaded.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        UhbdParameters._loaded.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def lastResidues(self,param_file):
+        """
+        Return the residues at the end of the neut and char records of
+        param_file.
+        """
+
+        entries = UhbdParameters.parseParamFile(param_file)[0]
+        return set([[e for e in entries if e[0] == r][-1][1]
+                    for r in ["neut","char"]])
+
+    def testBaseline(self):
+        """
+        readParamFile (compiled in memory, and from the cache) gives the
+        baseline differences, plus the last residue of each record, which the
+        baseline dropped.
+        """
+
+        for name in ["ch22fjmb1.dat","qr_parse.dat"]:
+            param_file = os.path.join(PARAM_DIR,name)
+            expected = baselineReadParamFile(param_file)
+            last = self.lastResidues(param_file)
+
+            cache_dir = os.path.join(self.tmp_dir,name)
+            for i in range(2):
+                UhbdParameters._loaded.clear()
+                found = UhbdFullFunctions.readParamFile(param_file,cache_dir)
+                self.assertTrue(set(found) - set(expected) <= last)
+                self.assertTrue(len(set(found) - set(expected)) > 0)
+                self.assertEqual(dict([(k,found[k]) for k in expected]),
+                                 expected)
+            if UhbdParameters.numpy != None:
+                self.assertEqual(len(os.listdir(cache_dir)),1)
+
+    def testFindDifferences(self):
+        entries = [("neut","ASP","CG",0.1,0.,1.,1.),
+                   ("neut","ASP","OD1",-0.5,0.,1.,1.),
+                   ("neut","ASP","OD2",-0.5,0.,1.,1.),
+                   ("char","ASP","CG",0.1,0.,1.,1.),
+                   ("char","ASP","OD1",-0.5,0.,1.5,1.),
+                   ("char","ASP","OD2",-0.6,0.,1.,1.),
+                   ("neut","LYS","NZ",0.,0.,1.,1.),
+                   ("char","ARG","CZ",1.,0.,1.,1.),
+
+                   # The radius is not compared
+                   ("neut","TYR","OH",0.,0.,1.,1.),
+                   ("char","TYR","OH",0.,0.,1.,2.)]
+        self.assertEqual(UhbdParameters.findDifferences(entries),
+                         [("ASP","OD1"),("ASP","OD2")])
+
+    def testMangled(self):
+        param_file = os.path.join(self.tmp_dir,"bad.dat")
+        g = open(param_file,"w")
+        g.write("NEUT\nresi atom charge\nASP  CG  0.1 0.0\n")
+        g.close()
+        self.assertRaises(Error.UhbdError,UhbdParameters.parseParamFile,
+                          param_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
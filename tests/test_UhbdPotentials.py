@@ -0,0 +1,307 @@
+"""
+test_UhbdPotentials.py
+
+Tests of the python getpots, the potentials readers and sparse potentials.
+Run from the pyUHBD directory with:
+    python -m unittest discover tests
+
+tests/data/potentials holds a four site calculation in the layout described in
+uhbd/UhbdPotentials.py: pkaS-potentials, pkaS-sitesinpr.pdb and the uhbd
+output of site 2 (site0002).  No output of the getpots binary is distributed
+with pyUHBD, so pkaS-potentials was written by a separate (awk) implementation
+of that layout from synthetic uhbd output, not by getpots itself; at run time
+--python-getpots checks the layout against the getpots binary.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdPotentials
+from common import Error
+
+numpy = UhbdPotentials.numpy
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"data",
+                        "potentials")
+POTENTIAL_FILE = os.path.join(DATA_DIR,"pkaS-potentials")
+SITE_FILE = os.path.join(DATA_DIR,UhbdPotentials.SITE_FILE)
+SITE_DIR = os.path.join(DATA_DIR,"site0002")
+
+
+def readLines(some_file):
+    """
+    Return the lines of some_file.
+    """
+
+    f = open(some_file,"r")
+    lines = f.readlines()
+    f.close()
+
+    return lines
+
+
+def writeLines(some_file,lines):
+    """
+    Write lines to some_file.
+    """
+
+    g = open(some_file,"w")
+    g.writelines(lines)
+    g.close()
+
+
+class FixtureTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is not installed")
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if hasattr(self,"tmp_dir"):
+            shutil.rmtree(self.tmp_dir)
+
+    def testReadPotentials(self):
+        p = UhbdPotentials.readPotentials(POTENTIAL_FILE)
+
+        self.assertEqual(p.sites,[("ALAN",1,"N"),("ASP",3,"CG"),
+                                  ("GLU",7,"CD"),("LYSC",12,"NZ")])
+        self.assertEqual(list(p.pk_model),[7.5,4.0,4.4,10.4])
+        self.assertEqual(list(p.charge),[1,-1,-1,1])
+        self.assertTrue(numpy.allclose(p.g_born,[5.634,5.326,1.905,1.835]))
+        self.assertTrue(numpy.allclose(p.g_back,[0.835,-2.496,-1.673,2.445]))
+        self.assertTrue(numpy.allclose(p.g_self,p.g_born + p.g_back))
+        self.assertEqual(p.w.shape,(4,4))
+        self.assertTrue(numpy.allclose(p.w,p.w.T))
+        self.assertAlmostEqual(p.w[1,2],2.90125)
+        self.assertAlmostEqual(p.w[0,3],-0.2031)
+
+    def testSiteGroup(self):
+        self.assertEqual([UhbdPotentials.siteGroup(r) for r in
+                          ["HISA","HISC","LYSN","ASP","ALAN","GLYC"]],
+                         ["HISA","HISB","LYS","ASP","TERN","TERC"])
+        self.assertRaises(Error.UhbdError,UhbdPotentials.siteGroup,"ALA")
+
+    def testSiteBlock(self):
+        """
+        The python getpots gives the block of site 2 in pkaS-potentials.
+        """
+
+        sites = UhbdPotentials.readSites(SITE_FILE)[0]
+        index, block = UhbdPotentials.siteBlock(SITE_DIR,sites)
+        self.assertEqual(index,2)
+        self.assertEqual(block,readLines(POTENTIAL_FILE)[2:4])
+
+    def testGetpots(self):
+        """
+        getpots appends the block of its site to potentials.
+        """
+
+        site_dir = os.path.join(self.tmp_dir,"site0002")
+        shutil.copytree(SITE_DIR,site_dir)
+        expected = readLines(POTENTIAL_FILE)
+        writeLines(os.path.join(site_dir,"potentials"),expected[:2])
+
+        sites = UhbdPotentials.readSites(SITE_FILE)[0]
+        self.assertEqual(UhbdPotentials.getpots(site_dir,sites),2)
+        self.assertEqual(readLines(os.path.join(site_dir,"potentials")),
+                         expected[:4])
+
+    def testMissingEnergies(self):
+        site_dir = os.path.join(self.tmp_dir,"site0002")
+        shutil.copytree(SITE_DIR,site_dir)
+        out_file = os.path.join(site_dir,"uhbdpr.out")
+        writeLines(out_file,[l for l in readLines(out_file)
+                             if "Self energy" not in l])
+
+        sites = UhbdPotentials.readSites(SITE_FILE)[0]
+        self.assertRaises(Error.UhbdError,UhbdPotentials.siteBlock,site_dir,
+                          sites)
+
+    def changedCopy(self,lines):
+        """
+        Write lines as pkaS-potentials next to a copy of the fixture sites.
+        Returns the name of the new potentials file.
+        """
+
+        shutil.copy(SITE_FILE,self.tmp_dir)
+        potential_file = os.path.join(self.tmp_dir,"pkaS-potentials")
+        writeLines(potential_file,lines)
+
+        return potential_file
+
+    def testLayoutChecked(self):
+        """
+        Files that do not have exactly the expected layout are not misread.
+        """
+
+        lines = readLines(POTENTIAL_FILE)
+
+        # Different column widths in the site line
+        changed = lines[:]
+        changed[2] = changed[2].replace("    4.00 -1","   4.000-1")
+        self.assertRaises(Error.UhbdError,UhbdPotentials.readPotentials,
+                          self.changedCopy(changed))
+
+        # Sites in another order than pkaS-sitesinpr.pdb
+        changed = lines[2:4] + lines[0:2] + lines[4:]
+        self.assertRaises(Error.UhbdError,UhbdPotentials.readPotentials,
+                          self.changedCopy(changed))
+
+        # A missing potential
+        changed = lines[:]
+        changed[5] = changed[5][:-15] + "\n"
+        self.assertRaises(Error.UhbdError,UhbdPotentials.readPotentials,
+                          self.changedCopy(changed))
+
+        # An asymmetric matrix
+        changed = lines[:]
+        changed[3] = changed[3].replace("2.901250E+00","8.901250E+00")
+        self.assertRaises(Error.UhbdError,UhbdPotentials.readPotentials,
+                          self.changedCopy(changed))
+
+        # The unchanged file reads
+        UhbdPotentials.readPotentials(self.changedCopy(lines))
+
+
+def randomSparse(size,density,seed):
+    """
+    Return a random dense matrix with about density of its entries non-zero,
+    and the same matrix as a SparseMatrix (built from shuffled triplets).
+    """
+
+    rng = numpy.random.RandomState(seed)
+    dense = rng.normal(0.,1.,(size,size))*(rng.rand(size,size) < density)
+    rows, cols = numpy.nonzero(dense)
+    order = rng.permutation(len(rows))
+    rows, cols = rows[order], cols[order]
+
+    return dense, UhbdPotentials.fromTriplets(rows,cols,dense[rows,cols],size)
+
+
+class SparseMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is not installed")
+
+    def testRoundTrip(self):
+        dense, w = randomSparse(30,0.2,1)
+        self.assertEqual(len(w),30)
+        self.assertEqual(len(w.data),numpy.count_nonzero(dense))
+        self.assertTrue((w.toDense() == dense).all())
+        for i in [0,7,29]:
+            cols, values = w.rowEntries(i)
+            self.assertTrue((cols == numpy.nonzero(dense[i])[0]).all())
+            self.assertTrue((values == dense[i,cols]).all())
+
+    def testRepeatedEntriesAreSummed(self):
+        w = UhbdPotentials.fromTriplets([0,2,0,1],[1,2,1,0],[1.,2.,3.,4.],3)
+        self.assertTrue((w.toDense() == [[0.,4.,0.],[4.,0.,0.],
+                                         [0.,0.,2.]]).all())
+
+    def testEmpty(self):
+        w = UhbdPotentials.fromTriplets([],[],[],4)
+        self.assertTrue((w.toDense() == numpy.zeros((4,4))).all())
+        self.assertTrue((w.dot(numpy.ones(4)) == numpy.zeros(4)).all())
+
+    def testProducts(self):
+        dense, w = randomSparse(25,0.3,2)
+        x = numpy.random.RandomState(3).rand(6,25)
+        self.assertTrue(numpy.allclose(w.dot(x),numpy.dot(x,dense)))
+        self.assertTrue(numpy.allclose(w.dot(x[0]),numpy.dot(x[0],dense)))
+        self.assertTrue(numpy.allclose(UhbdPotentials.matrixDot(x,w),
+                                       UhbdPotentials.matrixDot(x,dense)))
+
+        index = [3,11,12,20]
+        self.assertTrue((UhbdPotentials.subMatrix(w,index) ==
+                         UhbdPotentials.subMatrix(dense,index)).all())
+
+
+class SparsePotentialsTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is not installed")
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if hasattr(self,"tmp_dir"):
+            shutil.rmtree(self.tmp_dir)
+
+    def testCutoff(self):
+        """
+        Only sites within the cutoff of each other keep their interaction.
+        """
+
+        dense = UhbdPotentials.readPotentials(POTENTIAL_FILE)
+        sparse = UhbdPotentials.readPotentials(POTENTIAL_FILE,cutoff=9.0)
+        coord = UhbdPotentials.readSites(SITE_FILE)[1]
+
+        near = UhbdPotentials.neighborMask(coord,range(4),9.0)
+        self.assertFalse(near.all())
+        self.assertTrue((sparse.w.toDense() == numpy.where(near,dense.w,
+                                                           0.)).all())
+        self.assertTrue((sparse.g_self == dense.g_self).all())
+
+    def testWriteRead(self):
+        sparse = UhbdPotentials.readPotentials(POTENTIAL_FILE,cutoff=9.0)
+        sparse_file = os.path.join(self.tmp_dir,UhbdPotentials.SPARSE_FILE)
+        UhbdPotentials.writeSparsePotentials(sparse_file,sparse,9.0)
+
+        p = UhbdPotentials.loadPotentials(sparse_file)
+        self.assertTrue(isinstance(p.w,UhbdPotentials.SparseMatrix))
+        self.assertEqual(p.sites,sparse.sites)
+        for name in ["pk_model","charge","g_self","g_born","g_back"]:
+            self.assertTrue((p.__dict__[name] == sparse.__dict__[name]).all())
+        self.assertTrue((p.w.toDense() == sparse.w.toDense()).all())
+
+
+class CheckSymmetricTest(unittest.TestCase):
+
+    def setUp(self):
+        if numpy == None:
+            self.skipTest("numpy is not installed")
+
+        rng = numpy.random.RandomState(4)
+        w = rng.normal(0.,1.,(20,20))
+        self.w = w + w.T
+
+    def check(self,w):
+        for matrix in [w,UhbdPotentials.fromTriplets(
+                numpy.nonzero(w)[0],numpy.nonzero(w)[1],w[numpy.nonzero(w)],
+                len(w))]:
+            UhbdPotentials.checkSymmetric(matrix,"pkaS-potentials")
+
+    def testSymmetric(self):
+        w = self.w.copy()
+
+        # Within the relative tolerance, and near zero within the floor
+        w[2,5] *= 1. + 0.5*UhbdPotentials.SYMMETRY_TOLERANCE
+        w[3,4] = 0.5*UhbdPotentials.SYMMETRY_FLOOR
+        w[4,3] = 0.
+        self.check(w)
+        self.check(numpy.zeros((0,0)))
+
+    def testAsymmetric(self):
+        w = self.w.copy()
+        w[6,13] += 5.
+        try:
+            self.check(w)
+        except Error.UhbdError, value:
+            self.assertTrue("potential 7,14" in str(value) or
+                            "potential 14,7" in str(value))
+        else:
+            self.fail("asymmetric matrix passed")
+
+        # An entry missing from a sparse matrix counts as zero
+        w = self.w.copy()
+        w[8,1] = 0.
+        self.assertRaises(Error.UhbdError,self.check,w)
+
+
+if __name__ == "__main__":
+    unittest.main()
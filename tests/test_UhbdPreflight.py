@@ -0,0 +1,154 @@
+"""
+test_UhbdPreflight.py
+
+Tests of the --preflight checks.  Run from the pyUHBD directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdPreflight, UhbdParameters
+
+PARAM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir,"parameters","pkaS.dat")
+
+ATOM = "ATOM  %5i %-4s %-4s %4i    %8.3f%8.3f%8.3f  1.00  0.00\n"
+
+# Three residues with the atom names of pkaS.dat
+RESIDUES = [("ALA",["N","H","CA","CB","C","O"]),
+            ("GLY",["N","H","CA","C"]),
+            ("ALA",["N","H","CA","CB","C","O"])]
+
+
+class CalcParam:
+    """
+    Stand-in for the calc_param of a single-site calculation.
+    """
+
+    def __init__(self,**kwargs):
+        self.calc_type = "single"
+        self.full = False
+        self.param_file = PARAM_FILE
+        self.his_tautomers = None
+        self.cys_titrate = None
+        self.grid = None
+        self.plan_grid = None
+        self.cache = False
+        self.cache_dir = None
+        self.__dict__.update(kwargs)
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        UhbdParameters._loaded.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.atoms = []
+        for resid, (resname, names) in enumerate(RESIDUES):
+            for k, name in enumerate(names):
+                self.atoms.append([name,resname,resid+1,
+                                   [3.8*resid + 0.5*k,0.3*k,-0.2*k]])
+
+    def tearDown(self):
+        UhbdParameters._loaded.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def writeFile(self,name,lines):
+        """
+        Write lines to name in the temporary directory.  Returns the path.
+        """
+
+        some_file = os.path.join(self.tmp_dir,name)
+        g = open(some_file,"w")
+        g.writelines(lines)
+        g.close()
+
+        return some_file
+
+    def writePdb(self,name,atoms=None):
+        if atoms == None:
+            atoms = self.atoms
+        return self.writeFile(name,["HEADER    TEST\n"] +
+                              [ATOM % tuple([i+1] + a[:3] + a[3])
+                               for i, a in enumerate(atoms)] + ["END\n"])
+
+    def check(self,pdb_file,**kwargs):
+        """
+        Return the report of preflight on pdb_file.
+        """
+
+        reports = UhbdPreflight.preflight([pdb_file],CalcParam(**kwargs))
+        self.assertEqual(len(reports),1)
+
+        return reports[0]
+
+    def assertRejected(self,report,text):
+        self.assertFalse(report.success())
+        self.assertTrue(text in "".join(report.report()),report.report())
+
+    def testGood(self):
+        good = self.writePdb("good.pdb")
+        report = self.check(good)
+        self.assertTrue(report.success(),report.report())
+        self.assertEqual(report.num_atoms,16)
+
+    def testUnreadable(self):
+        lines = [ATOM % tuple([i+1] + a[:3] + a[3])
+                 for i, a in enumerate(self.atoms)]
+        lines[3] = lines[3][:32] + "x.xxx" + lines[3][37:]
+        bad = self.writeFile("mangled.pdb",lines)
+        self.assertRejected(self.check(bad),"Mangled ATOM record")
+
+        self.assertRejected(self.check(os.path.join(self.tmp_dir,"none.pdb")),
+                            "FAILED")
+        self.assertRejected(self.check(self.writeFile("empty.pdb",["END\n"])),
+                            "no ATOM records")
+
+    def testUnknownAtoms(self):
+        self.atoms[7][0] = "XX"
+        self.atoms[2][1] = "FOO"
+        report = self.check(self.writePdb("unknown.pdb"))
+        self.assertRejected(report,"atoms of 2 residue types not in pkaS.dat")
+        self.assertRejected(report,"GLY  (first in residue 2): XX")
+        self.assertRejected(report,"FOO  (first in residue 1): CA")
+
+    def testGrid(self):
+        pdb_file = self.writePdb("good.pdb")
+
+        grid_file = self.writeFile("grid.txt",["0.5 9 9 9\n"])
+        self.assertRejected(self.check(pdb_file,grid=grid_file),
+                            "past the coarsest grid")
+
+        grid_file = self.writeFile("grid.txt",["1.0 65 65 65\n",
+                                               "2.0 40 40 40\n"])
+        self.assertRejected(self.check(pdb_file,grid=grid_file),
+                            "grid: Grid 2 (2.0 A) is not finer")
+
+    def testCysTitrate(self):
+        cys_file = self.writeFile("cys.txt",["5\n"])
+        self.assertRejected(self.check(self.writePdb("good.pdb"),
+                                       cys_titrate=cys_file),
+                            "cys_titrate: Some cys specified")
+
+    def testBatch(self):
+        """
+        Every file of a batch is checked, and only the bad ones fail.
+        """
+
+        good = self.writePdb("good.pdb")
+        self.atoms[0][0] = "XX"
+        bad = self.writePdb("bad.pdb")
+
+        reports = UhbdPreflight.preflight([bad,good],CalcParam())
+        self.assertEqual([r.success() for r in reports],[False,True])
+        self.assertTrue(UhbdPreflight.preflightReport(reports).startswith(
+                        "Preflight checks passed for 1 of 2 files."))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+test_UhbdStages.py
+
+Tests of the stage manifest used by --incremental.  Run from the pyUHBD
+directory with:
+    python -m unittest discover tests
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir))
+
+from uhbd import UhbdStages
+
+
+class CalcParam:
+    """
+    Stand-in for the calc_param of a single-site calculation.
+    """
+
+    def __init__(self,**kwargs):
+        self.full = False
+        self.incremental = True
+        self.param_file = "/some/where/param.dat"
+        self.grid = [(65,2.0),(65,1.0)]
+        self.ionic_strength = 100.0
+        self.ph_param = (-5.0,20.0,0.25)
+        self.__dict__.update(kwargs)
+
+
+class StageManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        for f in ["proteinH.pdb","param.dat"]:
+            self.touch(f,"%s\n" % f)
+
+        # A complete single-site calculation
+        manifest = UhbdStages.StageManifest(CalcParam(),self.job_dir)
+        for stage in UhbdStages.STAGES:
+            self.assertTrue(manifest.run(stage))
+            manifest.done(stage)
+        for f in UhbdStages.SINGLE_REQUIRES["getgrids"] + \
+                 UhbdStages.SINGLE_REQUIRES["hybrid"]:
+            self.touch(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def touch(self,some_file,contents=""):
+        """
+        Write contents to some_file in the job directory.
+        """
+
+        g = open(os.path.join(self.job_dir,some_file),"w")
+        g.write(contents)
+        g.close()
+
+    def firstStage(self,**kwargs):
+        """
+        Return the first stage an --incremental rerun with kwargs changed in
+        calc_param would run (None if everything is up to date).
+        """
+
+        manifest = UhbdStages.StageManifest(CalcParam(**kwargs),self.job_dir)
+        to_run = [s for s in UhbdStages.STAGES if manifest.run(s)]
+        if len(to_run) == 0:
+            return None
+
+        self.assertEqual(to_run,
+                         UhbdStages.STAGES[UhbdStages.STAGES.index(to_run[0]):])
+        return to_run[0]
+
+    def testUpToDate(self):
+        self.assertEqual(self.firstStage(),None)
+
+    def testNotIncremental(self):
+        self.assertEqual(self.firstStage(incremental=False),"prepares")
+
+    def testChangedOption(self):
+        """
+        Each stage reruns from the first stage that reads the changed option.
+        """
+
+        self.assertEqual(self.firstStage(ph_param=(0.0,14.0,0.5)),"hybrid")
+        self.assertEqual(self.firstStage(ionic_strength=50.0),"getgrids")
+        self.assertEqual(self.firstStage(grid=[(65,1.5),(65,1.0)]),"uhbdini")
+
+        self.touch("proteinH.pdb","changed\n")
+        self.assertEqual(self.firstStage(),"prepares")
+
+    def testStepBack(self):
+        """
+        A stage whose inputs are missing from the job directory steps back to
+        an earlier stage that can be started.
+        """
+
+        # The site loop cannot be started on its own
+        os.remove(os.path.join(self.job_dir,"pkaS-potentials"))
+        self.assertEqual(self.firstStage(ph_param=(0.0,14.0,0.5)),"getgrids")
+
+        # getgrids needs the coarse maps of uhbdini
+        os.remove(os.path.join(self.job_dir,"coarse.epsk"))
+        self.assertEqual(self.firstStage(ph_param=(0.0,14.0,0.5)),"uhbdini")
+        self.assertEqual(self.firstStage(ionic_strength=50.0),"uhbdini")
+
+    def testDoneRecordsStage(self):
+        """
+        A rerun that stops after a stage leaves a manifest from which the next
+        run continues.
+        """
+
+        manifest = UhbdStages.StageManifest(CalcParam(ph_param=(0.,14.,0.5)),
+                                            self.job_dir)
+        self.assertFalse(manifest.run("sites"))
+        self.assertEqual(self.firstStage(ph_param=(0.,14.,0.5)),"hybrid")
+        manifest.done("hybrid")
+        self.assertEqual(self.firstStage(ph_param=(0.,14.,0.5)),None)
+        self.assertEqual(self.firstStage(),"hybrid")
+
+
+if __name__ == "__main__":
+    unittest.main()
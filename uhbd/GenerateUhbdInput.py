@@ -77,10 +77,10 @@ class ResidueEntry(DoinpEntry):
         self.value = self.value[:-1]
 
 
-def createDoinp(filename,calc_param):
+def createDoinp(filename,calc_param,job_dir):
     """
-    Generates a standard UHBD input file given a filename and set of calc
-    paramters.  This is done by generating DoinpEntry instances for each option
+    Generates a standard UHBD input file in job_dir given a filename and set of
+    calc paramters.  This is done by generating DoinpEntry instances for each option
     that are then written to a file using DoinpEntry.writeOutput.
     """
 
@@ -124,7 +124,7 @@ def createDoinp(filename,calc_param):
     inp_file = "".join(inp_file)
 
     # Write output to inp file name
-    g = open(calc_param.inp_name,"w")
+    g = open(os.path.join(job_dir,calc_param.inp_name),"w")
     g.write(inp_file)
     g.close()
 
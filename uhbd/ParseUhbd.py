@@ -23,8 +23,11 @@ LOCKED_SETTINGS = {"iterations":300,"added_residues":0,"change_acid":"n",
 
 # Files to keep for clean up
 SINGLE_KEEPFILES = ['hybrid.out','pkaS-doinp.inp','pkaS-potentials',
-                    'pkaS-sitesinpr.pdb','titraa.pdb']
-FULL_KEEPFILES =   ['hybrid.out','doinp.inp','pkaF-potentials','sites.dat']
+                    'pkaS-sitesinpr.pdb','titraa.pdb','pyUHBD-stages.dat',
+                    'pyUHBD-runs.dat','mc-fractions.dat',
+                    'pkaS-potentials.npz']
+FULL_KEEPFILES =   ['hybrid.out','doinp.inp','pkaF-potentials','sites.dat',
+                    'pyUHBD-stages.dat','pyUHBD-runs.dat']
 
 # In a perfect world, the following global options would be attributes of each
 # option in parser. This would involve some large, non-intuitive modifications
@@ -32,11 +35,22 @@ FULL_KEEPFILES =   ['hybrid.out','doinp.inp','pkaF-potentials','sites.dat']
 # solution of setting some global variables.
 
 # Options that the user cannot titrate
-NOT_TITRATABLE = ["full","keep_temp","titration","ph_param","override"]
+NOT_TITRATABLE = ["full","keep_temp","titration","ph_param","override","jobs",
+                  "parallel_titration","executor","site_jobs",
+                  "site_batch","check_sites","cache","cache_dir","cache_size",
+                  "share_maps","incremental","timeout","stall",
+                  "scratch","python_getpots","python_hybrid",
+                  "monte_carlo","sparse_cutoff",
+                  "preflight","plan_grid"]
 
 # Options compatible with the --override setting; everything else is
 # incompatible
-OVERRIDE_COMPATIBLE = ["keep","ph_param","full","override"]
+OVERRIDE_COMPATIBLE = ["keep","ph_param","full","override","jobs",
+                       "parallel_titration","executor","site_jobs",
+                       "site_batch","check_sites","cache","cache_dir",
+                       "cache_size","share_maps","incremental","timeout",
+                       "stall","scratch","python_getpots","python_hybrid",
+                       "monte_carlo","sparse_cutoff"]
 
 
 # ---------- Initialize module --------------------
@@ -44,8 +58,9 @@ OVERRIDE_COMPATIBLE = ["keep","ph_param","full","override"]
 
 # Load pyUHBD modules
 import os
-from common import SystemOps, ArgParser
-from uhbd import UhbdInterface
+from common import SystemOps, ArgParser, StageCache, Error
+from uhbd import UhbdInterface, UhbdStages, UhbdPotentials, UhbdHybrid, \
+                 UhbdMonteCarlo, UhbdParameters
 
 default_location = os.path.split(__file__)[0]
 default_location = os.path.split(default_location)[0]
@@ -72,6 +87,97 @@ def main():
     parser.add_option("-k","--keep-temp",action="store_true",default=False,
                       help="Delete temporary files [default %default]")
 
+    # Execution options (not available for titration)
+    parser.add_option("-j","--jobs",action="store",type="int",default=1,
+                      help="Number of calculations to run concurrently " +
+                      "[default %default]")
+    parser.add_option("--parallel-titration",action="store_true",
+                      default=False,
+                      help="Run each titration point as a separate job " +
+                      "[default %default]")
+    parser.add_option("--executor",action="store",type="choice",
+                      choices=["process","thread"],default="process",
+                      help="Run concurrent calculations in worker processes " +
+                      "or in threads of one process [default %default]")
+    parser.add_option("--site-jobs",action="store",type="int",default=1,
+                      help="Number of titratable sites (single-site) or " +
+                      "uhbd runs (full) to run concurrently within each " +
+                      "calculation [default %default]")
+    parser.add_option("--site-batch",action="store",type="int",default=1,
+                      help="Number of sites solved per uhbd session in " +
+                      "single-site calculations; the last site of the " +
+                      "first batch is also run on its own and must give " +
+                      "the same potentials [default %default]")
+    parser.add_option("--check-sites",action="store_true",default=False,
+                      help="Also run the stopnow loop in a copy of each " +
+                      "calculation and stop if its potentials differ from " +
+                      "those of --site-jobs/--site-batch; with " +
+                      "--python-getpots, check every site against the " +
+                      "getpots binary [default %default]")
+    parser.add_option("-M","--share-maps",action="store_true",default=False,
+                      help="Build the coarse dielectric maps once per " +
+                      "structure and share them between titration points " +
+                      "(single-site only) [default %default]")
+    parser.add_option("--timeout",action="append",type="string",nargs=2,
+                      metavar="STAGE MINUTES",
+                      help="Limit STAGE (uhbdini, getgrids, sites or " +
+                      "hybrid) to MINUTES, killing any binary still running " +
+                      "when the time is up.  May be given once per stage " +
+                      "[default no limit]")
+    parser.add_option("--stall",action="store",type="float",default=120.,
+                      metavar="MINUTES",
+                      help="Stop a calculation if its stopnow loop writes no " +
+                      "new potentials for MINUTES (0 to disable) " +
+                      "[default %default]")
+    parser.add_option("-S","--scratch",action="store",type="string",
+                      metavar="DIR",
+                      help="Run each calculation in a temporary directory " +
+                      "under DIR (i.e. /dev/shm or $TMPDIR), copying only " +
+                      "the output files back [default run in the output " +
+                      "directory]")
+    parser.add_option("--preflight",action="store_true",default=False,
+                      help="Check every pdb file (parameters, his/cys " +
+                      "files, grid) before starting any calculations and " +
+                      "stop if any fail [default %default]")
+    parser.add_option("--python-getpots",action="store_true",default=False,
+                      help="Extract site potentials in python rather than " +
+                      "with the getpots binary; the first site of each " +
+                      "calculation is also run through getpots and must " +
+                      "give the same potentials (single-site only, " +
+                      "requires numpy) [default %default]")
+    parser.add_option("--python-hybrid",action="store_true",default=False,
+                      help="Titrate the sites in python rather than with " +
+                      "the hybrids binary (single-site only, requires " +
+                      "numpy) [default %default]")
+    parser.add_option("--monte-carlo",action="store",type="int",nargs=2,
+                      metavar="SWEEPS CHAINS",
+                      help="Titrate the sites by Metropolis Monte Carlo, " +
+                      "running CHAINS chains of SWEEPS sweeps in parallel " +
+                      "processes (single-site only, requires numpy) " +
+                      "[default use hybrids]")
+    parser.add_option("--sparse-cutoff",action="store",type="float",
+                      metavar="ANGSTROMS",
+                      help="Also store the site-site potentials sparsely " +
+                      "(pkaS-potentials.npz), dropping pairs of sites more " +
+                      "than ANGSTROMS apart; --python-hybrid and " +
+                      "--monte-carlo titrate the sparse potentials " +
+                      "(single-site only, requires numpy) [default off]")
+    parser.add_option("-I","--incremental",action="store_true",
+                      default=False,
+                      help="Reuse existing output directories, rerunning " +
+                      "only the stages whose inputs changed " +
+                      "[default %default]")
+    parser.add_option("-c","--cache",action="store_true",default=False,
+                      help="Reuse the outputs of identical calculation " +
+                      "stages from the stage cache [default %default]")
+    parser.add_option("--cache-dir",action="store",type="string",
+                      default=StageCache.DEFAULT_CACHE_DIR,
+                      help="Stage cache directory [default %default]")
+    parser.add_option("--cache-size",action="store",type="float",
+                      default=5000.,
+                      help="Maximum size of the stage cache in MB " +
+                      "[default %default]")
+
     # Calculation options (value typed on command line)
     parser.add_option("-T","--temperature",action="store",type="float",
                       default=298.0,
@@ -112,6 +218,11 @@ def main():
     parser.add_option("-g","--grid",action="store",type="file",
                       help="File containing list grids to use " +
                       "[default automatic]")
+    parser.add_option("--plan-grid",action="store",type="float",
+                      metavar="SPACING",
+                      help="Plan the grid levels for each structure from its " +
+                      "size and sites, with a finest spacing of SPACING " +
+                      "(A), at the lowest estimated cost [default automatic]")
     parser.add_option("-o","--override",action="store",type="file",
                       help="Use user-specified doinp file [default None]")
 
@@ -150,6 +261,75 @@ def main():
 
     # ---------- Check for incompatible options --------------------
 
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1!")
+    if options.site_jobs < 1:
+        parser.error("--site-jobs must be at least 1!")
+    if options.site_batch < 1:
+        parser.error("--site-batch must be at least 1!")
+    if options.site_batch > 1 and options.full:
+        parser.error("--site-batch is for single-site calculations!")
+    if options.check_sites and options.site_jobs < 2 and \
+       options.site_batch < 2 and not options.python_getpots:
+        parser.error("--check-sites needs --site-jobs, --site-batch or " +
+                     "--python-getpots!")
+
+    if options.python_getpots:
+        if options.full:
+            parser.error("--python-getpots is for single-site calculations!")
+        if UhbdPotentials.numpy == None:
+            parser.error("--python-getpots requires numpy!")
+
+    if options.python_hybrid:
+        if options.full:
+            parser.error("--python-hybrid is for single-site calculations!")
+        if UhbdHybrid.numpy == None:
+            parser.error("--python-hybrid requires numpy!")
+    if options.monte_carlo != None:
+        if options.full:
+            parser.error("--monte-carlo is for single-site calculations!")
+        if options.python_hybrid:
+            parser.error("--monte-carlo and --python-hybrid are exclusive!")
+        if UhbdMonteCarlo.numpy == None:
+            parser.error("--monte-carlo requires numpy!")
+        if options.monte_carlo[0] < UhbdMonteCarlo.MIN_SWEEPS:
+            parser.error("--monte-carlo needs at least %i sweeps!" % \
+                         UhbdMonteCarlo.MIN_SWEEPS)
+        if options.monte_carlo[1] < 1:
+            parser.error("--monte-carlo needs at least 1 chain!")
+    if options.sparse_cutoff != None:
+        if options.full:
+            parser.error("--sparse-cutoff is for single-site calculations!")
+        if UhbdPotentials.numpy == None:
+            parser.error("--sparse-cutoff requires numpy!")
+        if options.sparse_cutoff <= 0:
+            parser.error("--sparse-cutoff must be positive!")
+    if options.scratch != None and not os.path.isdir(options.scratch):
+        parser.error("--scratch %s is not a directory!" % options.scratch)
+    if options.stall < 0:
+        parser.error("--stall cannot be negative!")
+
+    # Convert --timeout into a dictionary of limits (seconds) keyed to stage
+    timeout = {}
+    if options.timeout != None:
+        for stage, minutes in options.timeout:
+            if stage not in UhbdStages.STAGES[1:]:
+                err = "--timeout stage must be one of %s!" % \
+                      ", ".join(UhbdStages.STAGES[1:])
+                parser.error(err)
+            try:
+                timeout[stage] = 60*float(minutes)
+            except ValueError:
+                parser.error("--timeout %s is not a number!" % minutes)
+            if timeout[stage] <= 0:
+                parser.error("--timeout must be positive!")
+
+    if options.plan_grid != None:
+        if options.grid != None:
+            parser.error("--plan-grid and --grid cannot be used together!")
+        if round(options.plan_grid,2) <= 0:
+            parser.error("--plan-grid spacing must be at least 0.01 A!")
+
     # Verify that the user specifies a proper parameter file if they are doing
     # full calculations.
     if options.full and parser.defaults['param_file'] == options.param_file:
@@ -159,6 +339,15 @@ def main():
             err += "Specify a different parameter file using --param_file."
             parser.error(err)
 
+    # Compile the full parameter file once, before any jobs start, so every job
+    # (and every worker process) loads the compiled copy.
+    if options.full and not options.override:
+        try:
+            UhbdParameters.loadParameters(options.param_file,
+                                          UhbdParameters.cacheDir(options))
+        except (IOError, Error.UhbdError), value:
+            parser.error(str(value))
+
     # Make sure that override is not placed with incompatible options
     if options.override != None:
         option_keys = options.__dict__.keys()
@@ -179,6 +368,7 @@ def main():
 
     # load optparse options into parameters class
     calc_param = ArgParser.Parameters(options)
+    calc_param.timeout = timeout
 
     # Define some globalsettings depending on full/single calculation
     calc_param.__dict__.update([("inp_name",""),("keep_files",[]),
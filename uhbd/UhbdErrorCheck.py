@@ -5,6 +5,32 @@ A set of functions to check for errors in uhbd output.
 """
 
 
+# Number of output lines reported with a fatal error
+TAIL_LINES = 5
+
+def isFatal(line):
+    """
+    Return True if line of uhbd output reports a fatal error.
+    """
+
+    return line[1:6] == "FATAL"
+
+
+def fatalMessage(tail,filename):
+    """
+    Create the error message for a fatal error in filename, given the last few
+    lines of output (tail).
+    """
+
+    err = ["%s\n" % (80*"-")]
+    err.append("Fatal Error in %s:\n" % filename)
+    err.extend(["%s\n" % (80*"-")])
+    err.append("tail -%i %s\n\n" % (len(tail),filename))
+    err.extend(["%s\n" % l.rstrip("\n") for l in tail])
+
+    return "".join(err)
+
+
 def checkOut(out,filename):
     """
     Check for errors in uhbdaa and uhbdpr.out.
@@ -13,20 +39,11 @@ def checkOut(out,filename):
     lines = out.split("\n")
 
     # Check for fatal errors
-    hash = [l[1:6] for l in lines]
-    try:
-        err_index = hash.index("FATAL")
-    
-        err = ["%s\n" % (80*"-")]
-        err.append("Fatal Error in %s:\n" % filename)
-        err.extend(["%s\n" % (80*"-")])
-        err.append("tail -5 %s\n\n" % filename)
-        err.extend(["%s\n" % l for l in lines[-5:]])
-        
-        return 1, "".join(err)
-    
-    except ValueError:
-        return 0, ""
+    fatal = [l for l in lines if isFatal(l)]
+    if len(fatal) > 0:
+        return 1, fatalMessage(lines[-TAIL_LINES:],filename)
+
+    return 0, ""
 
 
 
@@ -15,148 +15,18 @@ GROUP_CHARGES = {"HISA": 1,"HISB": 1,"LYS" : 1,"ARG" : 1,"ASP" :-1,
                  "TERC":-1}
 
 import os
+import UhbdParameters
+from common import Error, Structure
 
-class AminoAcidParameters:
+def readParamFile(param_file,cache_dir=None):
     """
-    Class that stores and processes parameters from a uhbd full parameter file.
+    Return a dictionary keying each amino acid in a UHBD "full" parameter file
+    to the atoms that are different between its charged and neutral forms (as
+    read by prepareFull).  The file is compiled by UhbdParameters (and stored
+    in cache_dir, if given).
     """
 
-    def __init__(self,entry,charge_state):
-        """
-        Initialize instance of AminoAcidParameters, taking an entry and the
-        charge state of that entry as an argument.
-        """
-
-        # Create list of atoms and initialize parameter dictionary
-        self.atom_list = [l.split()[1] for l in entry]
-        self.param = {"charged":{},"neutral":{}}
-
-        # Parse the first entry
-        self.parseEntry(entry,charge_state)
-
-    def parseEntry(self,entry,charge_state):
-        """
-        Parses a uhbd parameter file entry by amino acid.
-        """
-
-        for line in entry:
-            columns = line.split()
-            atom = columns[1]
-            data = [float(d) for d in columns[2:5]]
-            self.param[charge_state][atom] = data
-
-    def findDifferences(self,residue_name):
-        """
-        Go through every atom in self.atom_list and determine if there are *any*
-        differences in parameters.  A list of different atoms will then be
-        returned.
-        """
-        self.different = []
-        for atom in self.atom_list:
-            if self.param['charged'][atom] != self.param['neutral'][atom]:
-                self.different.append(atom)
-
-        return self.different
-
-
-def readParamFile(param_file):
-    """
-    Read a UHBD "full" parameter file and place individual amino acid data in
-    AminoAcidParameters instances.  Use this class to determine which atoms are
-    different between the charged and netural forms of each amino acid.  This is
-    returned as a dictionary that can be read by prepareFull.
-    """
-
-    print "Reading parameter file %s" % param_file
-
-    # Possible records in parameter file.  If there are any other records, they
-    # will be subsumed into another record, probably causing an error.
-    allowed_records = ["equi","neut","char"]
-
-    # Read in file
-    f = open(param_file)
-    param = f.readlines()
-    f.close()
-
-    # strip comments and white space
-    param = [l for l in param if l[0] != "!" and l.strip() != ""]
-
-    record_table = []
-    for index, line in enumerate(param):
-        if line[0:4].lower() in allowed_records:
-            record_table.append(index)
-
-            # Record the location of neutral and charged entries in table of
-            # records.
-            if line[0:4].lower() == "neut":
-                neutral = len(record_table) - 1
-            elif line[0:4].lower() == "char":
-                charged = len(record_table) - 1
-
-    # Put on dummy last record to avoid IndexError
-    record_table.append(-1)
-
-    # Pull out data in neutral and charged database entries
-    neutral_record = param[record_table[neutral]:record_table[neutral+1]]
-    charged_record = param[record_table[charged]:record_table[charged+1]]
-
-    # Strip out header
-    neutral_record = neutral_record[2:]
-    charged_record = charged_record[2:]
-
-    # Dictionary that will hold instance of AminoAcidParameters keyed to
-    # residue name.
-    all_fields = {}
-
-    # Go through netural record and find fields.  Create instance of
-    # AminoAcidParameters class for each amino acid field.
-    current_residue_field = []
-    current_residue = neutral_record[0].split()[0]
-    for line in neutral_record:
-        if current_residue != line.split()[0]:
-            all_fields.update([(current_residue,
-                AminoAcidParameters(current_residue_field,"neutral"))])
-            current_residue = line.split()[0]
-            current_residue_field = [line]
-        else:
-            current_residue_field.append(line)
-
-    # Go through charged record and find fields.  Update each instance of
-    # AminoAcidParameters with charged information.
-    current_residue_field = []
-    current_residue = charged_record[0].split()[0]
-    for line in charged_record:
-        if current_residue != line.split()[0]:
-            try:
-                all_fields[current_residue].parseEntry(current_residue_field,
-                                                       "charged")
-            except KeyError:
-                # If there was no neutral entry, there is no instance of
-                # AminoAcidParameters, hence an error.
-                err = "   %s has a charged entry " % current_residue
-                err += "but no neutral entry!  Skipping..."
-                print err
-            current_residue = line.split()[0]
-            current_residue_field = [line]
-        else:
-            current_residue_field.append(line)
-
-    # Remove entries for which there is no charged data
-    no_charged = [k for k in all_fields.keys()
-                  if all_fields[k].param['charged'] == {}]
-    err = ["   %s has neutral entry but no charged entry!  Skipping...\n" % x
-           for x in no_charged]
-    print "".join(err)
-
-    all_fields = dict([(k,all_fields[k]) for k in all_fields.keys()
-                       if  all_fields[k].param['charged'] != {}])
-
-    # Create a dictionary keying amino acid to atoms that are different between
-    # netural and charged forms of the amino acid.
-    group_param = dict([(k,all_fields[k].findDifferences(k))
-                        for k in all_fields.keys()])
-
-    return group_param
+    return UhbdParameters.loadParameters(param_file,cache_dir).differences
 
 
 def writeOutput(output_file,data_list):
@@ -169,75 +39,67 @@ def writeOutput(output_file,data_list):
     g.close()
 
 
-def prepareFull(pdb_file,group_param):
+def prepareFull(pdb_file,group_param,job_dir,structure=None):
     """
     A python implementation of UHBD fortran "prepare.f"  It does not direclty
-    write out uhbdini.inp.  See the makeUhbdini function for that.
+    write out uhbdini.inp.  See the makeUhbdini function for that.  Works from
+    structure (the Structure written to proteinH.pdb); if it is not given,
+    proteinH.pdb is read.  Writes files in job_dir.
     """
 
-    # Open pdb file and read it
-    f = open("proteinH.pdb","r")
-    pdb = f.readlines()
-    f.close()
+    if structure == None:
+        structure = Structure.readStructure(os.path.join(job_dir,
+                                                         "proteinH.pdb"))
 
     # Pull only titratable atoms from the pdb
-    titr_atoms = [l for l in pdb if l[0:4] == "ATOM"
-                  and l[17:21].strip() in GROUP_PKAS.keys()]
+    titr_atoms = [i for i in range(len(structure))
+                  if structure.resname[i].strip() in GROUP_PKAS]
+    if len(titr_atoms) == 0:
+        err = "No titratable groups in %s!" % job_dir
+        raise Error.UhbdError(err)
+
+    # Group the titratable atoms into residues (runs of residue number)
+    lines = structure.lines
+    runs = Structure.groupRuns([lines[i][23:26].strip() for i in titr_atoms])
 
     # Initialize lists to hold output files
-    all_groups = [pdb[0]]
-    all_residues = [pdb[0]]
+    all_groups = [structure.header]
+    all_residues = [structure.header]
     for_pot, sites_dat = [], []
 
-    # Initialize residue names/number and counter for going through pdb file
-    current_name = titr_atoms[0][17:21].strip()
-    current_numb = titr_atoms[0][23:26].strip()
-    counter = 1
-    for atom in titr_atoms:
-
-        # If we are on a new residue, update output files.  Reset counters.
-        if atom[23:26].strip() != current_numb:
-
-            # Update output files
-            for_pot.append("%4.1F%6i%13.6E%6i\n" % (GROUP_PKAS[current_name],
-                                                    GROUP_CHARGES[current_name],
-                                                    0.,counter))
-            sites_dat.append("%4i %-4s %4i\n" % (counter,current_name,
-                                               int(current_numb)))
-            all_residues.append("%-76s\n" % ("NEXT"))
-            all_groups.append("%-76s\n" % ("NEXT"))
-
-            # Update counters
-            current_name = atom[17:21].strip()
-            current_numb = atom[23:26].strip()
-            counter += 1
-
-        # Update all_residues and all_groups
-        all_residues.append(atom)
-        if atom[12:15].strip() in group_param[current_name]:
-            all_groups.append(atom)
+    for counter, (current_numb, index) in enumerate(runs):
+        atoms = [titr_atoms[i] for i in index]
+        current_name = structure.resname[atoms[0]].strip()
+        group = group_param[current_name]
+
+        for_pot.append("%4.1F%6i%13.6E%6i\n" % (GROUP_PKAS[current_name],
+                                                GROUP_CHARGES[current_name],
+                                                0.,counter + 1))
+        sites_dat.append("%4i %-4s %4i\n" % (counter + 1,current_name,
+                                            int(current_numb)))
+        all_residues.extend([lines[i] for i in atoms])
+        all_groups.extend([lines[i] for i in atoms
+                           if structure.name[i][:3].strip() in group])
+        all_residues.append("%-76s\n" % ("NEXT"))
+        all_groups.append("%-76s\n" % ("NEXT"))
+    counter = len(runs)
 
     # Close out output files
-    for_pot.append("%4.1F%6i%13.6E%6i\n" % (GROUP_PKAS[current_name],
-                                            GROUP_CHARGES[current_name],
-                                            0.,counter))
-    sites_dat.append("%4i %-4s %4i\n" % (counter,current_name,
-                                       int(current_numb)))
-    all_residues.append("%-76s\nEND\n" % ("NEXT"))
-    all_groups.append("%-76s\nEND\n" % ("NEXT"))
+    all_residues.append("END\n")
+    all_groups.append("END\n")
 
     # Write out files exactly like old fortran did
-    writeOutput("allgroups.pdb",all_groups)
-    writeOutput("allresidues.pdb",all_residues)
-    writeOutput("allresidues.pdb.orig",all_residues)
-    writeOutput("for_pot.dat",for_pot)
-    writeOutput("sites.dat",sites_dat)
-    writeOutput("potentials",["%i\n" % counter])
+    writeOutput(os.path.join(job_dir,"allgroups.pdb"),all_groups)
+    writeOutput(os.path.join(job_dir,"allresidues.pdb"),all_residues)
+    writeOutput(os.path.join(job_dir,"allresidues.pdb.orig"),all_residues)
+    writeOutput(os.path.join(job_dir,"for_pot.dat"),for_pot)
+    writeOutput(os.path.join(job_dir,"sites.dat"),sites_dat)
+    writeOutput(os.path.join(job_dir,"potentials"),["%i\n" % counter])
 
 
-def makeUhbdini(calc_param):
+def makeUhbdini(calc_param,job_dir):
     """
-    Write out uhbdini.inp.
+    Write out uhbdini.inp in job_dir.
     """
 
     short_param_file = os.path.split(calc_param.param_file)[-1]
@@ -256,13 +118,14 @@ def makeUhbdini(calc_param):
     " pdie   %.2F\n" % calc_param.protein_dielec,
     "end\n\nstop\n"]
 
-    writeOutput("uhbdini.inp",uhbdini)
+    writeOutput(os.path.join(job_dir,"uhbdini.inp"),uhbdini)
 
-def runPrepare(calc_param):
+def runPrepare(calc_param,job_dir):
 
-    group_param = readParamFile(calc_param.param_file)
-    prepareFull(calc_param.pdb_file,group_param)
-    makeUhbdini(calc_param)
+    group_param = readParamFile(calc_param.param_file,
+                                UhbdParameters.cacheDir(calc_param))
+    prepareFull(calc_param.pdb_file,group_param,job_dir,calc_param.structure)
+    makeUhbdini(calc_param,job_dir)
 
 
 
@@ -0,0 +1,59 @@
+"""
+UhbdGridFunctions.py
+
+Functions that check and summarize the finite difference grids of a
+calculation, given as a grid specification (a list of [spacing, dime_x,
+dime_y, dime_z], coarsest first, as in calc_param.grid).
+"""
+
+__author__ = "Michael J. Harms"
+
+from common import Error
+
+# The doinp format allows at most 5 grids
+MAX_GRIDS = 5
+
+
+def checkGrid(grid):
+    """
+    Make sure a grid specification is usable: 1 to MAX_GRIDS levels, each with
+    a positive spacing and positive integer dimensions, and every focused
+    level finer than the one before it.  Raises Error.UhbdError otherwise.
+    """
+
+    if len(grid) < 1 or len(grid) > MAX_GRIDS:
+        err = "Between 1 and %i grids must be given (not %i)!" % \
+              (MAX_GRIDS,len(grid))
+        raise Error.UhbdError(err)
+
+    for i, g in enumerate(grid):
+        if len(g) != 4:
+            err = "Grid %i must be spacing and three dimensions!" % (i+1)
+            raise Error.UhbdError(err)
+        if g[0] <= 0:
+            err = "Grid %i has a spacing of %s!" % (i+1,g[0])
+            raise Error.UhbdError(err)
+        if min(g[1:]) < 1 or [int(d) for d in g[1:]] != list(g[1:]):
+            err = "Grid %i dimensions must be positive integers!" % (i+1)
+            raise Error.UhbdError(err)
+        if i > 0 and g[0] >= grid[i-1][0]:
+            err = "Grid %i (%s A) is not finer than grid %i (%s A)!" % \
+                  (i+1,g[0],i,grid[i-1][0])
+            raise Error.UhbdError(err)
+
+
+def gridSummary(grid):
+    """
+    Return a description of each grid level: spacing, dimensions and edge
+    lengths in Angstroms.
+    """
+
+    level_format = "   grid %i: %.2F A, %i x %i x %i (%.1F x %.1F x %.1F A)\n"
+
+    out = []
+    for i, g in enumerate(grid):
+        edges = tuple([g[0]*(d - 1) for d in g[1:]])
+        out.append(level_format % ((i+1,) + tuple(g) + edges))
+
+    return "".join(out)
+
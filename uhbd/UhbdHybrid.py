@@ -0,0 +1,370 @@
+"""
+UhbdHybrid.py
+
+NumPy hybrid titration, an alternative to the UHBD "hybrids" binary: sites
+are titrated in the mean-field approximation, except for clusters of strongly
+coupled sites, whose protonation states are summed over exactly (in the mean
+field of the remaining sites).  All pH values are evaluated at once.  Reads
+single-site potentials files (see UhbdPotentials) and writes hybrid.out
+(REPORT_FILE) in the layout tools that read the hybrids hybrid.out expect
+(i.e. previous_releases/0.4.1/plotUhbd.py): two header lines, one line per pH
+(pH, Z, Z(model), dG(ion), dG(elec)), one blank line, then SITE_HEADER and
+one line per site.
+
+Many potentials files can be titrated in one process:
+    python -m uhbd.UhbdHybrid [options] potentials_file(s)
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys
+import UhbdPotentials
+from common import Error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Gas constant (kcal/mol/K)
+R = 1.987e-3
+
+# Sites coupled more strongly than CLUSTER_CUTOFF (in pK units) are treated
+# exactly; clusters are kept to at most MAX_CLUSTER sites (2**MAX_CLUSTER
+# states).
+CLUSTER_CUTOFF = 1.0
+MAX_CLUSTER = 12
+
+# Report written by the python titration engines, as by hybrids.  Readers of
+# hybrid.out find the site table by its exact header line.
+REPORT_FILE = "hybrid.out"
+
+SITE_HEADER = "atom  type  resid  Group  pk(model)  pK(app)  DpK(app)  z  " + \
+              "Gself  Gborn  Gback\n"
+
+
+def phValues(ph_param):
+    """
+    Return the pH values (start, end, step) as an array, including end.
+    """
+
+    start, end, step = ph_param
+    if step <= 0:
+        raise Error.UhbdError("pH step must be positive!")
+
+    return numpy.arange(start,end + step/2.,step)
+
+
+def intrinsicPKa(potentials,temperature):
+    """
+    Return the intrinsic pKa of every site: the model pKa shifted by the
+    energy (Gborn + Gback) of charging the site in the protein rather than in
+    the model compound.  Charging a base (z = +1) protonates it, charging an
+    acid (z = -1) deprotonates it.
+    """
+
+    g_charge = potentials.g_born + potentials.g_back
+    return potentials.pk_model - potentials.charge*g_charge/ \
+           (numpy.log(10)*R*temperature)
+
+
+def interactionMatrix(potentials):
+    """
+    Return the matrix of interaction energies (kcal/mol) between the charged
+    states of every pair of sites.  The potentials of i at j and j at i are
+    averaged; a site does not interact with itself.  If potentials holds a
+    SparseMatrix, so is the result.
+    """
+
+    z = potentials.charge.astype(float)
+    if isinstance(potentials.w,UhbdPotentials.SparseMatrix):
+        r = potentials.w.rows()
+        c = potentials.w.indices
+        rows = numpy.concatenate((r,c))
+        cols = numpy.concatenate((c,r))
+        values = 0.5*numpy.concatenate((potentials.w.data,potentials.w.data))
+        keep = rows != cols
+        return UhbdPotentials.fromTriplets(rows[keep],cols[keep],
+                                           values[keep]*z[rows[keep]]*
+                                           z[cols[keep]],len(z))
+
+    w = 0.5*(potentials.w + potentials.w.T)*numpy.outer(z,z)
+    w[numpy.diag_indices(len(z))] = 0.
+
+    return w
+
+
+def findClusters(w,cutoff,max_size=MAX_CLUSTER,index=None):
+    """
+    Group sites connected by interactions larger than cutoff (kcal/mol) into
+    clusters.  A cluster larger than max_size is split by raising the cutoff
+    within it.  Returns a list of arrays of site indexes.
+    """
+
+    if index is None:
+        index = numpy.arange(len(w))
+
+    # Position of each site in index (-1 for sites not in index)
+    position = -numpy.ones(len(w),dtype=int)
+    position[index] = numpy.arange(len(index))
+
+    # Connected components of the strong-coupling graph
+    cluster_of = -numpy.ones(len(index),dtype=int)
+    clusters = []
+    for i in range(len(index)):
+        if cluster_of[i] != -1:
+            continue
+        cluster_of[i] = len(clusters)
+        members = [i]
+        stack = [i]
+        while len(stack) > 0:
+            j = stack.pop()
+            cols, values = UhbdPotentials.rowEntries(w,index[j])
+            neighbors = position[cols[abs(values) > cutoff]]
+            neighbors = neighbors[neighbors >= 0]
+            for k in neighbors[cluster_of[neighbors] == -1]:
+                cluster_of[k] = len(clusters)
+                members.append(k)
+                stack.append(k)
+        members.sort()
+        clusters.append(index[members])
+
+    out = []
+    for c in clusters:
+        if len(c) > max_size:
+            out.extend(findClusters(w,cutoff*1.5,max_size,c))
+        else:
+            out.append(c)
+
+    return out
+
+
+def clusterStates(size):
+    """
+    Return every charge state of a cluster of size sites as a 2**size x size
+    array of 0 (neutral) and 1 (charged).
+    """
+
+    states = numpy.arange(2**size)
+    return ((states[:,None] >> numpy.arange(size)) & 1).astype(float)
+
+
+def titrate(potentials,ph,temperature,cutoff=CLUSTER_CUTOFF,
+            max_cluster=MAX_CLUSTER,tolerance=1e-6,max_iterations=2000,
+            damping=0.5):
+    """
+    Calculate the fraction of every site in its charged state at every pH in
+    ph.  cutoff is in pK units.  Returns an array (pH x site) of charged
+    fractions.
+    """
+
+    kT = R*temperature
+    ln10 = numpy.log(10)
+    pk_int = intrinsicPKa(potentials,temperature)
+    z = potentials.charge.astype(float)
+    w = interactionMatrix(potentials)
+
+    # Free energy of charging each (isolated) site at each pH
+    g = z*ln10*kT*(ph[:,None] - pk_int[None,:])
+
+    clusters = findClusters(w,cutoff*ln10*kT,max_cluster)
+    exact = [c for c in clusters if len(c) > 1]
+    single = numpy.array([c[0] for c in clusters if len(c) == 1],dtype=int)
+    exact_states = []
+    for c in exact:
+        s = clusterStates(len(c))
+        wc = UhbdPotentials.subMatrix(w,c)
+        pair = 0.5*numpy.sum(numpy.dot(s,wc)*s,1)
+        exact_states.append((c,s,wc,pair))
+
+    theta = 1./(1. + numpy.exp(numpy.clip(g/kT,-500,500)))
+    for iteration in range(max_iterations):
+
+        new_theta = theta.copy()
+        field = UhbdPotentials.matrixDot(theta,w)
+        if len(single) > 0:
+            e = (g[:,single] + field[:,single])/kT
+            new_theta[:,single] = 1./(1. + numpy.exp(numpy.clip(e,-500,500)))
+
+        for c, s, wc, pair in exact_states:
+
+            # Field from outside the cluster only
+            inside = numpy.dot(theta[:,c],wc)
+            h = g[:,c] + field[:,c] - inside
+            e = (numpy.dot(h,s.T) + pair[None,:])/kT
+            e -= e.min(1)[:,None]
+            p = numpy.exp(-e)
+            p /= p.sum(1)[:,None]
+            new_theta[:,c] = numpy.dot(p,s)
+
+        change = abs(new_theta - theta).max()
+        theta = damping*theta + (1 - damping)*new_theta
+        if change < tolerance:
+            break
+    else:
+        err = "Hybrid titration did not converge in %i iterations!" % \
+              max_iterations
+        raise Error.UhbdError(err)
+
+    return theta
+
+
+def protonated(potentials,theta):
+    """
+    Convert charged fractions into protonated fractions.
+    """
+
+    base = potentials.charge > 0
+    return numpy.where(base[None,:],theta,1. - theta)
+
+
+def pKApp(ph,fraction):
+    """
+    Return the pH at which each site is half protonated (linear interpolation
+    on the pH grid).  Sites that do not cross 0.5 within the grid get the
+    nearest end of the grid.
+    """
+
+    out = numpy.zeros(fraction.shape[1])
+    for i in range(fraction.shape[1]):
+        f = fraction[:,i]
+        above = f >= 0.5
+        if above.all():
+            out[i] = ph[-1]
+        elif not above.any():
+            out[i] = ph[0]
+        else:
+            j = numpy.nonzero(above[:-1] != above[1:])[0][0]
+            out[i] = ph[j] + (0.5 - f[j])*(ph[j+1] - ph[j])/(f[j+1] - f[j])
+
+    return out
+
+
+def hybridReport(potentials,ph,theta,temperature,errors=None):
+    """
+    Create the report of a titration (REPORT_FILE): net charge, model
+    compound charge, free energy of ionization relative to the model
+    compounds and the electrostatic energy at every pH, then pK(app) for
+    every site.  errors, if given, is a tuple of the standard errors of Z
+    (per pH) and of pK(app) (per site); they are added as a last column of
+    the pH and site lines (SITE_HEADER itself is left as it is, so readers of
+    hybrid.out still find the site table).  Returns a list of lines.
+    """
+
+    kT = R*temperature
+    z = potentials.charge.astype(float)
+    w = interactionMatrix(potentials)
+
+    theta_model = 1./(1. + numpy.exp(numpy.clip(z*numpy.log(10)*
+                                      (ph[:,None] - potentials.pk_model),
+                                      -500,500)))
+    charge = numpy.dot(theta,z)
+    charge_model = numpy.dot(theta_model,z)
+
+    # Linkage: dG(ion) = 2.303 RT * integral of (Z - Z(model)) d(pH)
+    dq = charge - charge_model
+    dg_ion = numpy.zeros(len(ph))
+    dg_ion[1:] = numpy.cumsum(0.5*(dq[1:] + dq[:-1])*numpy.diff(ph))
+    dg_ion *= numpy.log(10)*kT
+    dg_elec = numpy.dot(theta,potentials.g_born + potentials.g_back) + \
+              0.5*numpy.sum(UhbdPotentials.matrixDot(theta,w)*theta,1)
+
+    title = "Hybrid titration: %i sites, T = %.2F K" % (len(potentials),
+                                                       temperature)
+    header = "%8s%10s%10s%12s%12s" % ("pH","Z","Z(model)","dG(ion)",
+                                      "dG(elec)")
+    if errors != None:
+        title += " (last column: standard error)"
+        header += "%10s" % "Z(err)"
+    out = [title + "\n",header + "\n"]
+    for i in range(len(ph)):
+        line = "%8.3F%10.4F%10.4F%12.4F%12.4F" % \
+               (ph[i],charge[i],charge_model[i],dg_ion[i],dg_elec[i])
+        if errors != None:
+            line += "%10.4F" % errors[0][i]
+        out.append(line + "\n")
+    out.append("\n")
+
+    pk_app = pKApp(ph,protonated(potentials,theta))
+    out.append(SITE_HEADER)
+    site_format = "%-5s %-5s %5i %5i %9.2F %8.2F %9.2F %2i %9.3F %9.3F %9.3F"
+    for i, site in enumerate(potentials.sites):
+        line = site_format % (site[2],site[0],site[1],i+1,
+                              potentials.pk_model[i],pk_app[i],
+                              pk_app[i] - potentials.pk_model[i],
+                              potentials.charge[i],potentials.g_self[i],
+                              potentials.g_born[i],potentials.g_back[i])
+        if errors != None:
+            line += " %8.2F" % errors[1][i]
+        out.append(line + "\n")
+
+    return out
+
+
+def runHybrid(potential_file,ph_param,temperature,output_file,
+              potentials=None):
+    """
+    Titrate the sites in potential_file (a potentials or sparse .npz file, or
+    the Potentials instance potentials, if given) over ph_param and write the
+    report to output_file.
+    """
+
+    if potentials == None:
+        potentials = UhbdPotentials.loadPotentials(potential_file)
+
+    ph = phValues(ph_param)
+    theta = titrate(potentials,ph,temperature)
+
+    g = open(output_file,"w")
+    g.writelines(hybridReport(potentials,ph,theta,temperature))
+    g.close()
+
+
+def titrateFiles(file_list,ph_param,temperature,output_name=REPORT_FILE):
+    """
+    Run the hybrid titration on every potentials file in file_list, writing
+    output_name next to each.  Returns a list of (file, error message) for
+    the files that failed.
+    """
+
+    failed = []
+    for potential_file in file_list:
+        output_file = os.path.join(os.path.split(potential_file)[0],
+                                   output_name)
+        try:
+            runHybrid(potential_file,ph_param,temperature,output_file)
+        except (Error.UhbdError, IOError, ValueError), value:
+            failed.append((potential_file,str(value)))
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = "python -m uhbd.UhbdHybrid [options] potentials_file(s)"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-q","--ph-param",action="store",type="float",nargs=3,
+                      default=(-5.0,20.0,0.25),
+                      help="pH titration parameters (3 values) " +
+                      "[default %default]")
+    parser.add_option("-T","--temperature",action="store",type="float",
+                      default=298.0,
+                      help="Temperature of calculation [default %default]")
+    parser.add_option("-o","--output",action="store",type="string",
+                      default=REPORT_FILE,
+                      help="Name of output file written next to each " +
+                      "potentials file [default %default]")
+    options, args = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error("no potentials files given")
+    if numpy == None:
+        parser.error("numpy is required")
+
+    failed = titrateFiles(args,options.ph_param,options.temperature,
+                          options.output)
+    print "Titrated %i of %i files." % (len(args) - len(failed),len(args))
+    for f, err in failed:
+        print "   %s: %s" % (f,err)
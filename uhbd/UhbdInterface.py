@@ -9,8 +9,10 @@ __author__ = "Michael J. Harms"
 # ---------- Initialize module --------------------
 
 import __init__, UhbdFullFunctions, UhbdSingleFunctions, UhbdErrorCheck
-import os, shutil
-from common import SystemOps, Error
+import UhbdStages, UhbdPotentials, UhbdHybrid, UhbdMonteCarlo
+import os, sys, re, shutil, time, glob, hashlib, collections, errno, fcntl
+import tempfile, threading
+from common import SystemOps, Error, JobPool, StageCache, Execute
 
 # Set up uhbd binary
 global uhbd
@@ -19,83 +21,903 @@ uhbd = os.path.join(bin_path,'uhbd')
 if not os.path.isfile(uhbd):
     raise OSError("uhbd binary not found in $UHBD (%s)" % bin_path)
 
+# Files written by pkaS-uhbdini (coarse dielectric maps)
+MAP_FILES = ["pkaS-uhbdini.out","coarse.eps*"]
+
+# Quoted file names in uhbd input (i.e. read mol 2 file "site.pdb" pdb end)
+QUOTED_FILE = re.compile(r'"([^"/]+)"')
+
+# Files doinp leaves for the next site of the full loop and where they go
+FULL_LOOP_FILES = [("tempallG.pdb","allgroups.pdb"),
+                   ("tempallR.pdb","allresidues.pdb"),
+                   ("tmp_for_pot.dat","for_pot.dat")]
+
 # ---------- Function definitions --------------------
 
-def runUHBD(inputfile,outputfile):
+def stageTimeout(calc_param,stage):
     """
-    Runs UHBD from an inputfile, putting standard out to outputfile.
+    Return the wall-clock limit (seconds) for each binary run in stage, or None
+    if there is no limit.
+    """
+
+    return calc_param.timeout.get(stage)
+
+class StageDeadline:
+    """
+    Class that holds the wall-clock limit (--timeout) of a stage that runs many
+    binaries (the sites).  The limit covers the whole stage: each binary may
+    only run for the time left when it starts.
+    """
+
+    def __init__(self,calc_param,stage):
+        """
+        Initialize class.  The clock starts now.
+        """
+
+        self.stage = stage
+        self.limit = stageTimeout(calc_param,stage)
+        self.end = None
+        if self.limit != None:
+            self.end = time.time() + self.limit
+
+    def left(self):
+        """
+        Return the time (seconds) left in the stage, or None if there is no
+        limit.  Raises Error.UhbdError if none is left.
+        """
+
+        if self.end == None:
+            return None
+
+        left = self.end - time.time()
+        if left <= 0:
+            err = "%s stage exceeded its time limit (%g s)" % (self.stage,
+                                                               self.limit)
+            raise Error.UhbdError(err)
+
+        return left
+
+def runUHBD(inputfile,outputfile,job_dir,timeout=None):
+    """
+    Runs UHBD in job_dir from an inputfile, putting standard out to outputfile.
+    Output is written to outputfile as it is produced and checked line by line
+    for fatal errors; uhbd is killed as soon as one appears.
     """
 
     global uhbd
 
     print "uhbd < %s > %s" % (inputfile,outputfile)
 
-    f = open(inputfile,'r')
+    f = open(os.path.join(job_dir,inputfile),'r')
     inp = f.read()
     f.close()
 
+    tail = collections.deque(maxlen=UhbdErrorCheck.TAIL_LINES)
+    def checkLine(line):
+        tail.append(line)
+        return UhbdErrorCheck.isFatal(line)
+
     try:
-        cin, cout = os.popen2(uhbd)
-        cin.write(inp)
-        cin.close()
-        out = cout.read()
-        cout.close()
+        record = Execute.runBinary(uhbd,job_dir,stdin_data=inp,
+                                   stdout_file=outputfile,
+                                   stderr_file="%s.stderr" % outputfile,
+                                   timeout=timeout,check_line=checkLine,
+                                   stdout_mode="w")
     except IOError:
         err = "uhbd binary (%s) not executable" % uhbd
         raise IOError(err)
 
-    status = UhbdErrorCheck.checkOut(out,outputfile)
+    if record.aborted:
+        raise Error.UhbdError(UhbdErrorCheck.fatalMessage(list(tail),
+                                                          outputfile))
 
-    g = open(outputfile,'w')
-    g.write(out)
+def runHybrid(hybrid,ph_param,job_dir,timeout=None):
+    """
+    Run the hybrid titration binary in job_dir, feeding it the pH titration
+    parameters on standard in.  Its standard out is echoed to the job log as
+    well as captured.
+    """
+
+    def echo(line):
+        sys.stdout.write(line)
+        return False
+
+    Execute.runBinary(hybrid,job_dir,stdin_data="%s\n%s\n%s\n" % ph_param,
+                      timeout=timeout,check_line=echo)
+
+def mergePotentials(job_dir,site_dirs):
+    """
+    Append the potentials written by getpots (getpot) in each site directory to
+    job_dir/potentials, in site order.  Each site directory started with a
+    copy of job_dir/potentials, so only what getpots added is merged.
+    """
+
+    potential_file = os.path.join(job_dir,"potentials")
+    if os.path.isfile(potential_file):
+        f = open(potential_file,"r")
+        base = f.read()
+        f.close()
+    else:
+        base = ""
+
+    merged = [base]
+    for site_dir in site_dirs:
+        f = open(os.path.join(site_dir,"potentials"),"r")
+        site_potentials = f.read()
+        f.close()
+
+        if not site_potentials.startswith(base):
+            err = "potentials in %s do not start with " % site_dir
+            err += "the potentials in %s!" % job_dir
+            raise Error.UhbdError(err)
+        merged.append(site_potentials[len(base):])
+
+    g = open(potential_file,"w")
+    g.writelines(merged)
     g.close()
 
-    if status[0] == 1:
-        raise Error.UhbdError(status[1]) 
+def sparsePotentials(job_dir,cutoff):
+    """
+    Write the single-site potentials in job_dir as a sparse potentials file,
+    keeping only pairs of sites within cutoff Angstroms of each other (using
+    the coordinates in pkaS-sitesinpr.pdb).  pkaS-potentials is read one site
+    at a time.  Returns the sparse Potentials instance.
+    """
+
+    print 'sparse potentials (%.1F A cutoff)' % cutoff
+    potentials = UhbdPotentials.readPotentials(
+        os.path.join(job_dir,'pkaS-potentials'),
+        os.path.join(job_dir,'pkaS-sitesinpr.pdb'),cutoff)
+
+    UhbdPotentials.writeSparsePotentials(
+        os.path.join(job_dir,UhbdPotentials.SPARSE_FILE),potentials,cutoff)
+    num_pairs = len(potentials.w.data)
+    print '   kept %i of %i interactions' % (num_pairs,len(potentials)**2)
+
+    return potentials
+
+
+class PythonGetpots:
+    """
+    Class that stands in for the getpots binary with --python-getpots (called
+    as getpot(site_dir,timeout), like the binary).  UhbdPotentials.siteBlock
+    builds the block of each site from its uhbd output.  The uhbd output
+    markers and potentials layout it relies on are not taken from getpots
+    itself, so the first site of each calculation (every site with
+    --check-sites) is also given to the getpots binary, which must append
+    exactly the same bytes to potentials; otherwise the calculation stops.
+    """
 
-def runSingleCalculation(calc_param):
+    def __init__(self,getpot_bin,job_dir,check_all=False):
+        """
+        Initialize class.  The sites are read from job_dir/sitesinpr.pdb.
+        """
+
+        self.getpot_bin = getpot_bin
+        self.sites = UhbdPotentials.readSites(os.path.join(job_dir,
+                                                           "sitesinpr.pdb"))[0]
+        self.check_all = check_all
+        self.checked = False
+        self.lock = threading.Lock()
+
+    def __call__(self,site_dir,timeout=None):
+        """
+        Append the block of the site in site_dir to site_dir/potentials.
+        """
+
+        try:
+            index, block = UhbdPotentials.siteBlock(site_dir,self.sites)
+        except (IOError, ValueError, Error.UhbdError), value:
+            err = "python getpots failed in %s (%s); " % (site_dir,value)
+            err += "run without --python-getpots."
+            raise Error.UhbdError(err)
+
+        self.lock.acquire()
+        check = self.check_all or not self.checked
+        self.checked = True
+        self.lock.release()
+
+        if not check:
+            g = open(os.path.join(site_dir,"potentials"),"a")
+            g.writelines(block)
+            g.close()
+            return
+
+        potential_file = os.path.join(site_dir,"potentials")
+        before = ""
+        if os.path.isfile(potential_file):
+            before = readPotentialFile(site_dir)
+        SystemOps.runBin(self.getpot_bin,site_dir,timeout)
+        if readPotentialFile(site_dir) != before + "".join(block):
+            err = "python getpots block of site %i differs from the one " % \
+                  index
+            err += "the getpots binary wrote to %s; " % potential_file
+            err += "run without --python-getpots."
+            raise Error.UhbdError(err)
+        print "   python getpots identical to getpots for site %i" % index
+
+def runSingleSite(site_dir,getpot,deadline):
     """
-    Peform pH titration on filename.
+    Run the protein and model compound calculations for one site in site_dir,
+    then extract its potentials with getpot(site_dir,timeout) (the getpots
+    binary or a PythonGetpots).  Each binary is limited to the time left
+    before deadline (a StageDeadline).
+    """
+
+    runUHBD('uhbdpr.inp','uhbdpr.out',site_dir,deadline.left())
+    runUHBD('uhbdaa.inp','uhbdaa.out',site_dir,deadline.left())
+    getpot(site_dir,deadline.left())
+
+def fileStates(some_dir):
+    """
+    Return the size and modification time of every file in some_dir, keyed to
+    file name.
+    """
+
+    out = {}
+    for f in os.listdir(some_dir):
+        path = os.path.join(some_dir,f)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            out[f] = (stat.st_size,stat.st_mtime)
+
+    return out
+
+def copyLoopState(job_dir,copy_dir):
+    """
+    Copy the files in job_dir (as they are before the stopnow loop) into
+    copy_dir, leaving out the run log.
+    """
+
+    SystemOps.makeDir(copy_dir)
+    SystemOps.copyFiles(job_dir,copy_dir,[f for f in os.listdir(job_dir)
+                                          if f != Execute.RUN_LOG])
+
+def writeSiteInputs(doinp,job_dir,site_root,num_sites,deadline,advance=None):
+    """
+    Run doinp (the doinps or doinp binary) once for each of num_sites sites,
+    as the stopnow loop would, but without the uhbd and getpot(s) runs in
+    between.  doinp runs in site_root/doinp, a copy of job_dir.  After its
+    i-th call, every file it has written so far is copied into
+    site_root/siteNNNN (NNNN = i); the other files are linked from job_dir and
+    potentials is copied.  Each site directory then holds what the stopnow
+    loop would have given uhbd and getpot(s) for that site.  If given,
+    advance(doinp_dir) is called after the site is saved (the full loop moves
+    the files doinp leaves for the next site into place).  doinp is limited
+    to the time left before deadline (a StageDeadline).  Returns the list of
+    site directories in site order.
+    """
+
+    doinp_dir = os.path.join(site_root,"doinp")
+    copyLoopState(job_dir,doinp_dir)
+    start = fileStates(doinp_dir)
+    exclude = ["potentials","stopnow",Execute.RUN_LOG]
+
+    site_dirs = []
+    for i in range(num_sites):
+        if os.path.isfile(os.path.join(doinp_dir,"stopnow")):
+            err = "%s wrote stopnow after %i of %i sites!" % (doinp,i,
+                                                              num_sites)
+            raise Error.UhbdError(err)
+        SystemOps.runBin(doinp,doinp_dir,deadline.left())
+
+        site_dir = os.path.join(site_root,"site%04i" % (i+1))
+        SystemOps.makeDir(site_dir)
+        SystemOps.linkFiles(job_dir,site_dir,exclude)
+        if os.path.isfile(os.path.join(job_dir,"potentials")):
+            shutil.copy(os.path.join(job_dir,"potentials"),site_dir)
+
+        # Replace the links to anything doinp has changed with copies
+        written = [f for f, state in fileStates(doinp_dir).items()
+                   if f not in exclude and start.get(f) != state]
+        for f in written:
+            if os.path.lexists(os.path.join(site_dir,f)):
+                os.remove(os.path.join(site_dir,f))
+        SystemOps.copyFiles(doinp_dir,site_dir,written)
+        site_dirs.append(site_dir)
+
+        if advance != None:
+            advance(doinp_dir)
+
+    return site_dirs
+
+def readPotentialFile(some_dir):
+    """
+    Return the contents of some_dir/potentials.
+    """
+
+    f = open(os.path.join(some_dir,"potentials"),"rb")
+    contents = f.read()
+    f.close()
+
+    return contents
+
+def checkSiteLoop(calc_param,check_dir,job_dir,num_sites,iteration):
+    """
+    Run the stopnow loop (iteration(check_dir), see runStopnowLoop) in
+    check_dir, a copy of job_dir made before the sites were run concurrently,
+    and make sure that it wrote the same potentials as the concurrent sites
+    did in job_dir.  Raises Error.UhbdError if it did not.
+    """
+
+    print "Checking concurrent sites against the stopnow loop in %s" % \
+          check_dir
+    runStopnowLoop(calc_param,check_dir,num_sites,lambda: iteration(check_dir))
+    Execute.mergeRecords(job_dir,[check_dir])
+
+    if readPotentialFile(job_dir) != readPotentialFile(check_dir):
+        err = "potentials from the concurrent sites in %s differ " % job_dir
+        err += "from those of the stopnow loop in %s!" % check_dir
+        raise Error.UhbdError(err)
+
+    print "   potentials identical"
+
+def siteFiles(site_dir):
+    """
+    Return the files doinps wrote for the site in site_dir (the files that
+    are not links to the output directory), leaving out potentials.
+    """
+
+    return [f for f in os.listdir(site_dir)
+            if f not in ["potentials",Execute.RUN_LOG] and
+            not os.path.islink(os.path.join(site_dir,f))]
+
+def batchCommands(site_dir,input_file,prefix,files):
+    """
+    Return the commands of input_file in site_dir, ready to be run together
+    with those of other sites in one uhbd session: the quoted file names in
+    files (the files of this site) get prefix, and everything from the last
+    stop on is dropped.
+    """
+
+    f = open(os.path.join(site_dir,input_file),"r")
+    lines = f.readlines()
+    f.close()
+
+    stops = [i for i, l in enumerate(lines) if l.strip().lower() == "stop"]
+    if len(stops) > 0:
+        lines = lines[:stops[-1]]
+
+    def rename(match):
+        if match.group(1) in files:
+            return '"%s%s"' % (prefix,match.group(1))
+        return match.group(0)
+
+    return [QUOTED_FILE.sub(rename,l) for l in lines]
+
+def splitBatchOutput(batch_output,prefixes,site_dirs,output_name):
+    """
+    Split the output of a batched uhbd session (batch_output) into one record
+    per site, written to output_name in each of site_dirs.  The record of a
+    site starts at the first line that mentions one of its (prefixed) files,
+    as echoed by uhbd.  Anything before the first site (reading the protein
+    and parameters) is shared and copied to the top of every record.
+    """
+
+    f = open(batch_output,"r")
+    out = f.readlines()
+    f.close()
+
+    starts = []
+    search_from = 0
+    for prefix in prefixes:
+        for i in range(search_from,len(out)):
+            if prefix in out[i]:
+                starts.append(i)
+                search_from = i + 1
+                break
+        else:
+            err = "Could not find the files of %s in %s, so the output " % \
+                  (prefix[:-1],batch_output)
+            err += "cannot be split into sites; run without --site-batch."
+            raise Error.UhbdError(err)
+
+    starts.append(len(out))
+    shared = out[:starts[0]]
+    for i, site_dir in enumerate(site_dirs):
+        g = open(os.path.join(site_dir,output_name),"w")
+        g.writelines(shared + out[starts[i]:starts[i+1]])
+        g.close()
+
+def runSiteBatch(site_dirs,batch_dir,getpot,deadline):
+    """
+    Run the protein and model compound calculations of all sites in site_dirs
+    in one uhbd session each, from batch_dir.  The files doinps wrote for each
+    site are linked into batch_dir with the site directory name as prefix
+    (i.e. site0003-), so sites do not overwrite each other's files.  The
+    output is split back into uhbdpr.out and uhbdaa.out in each site
+    directory, any files uhbd wrote for a site are moved back into its
+    directory, and getpot(site_dir,timeout) runs in each site directory.
+    Every binary is limited to the time left before deadline (a
+    StageDeadline).
+    """
+
+    prefixes = ["%s-" % os.path.split(d)[-1] for d in site_dirs]
+    files = []
+    for site_dir, prefix in zip(site_dirs,prefixes):
+        files.append(siteFiles(site_dir))
+        for f in files[-1]:
+            SystemOps.linkFile(os.path.join(site_dir,f),
+                               os.path.join(batch_dir,prefix + f))
+
+    for name in ["uhbdpr","uhbdaa"]:
+        commands = []
+        for site_dir, prefix, site_files in zip(site_dirs,prefixes,files):
+            commands.extend(batchCommands(site_dir,"%s.inp" % name,prefix,
+                                          site_files))
+        commands.append("stop\n")
+
+        g = open(os.path.join(batch_dir,"%s.inp" % name),"w")
+        g.writelines(commands)
+        g.close()
+
+        runUHBD("%s.inp" % name,"%s.out" % name,batch_dir,deadline.left())
+        splitBatchOutput(os.path.join(batch_dir,"%s.out" % name),prefixes,
+                         site_dirs,"%s.out" % name)
+
+    for site_dir, prefix in zip(site_dirs,prefixes):
+        for f in os.listdir(batch_dir):
+            path = os.path.join(batch_dir,f)
+            if f.startswith(prefix) and not os.path.islink(path):
+                shutil.move(path,os.path.join(site_dir,f[len(prefix):]))
+
+    for site_dir in site_dirs:
+        getpot(site_dir,deadline.left())
+
+def runSiteBatches(calc_param,job_dir,site_root,site_dirs,getpot,deadline):
+    """
+    Run the sites in site_dirs in batches of calc_param.site_batch sites per
+    uhbd session (see runSiteBatch), calc_param.site_jobs batches at a time.
+    Nothing guarantees that a uhbd session gives the same results for a site
+    whatever ran before it, so the last site of the first batch is also run
+    on its own (in site_root/check) and must give byte-identical potentials.
+    Returns the directories binaries ran in.
+    """
+
+    calls = []
+    run_dirs = []
+    for i in range(0,len(site_dirs),calc_param.site_batch):
+        batch_dir = os.path.join(site_root,"batch%04i" % (len(calls) + 1))
+        SystemOps.makeDir(batch_dir)
+        SystemOps.linkFiles(job_dir,batch_dir,["potentials","stopnow",
+                                              Execute.RUN_LOG])
+        batch = site_dirs[i:i + calc_param.site_batch]
+        calls.append((runSiteBatch,(batch,batch_dir,getpot,deadline)))
+        run_dirs.append(batch_dir)
+
+    check_site = site_dirs[min(calc_param.site_batch,len(site_dirs)) - 1]
+    check_dir = os.path.join(site_root,"check")
+    if len(site_dirs) > 1:
+        shutil.copytree(check_site,check_dir,symlinks=True)
+        calls.append((runSingleSite,(check_dir,getpot,deadline)))
+        run_dirs.append(check_dir)
+
+    JobPool.mapThreads(JobPool.callFunction,[(c,) for c in calls],
+                       calc_param.site_jobs)
+
+    if len(site_dirs) > 1:
+        if readPotentialFile(check_site) != readPotentialFile(check_dir):
+            err = "potentials of %s differ between its batched " % check_site
+            err += "uhbd session and a run on its own (%s); " % check_dir
+            err += "this uhbd does not support --site-batch."
+            raise Error.UhbdError(err)
+        print "   batched potentials of %s identical to a run on its own" % \
+              os.path.split(check_site)[-1]
+
+    return run_dirs
+
+def runSingleSites(calc_param,doinp,job_dir,num_sites,getpot,iteration,
+                   deadline):
+    """
+    Concurrent replacement for the single-site stopnow loop.  The doinps
+    binary writes the inputs of every site up front (see writeSiteInputs),
+    the sites are run in calc_param.site_jobs threads (in batches of
+    calc_param.site_batch sites per uhbd session, see runSiteBatches) and
+    their potentials are merged back into job_dir/potentials in site order.
+    With calc_param.check_sites, the stopnow loop (iteration) is also run and
+    must give the same potentials.  Every binary is limited to the time left
+    before deadline (a StageDeadline).
+    """
+
+    if num_sites == 0:
+        raise Error.UhbdError("No titratable sites in %s!" % job_dir)
+
+    site_root = os.path.join(job_dir,"sites")
+    SystemOps.makeDir(site_root)
+    if calc_param.check_sites:
+        copyLoopState(job_dir,os.path.join(site_root,"stopnow"))
+
+    site_dirs = writeSiteInputs(doinp,job_dir,site_root,num_sites,deadline)
+    print "Running %i sites using %i threads." % (len(site_dirs),
+                                                  calc_param.site_jobs)
+
+    if calc_param.site_batch > 1:
+        run_dirs = runSiteBatches(calc_param,job_dir,site_root,site_dirs,
+                                  getpot,deadline)
+    else:
+        JobPool.mapThreads(runSingleSite,[(d,getpot,deadline)
+                                          for d in site_dirs],
+                           calc_param.site_jobs)
+        run_dirs = []
+    Execute.mergeRecords(job_dir,[os.path.join(site_root,"doinp")] +
+                         site_dirs + run_dirs)
+
+    mergePotentials(job_dir,site_dirs)
+
+    if calc_param.check_sites:
+        checkSiteLoop(calc_param,os.path.join(site_root,"stopnow"),job_dir,
+                      num_sites,iteration)
+
+    if not calc_param.keep_temp:
+        shutil.rmtree(site_root)
+
+def runSingleUhbdini(calc_param,job_dir,cache):
+    """
+    Run pkaS-uhbdini in job_dir (or restore its output from the cache), writing
+    the coarse dielectric maps.
+    """
+
+    short_param_file = os.path.split(calc_param.param_file)[-1]
+    uhbdini_key = cache.key("uhbdini",
+                            [os.path.join(job_dir,f) for f in
+                             ["proteinH.pdb",short_param_file,
+                              "pkaS-uhbdini.inp"]],
+                            [StageCache.binaryIdentity(uhbd)])
+    if not cache.restore(uhbdini_key,job_dir):
+        runUHBD('pkaS-uhbdini.inp','pkaS-uhbdini.out',job_dir,
+                stageTimeout(calc_param,"uhbdini"))
+        cache.store(uhbdini_key,job_dir,MAP_FILES)
+
+def lockMaps(lock_file,shared_dir,timeout):
+    """
+    Take an exclusive lock (fcntl.flock) on the open lock_file, waiting while
+    another job holds it (i.e. while it builds the maps in shared_dir) but no
+    longer than timeout seconds (None: no limit).  The lock is released when
+    lock_file is closed or its owner exits, so a job that was killed never
+    leaves a stale lock behind.
+    """
+
+    waiting = None
+    while True:
+        try:
+            fcntl.flock(lock_file.fileno(),fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except IOError, value:
+            if value.errno not in (errno.EAGAIN,errno.EACCES):
+                raise
+
+        if waiting == None:
+            print "Waiting for maps in %s (another job is building them)" % \
+                  shared_dir
+            waiting = time.time()
+        elif timeout != None and time.time() - waiting > timeout:
+            err = "Timed out after %i s waiting for maps in %s " % \
+                  (timeout,shared_dir)
+            err += "(%s is held by another job)" % lock_file.name
+            raise Error.UhbdError(err)
+        time.sleep(2)
+
+def linkSharedMaps(calc_param,job_dir,cache):
+    """
+    The coarse dielectric maps depend only on the structure, parameter file,
+    coarse grid and dielectric options, all of which are in pkaS-uhbdini.inp;
+    they do not depend on ionic strength or temperature.  The maps are built
+    once for each distinct set of these inputs in calc_param.map_dir and
+    linked into job_dir.  Jobs that need maps another job is building wait for
+    them (see lockMaps); a job waits no longer than the uhbdini --timeout.
+    """
+
+    short_param_file = os.path.split(calc_param.param_file)[-1]
+    key = [StageCache.hashFile(os.path.join(job_dir,f))
+           for f in ["proteinH.pdb",short_param_file,"pkaS-uhbdini.inp"]]
+    key.append(StageCache.binaryIdentity(uhbd))
+    key = hashlib.sha1(" ".join(key)).hexdigest()
+
+    shared_dir = os.path.join(calc_param.map_dir,key)
+    if not os.path.isdir(shared_dir):
+        try:
+            os.makedirs(calc_param.map_dir)
+        except OSError:
+            if not os.path.isdir(calc_param.map_dir):
+                raise
+
+        lock_file = open("%s.lock" % shared_dir,"a")
+        try:
+            lockMaps(lock_file,shared_dir,stageTimeout(calc_param,"uhbdini"))
+            if not os.path.isdir(shared_dir):
+                print "Building coarse maps in %s" % shared_dir
+                runSingleUhbdini(calc_param,job_dir,cache)
+
+                # Maps are moved in under a private name and renamed, so a
+                # job that got the lock anyway (flock emulated on a network
+                # file system) never sees or clobbers a partial set.
+                tmp_dir = tempfile.mkdtemp(prefix="%s.tmp" % key,
+                                           dir=calc_param.map_dir)
+                try:
+                    for pattern in MAP_FILES:
+                        for f in glob.glob(os.path.join(job_dir,pattern)):
+                            shutil.move(f,tmp_dir)
+                    try:
+                        os.rename(tmp_dir,shared_dir)
+                    except OSError:
+                        if not os.path.isdir(shared_dir):
+                            raise
+                finally:
+                    shutil.rmtree(tmp_dir,ignore_errors=True)
+        finally:
+            lock_file.close()
+
+    print "Linking coarse maps from %s" % shared_dir
+    SystemOps.linkFiles(shared_dir,job_dir)
+
+def clearSiteLoop(job_dir,file_list=["potentials","stopnow"]):
+    """
+    Remove the files in file_list a previous site loop left in job_dir (only
+    present when rerunning in an existing output directory), so the loop
+    starts over.
+    """
+
+    for f in file_list:
+        if os.path.isfile(os.path.join(job_dir,f)):
+            os.remove(os.path.join(job_dir,f))
+
+def fileSize(some_file):
+    """
+    Return the size of some_file, or -1 if it does not exist.
+    """
+
+    if os.path.isfile(some_file):
+        return os.path.getsize(some_file)
+    return -1
+
+def runStopnowLoop(calc_param,job_dir,num_sites,iteration):
+    """
+    Supervise the stopnow loop in job_dir.  iteration is a function that runs
+    one pass of the loop (doinp, uhbd, getpot).  doinp writes stopnow once
+    every site has been calculated; the loop is stopped with an error if this
+    does not happen within num_sites + 1 passes (one pass per site plus the
+    pass in which doinp may notice it is done) or if a pass ends with the
+    potentials file unchanged for calc_param.stall minutes.  The stall check
+    never kills a running binary; only the sites --timeout does that.
+    Progress and an estimated time to completion are printed after each pass.
+    """
+
+    stopnow = os.path.join(job_dir,'stopnow')
+    potential_file = os.path.join(job_dir,'potentials')
+    max_iterations = num_sites + 1
+
+    print 'Running stopnow loop (%i sites).' % num_sites
+
+    start = time.time()
+    last_change = start
+    last_size = fileSize(potential_file)
+    counter = 0
+    while os.path.isfile(stopnow) == False:
+        if counter == max_iterations:
+            err = "stopnow loop in %s did not finish after " % job_dir
+            err += "%i passes (%i sites)!" % (counter,num_sites)
+            raise Error.UhbdError(err)
+
+        iteration()
+        counter += 1
+
+        now = time.time()
+        size = fileSize(potential_file)
+        if size != last_size:
+            last_size = size
+            last_change = now
+        elif calc_param.stall > 0 and now - last_change > 60*calc_param.stall:
+            err = "stopnow loop in %s stalled: no new potentials " % job_dir
+            err += "for %.1F minutes!" % ((now - last_change)/60.)
+            raise Error.UhbdError(err)
+
+        elapsed = now - start
+        remaining = max(num_sites - counter,0)
+        print "Site %i/%i done [%.1F s elapsed, about %.1F s left]" % \
+              (min(counter,num_sites),num_sites,elapsed,
+               elapsed/counter*remaining)
+        sys.stdout.flush()
+
+def runSingleCalculation(calc_param,job_dir):
+    """
+    Peform pH titration on the files in job_dir.
     """
 
     # Set up aliases for binaries
     getgrid = os.path.join(bin_path,'getgrids')
     doinp = os.path.join(bin_path,'doinps')
-    getpot = os.path.join(bin_path,'getpots')
+    getpot_bin = os.path.join(bin_path,'getpots')
     hybrid = os.path.join(bin_path,'hybrids')
 
-    # Make sure that all of the executables exist:
-    to_check = [getgrid, doinp, getpot, hybrid]
+    # Make sure that all of the executables exist (getpots is needed even with
+    # --python-getpots, to check the python getpots)
+    to_check = [getgrid, doinp, getpot_bin]
+    if not calc_param.python_hybrid and calc_param.monte_carlo == None:
+        to_check.append(hybrid)
     checksum = sum([os.path.isfile(f) for f in to_check])
     if checksum != len(to_check):
         raise OSError("Not all required binaries in $UHBD (%s)" % bin_path)
 
     print 'prepares'
-    UhbdSingleFunctions.runPrepares(calc_param)
+    UhbdSingleFunctions.runPrepares(calc_param,job_dir)
+
+    # getpots is either the binary or its python implementation; either way it
+    # is called as getpot(site_dir,timeout).
+    if calc_param.python_getpots:
+        getpot = PythonGetpots(getpot_bin,job_dir,calc_param.check_sites)
+        getpot_identity = ["python getpots"]
+    else:
+        def getpot(site_dir,timeout):
+            SystemOps.runBin(getpot_bin,site_dir,timeout)
+        getpot_identity = []
+
+    # The site loop depends on everything prepares wrote, the binaries and
+    # whether the sites are run concurrently.
+    cache = StageCache.openCache(calc_param)
+    short_param_file = os.path.split(calc_param.param_file)[-1]
+    concurrent = calc_param.site_jobs > 1 or calc_param.site_batch > 1
+    sites_key = cache.key("sites",
+                          [os.path.join(job_dir,f) for f in
+                           ["proteinH.pdb",short_param_file,calc_param.inp_name,
+                            "pkaS-uhbdini.inp","titraa.pdb"]],
+                          [StageCache.binaryIdentity(b) for b in
+                           [uhbd,getgrid,doinp,getpot_bin]] +
+                          getpot_identity +
+                          ["concurrent sites %s" % concurrent,
+                           "site batch %i" % calc_param.site_batch])
+
+    stages = UhbdStages.StageManifest(calc_param,job_dir)
+    stages.done("prepares")
+
+    if stages.run("getgrids") and not cache.restore(sites_key,job_dir):
+
+        if stages.run("uhbdini"):
+            if calc_param.share_maps:
+                linkSharedMaps(calc_param,job_dir,cache)
+            else:
+                runSingleUhbdini(calc_param,job_dir,cache)
+        stages.done("uhbdini")
+
+        print 'getgrids'
+        clearSiteLoop(job_dir)
+        SystemOps.runBin(getgrid,job_dir,stageTimeout(calc_param,"getgrids"))
+        stages.done("getgrids")
+
+        deadline = StageDeadline(calc_param,"sites")
+        def iteration(loop_dir):
+            SystemOps.runBin(doinp,loop_dir,deadline.left())
+            runSingleSite(loop_dir,getpot,deadline)
+
+        num_sites = len(UhbdSingleFunctions.readSites(job_dir))
+        if concurrent:
+            runSingleSites(calc_param,doinp,job_dir,num_sites,getpot,
+                           iteration,deadline)
+        else:
+            runStopnowLoop(calc_param,job_dir,num_sites,
+                           lambda: iteration(job_dir))
+
+        cache.store(sites_key,job_dir,["potentials","sitesinpr.pdb"])
+
+    if stages.run("sites"):
+        shutil.copy(os.path.join(job_dir,'potentials'),
+                    os.path.join(job_dir,'pkaS-potentials'))
+        shutil.copy(os.path.join(job_dir,'sitesinpr.pdb'),
+                    os.path.join(job_dir,'pkaS-sitesinpr.pdb'))
+        for stage in ["uhbdini","getgrids","sites"]:
+            stages.done(stage)
+
+    # Run hybrid (the binary, its python implementation or Monte Carlo); each
+    # writes hybrid.out
+    hybrid_outputs = ["hybrid.out"]
+    if calc_param.monte_carlo != None:
+        hybrid_identity = "python monte carlo %s %i %i" % \
+                          ((calc_param.temperature,) + calc_param.monte_carlo)
+        hybrid_outputs.append(UhbdMonteCarlo.FRACTION_FILE)
+    elif calc_param.python_hybrid:
+        hybrid_identity = "python hybrid %s" % calc_param.temperature
+    else:
+        hybrid_identity = StageCache.binaryIdentity(hybrid)
+    if calc_param.sparse_cutoff != None:
+        hybrid_identity += " sparse %s" % calc_param.sparse_cutoff
+        hybrid_outputs.append(UhbdPotentials.SPARSE_FILE)
+    if stages.run("hybrid"):
+        hybrid_key = cache.key("hybrid",
+                               [os.path.join(job_dir,f) for f in
+                                ["pkaS-potentials","pkaS-sitesinpr.pdb"]],
+                               [hybrid_identity,
+                                "%s %s %s" % calc_param.ph_param])
+        if not cache.restore(hybrid_key,job_dir):
+            potentials = None
+            if calc_param.sparse_cutoff != None:
+                potentials = sparsePotentials(job_dir,calc_param.sparse_cutoff)
+            if calc_param.monte_carlo != None:
+                print 'hybrid (monte carlo)'
+                sweeps, chains = calc_param.monte_carlo
+                UhbdMonteCarlo.runMonteCarlo(
+                    os.path.join(job_dir,'pkaS-potentials'),
+                    calc_param.ph_param,calc_param.temperature,
+                    os.path.join(job_dir,UhbdHybrid.REPORT_FILE),sweeps,chains,
+                    os.path.join(job_dir,UhbdMonteCarlo.FRACTION_FILE),
+                    potentials)
+            elif calc_param.python_hybrid:
+                print 'hybrid (python)'
+                UhbdHybrid.runHybrid(os.path.join(job_dir,'pkaS-potentials'),
+                                     calc_param.ph_param,
+                                     calc_param.temperature,
+                                     os.path.join(job_dir,
+                                                  UhbdHybrid.REPORT_FILE),
+                                     potentials)
+            else:
+                runHybrid(hybrid,calc_param.ph_param,job_dir,
+                          stageTimeout(calc_param,"hybrid"))
+            cache.store(hybrid_key,job_dir,hybrid_outputs)
+        stages.done("hybrid")
+
+
+def nextFullSite(loop_dir):
+    """
+    Move the files doinp leaves for the next site in loop_dir (tempallG.pdb,
+    tempallR.pdb and tmp_for_pot.dat) into place.
+    """
+
+    for source, destination in FULL_LOOP_FILES:
+        shutil.move(os.path.join(loop_dir,source),
+                    os.path.join(loop_dir,destination))
+
+def runFullSites(calc_param,doinp,job_dir,num_sites,getpot,iteration,
+                 deadline):
+    """
+    Concurrent replacement for the full stopnow loop.  The doinp binary
+    writes the inputs of every site up front (see writeSiteInputs).  The four
+    uhbd runs of every site are independent, so all of them are run in
+    calc_param.site_jobs threads, followed by getpot in each site directory.
+    The potentials are merged back into job_dir/potentials in site order.
+    With calc_param.check_sites, the stopnow loop (iteration) is also run and
+    must give the same potentials.  Every binary is limited to the time left
+    before deadline (a StageDeadline).
+    """
 
-    runUHBD('pkaS-uhbdini.inp','pkaS-uhbdini.out')
+    if num_sites == 0:
+        raise Error.UhbdError("No titratable sites in %s!" % job_dir)
 
-    print 'getgrids'
-    SystemOps.runBin(getgrid)
+    site_root = os.path.join(job_dir,"sites")
+    SystemOps.makeDir(site_root)
+    if calc_param.check_sites:
+        copyLoopState(job_dir,os.path.join(site_root,"stopnow"))
 
-    print 'Running stopnow loop.'
-    while os.path.isfile('stopnow') == False:
-        SystemOps.runBin(doinp)
-        runUHBD('uhbdpr.inp','uhbdpr.out')
-        runUHBD('uhbdaa.inp','uhbdaa.out')
-        SystemOps.runBin(getpot)
+    site_dirs = writeSiteInputs(doinp,job_dir,site_root,num_sites,deadline,
+                                nextFullSite)
+    print "Running %i sites using %i threads." % (len(site_dirs),
+                                                  calc_param.site_jobs)
 
-    shutil.copy('potentials','pkaS-potentials')
-    shutil.copy('sitesinpr.pdb','pkaS-sitesinpr.pdb')
+    def runSite(inputfile,outputfile,site_dir):
+        runUHBD(inputfile,outputfile,site_dir,deadline.left())
+    def runGetpot(site_dir):
+        SystemOps.runBin(getpot,site_dir,deadline.left())
 
-    # Run hybrid
-    hybrid_run = os.popen(hybrid,'w')
-    hybrid_run.write("%s\n%s\n%s\n" % calc_param.ph_param)
-    hybrid_run.close()
+    uhbd_runs = []
+    for d in site_dirs:
+        for name in ["uhbdpr","uhbdaa"]:
+            for suffix in ["1","2"]:
+                uhbd_runs.append(("%s.inp%s" % (name,suffix),
+                                  "%s.out%s" % (name,suffix),d))
+
+    JobPool.mapThreads(runSite,uhbd_runs,calc_param.site_jobs)
+    JobPool.mapThreads(runGetpot,[(d,) for d in site_dirs],
+                       calc_param.site_jobs)
+    mergePotentials(job_dir,site_dirs)
+    Execute.mergeRecords(job_dir,[os.path.join(site_root,"doinp")] +
+                         site_dirs)
 
+    if calc_param.check_sites:
+        checkSiteLoop(calc_param,os.path.join(site_root,"stopnow"),job_dir,
+                      num_sites,iteration)
 
-def runFullCalculation(calc_param):
-    """Peform pH titration on filename."""
+    if not calc_param.keep_temp:
+        shutil.rmtree(site_root)
+
+def runFullCalculation(calc_param,job_dir):
+    """Peform pH titration on the files in job_dir."""
 
     # Set up aliases for binaries
     getgrid = os.path.join(bin_path,'getgrid')
@@ -110,32 +932,82 @@ def runFullCalculation(calc_param):
         raise OSError("Not all required binaries in $UHBD (%s)" % bin_path)
 
     print 'Prepare'
-    UhbdFullFunctions.runPrepare(calc_param)
-
-    runUHBD('uhbdini.inp','uhbdini.out')
-
-    print 'Getgrid'
-    SystemOps.runBin(getgrid)
-
-    print 'Running stopnow loop.'
-    while os.path.isfile('stopnow') == False:
-        SystemOps.runBin(doinp)
-        runUHBD('uhbdpr.inp1','uhbdpr.out1')
-        runUHBD('uhbdpr.inp2','uhbdpr.out2')
-        runUHBD('uhbdaa.inp1','uhbdaa.out1')
-        runUHBD('uhbdaa.inp2','uhbdaa.out2')
-        SystemOps.runBin(getpot)
-
-        shutil.move('tempallG.pdb','allgroups.pdb')
-        shutil.move('tempallR.pdb','allresidues.pdb')
-        shutil.move('tmp_for_pot.dat','for_pot.dat')
-
-    shutil.copy('potentials','pkaF-potentials')
+    UhbdFullFunctions.runPrepare(calc_param,job_dir)
+
+    # The site loop depends on everything prepare wrote, the binaries and
+    # whether the sites are run concurrently.
+    cache = StageCache.openCache(calc_param)
+    short_param_file = os.path.split(calc_param.param_file)[-1]
+    concurrent = calc_param.site_jobs > 1
+    sites_key = cache.key("sites",
+                          [os.path.join(job_dir,f) for f in
+                           ["proteinH.pdb",short_param_file,calc_param.inp_name,
+                            "uhbdini.inp","allgroups.pdb","allresidues.pdb",
+                            "for_pot.dat","sites.dat"]],
+                          [StageCache.binaryIdentity(b) for b in
+                           [uhbd,getgrid,doinp,getpot]] +
+                          ["concurrent sites %s" % concurrent])
+
+    stages = UhbdStages.StageManifest(calc_param,job_dir)
+    stages.done("prepares")
+
+    if stages.run("getgrids") and not cache.restore(sites_key,job_dir):
+
+        if stages.run("uhbdini"):
+            uhbdini_key = cache.key("uhbdini",
+                                    [os.path.join(job_dir,f) for f in
+                                     ["proteinH.pdb",short_param_file,
+                                      "uhbdini.inp"]],
+                                    [StageCache.binaryIdentity(uhbd)])
+            if not cache.restore(uhbdini_key,job_dir):
+                runUHBD('uhbdini.inp','uhbdini.out',job_dir,
+                        stageTimeout(calc_param,"uhbdini"))
+                cache.store(uhbdini_key,job_dir,["uhbdini.out"])
+        stages.done("uhbdini")
+
+        # potentials starts with the site count written by prepareFull
+        print 'Getgrid'
+        clearSiteLoop(job_dir,["stopnow"])
+        SystemOps.runBin(getgrid,job_dir,stageTimeout(calc_param,"getgrids"))
+        stages.done("getgrids")
+
+        deadline = StageDeadline(calc_param,"sites")
+        def iteration(loop_dir):
+            SystemOps.runBin(doinp,loop_dir,deadline.left())
+            for name in ["uhbdpr","uhbdaa"]:
+                for suffix in ["1","2"]:
+                    runUHBD("%s.inp%s" % (name,suffix),
+                            "%s.out%s" % (name,suffix),loop_dir,
+                            deadline.left())
+            SystemOps.runBin(getpot,loop_dir,deadline.left())
+            nextFullSite(loop_dir)
+
+        num_sites = len(SystemOps.readFile(os.path.join(job_dir,"sites.dat")))
+        if concurrent:
+            runFullSites(calc_param,doinp,job_dir,num_sites,getpot,iteration,
+                         deadline)
+        else:
+            runStopnowLoop(calc_param,job_dir,num_sites,
+                           lambda: iteration(job_dir))
+
+        cache.store(sites_key,job_dir,["potentials"])
+
+    if stages.run("sites"):
+        shutil.copy(os.path.join(job_dir,'potentials'),
+                    os.path.join(job_dir,'pkaF-potentials'))
+        for stage in ["uhbdini","getgrids","sites"]:
+            stages.done(stage)
 
     # Run hybrid
-    hybrid_run = os.popen(hybrid,'w')
-    hybrid_run.write("%s\n%s\n%s\n" % calc_param.ph_param)
-    hybrid_run.close()
-
-
+    if stages.run("hybrid"):
+        hybrid_key = cache.key("hybrid",
+                               [os.path.join(job_dir,f) for f in
+                                ["pkaF-potentials","sites.dat"]],
+                               [StageCache.binaryIdentity(hybrid),
+                                "%s %s %s" % calc_param.ph_param])
+        if not cache.restore(hybrid_key,job_dir):
+            runHybrid(hybrid,calc_param.ph_param,job_dir,
+                      stageTimeout(calc_param,"hybrid"))
+            cache.store(hybrid_key,job_dir,["hybrid.out"])
+        stages.done("hybrid")
 
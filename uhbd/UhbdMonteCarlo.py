@@ -0,0 +1,259 @@
+"""
+UhbdMonteCarlo.py
+
+Metropolis Monte Carlo titration of the sites in a single-site potentials
+file, for systems too large for the hybrid treatment.  Every pH point is
+sampled at once (each row of the state array is an independent walk at one
+pH) and independent chains are run in a pool of worker processes.  Per-site
+protonated fractions, pK(app) and their standard errors (from block averages
+over all chains) are written in the hybrid.out of UhbdHybrid (REPORT_FILE).
+
+Many potentials files can be titrated in one process:
+    python -m uhbd.UhbdMonteCarlo [options] potentials_file(s)
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, sys
+import UhbdPotentials, UhbdHybrid
+from common import Error, JobPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fraction of the sweeps of each chain discarded as equilibration and the
+# number of blocks the remaining sweeps are averaged over.
+EQUILIBRATION = 0.2
+NUM_BLOCKS = 10
+MIN_SWEEPS = 50
+
+# Pairs of sites coupled more strongly than this (in pK units) are also
+# flipped together, which keeps strongly coupled pairs from getting stuck.
+PAIR_CUTOFF = UhbdHybrid.CLUSTER_CUTOFF
+
+FRACTION_FILE = "mc-fractions.dat"
+
+
+def strongPairs(w,cutoff):
+    """
+    Return a list of (i, j, w[i,j]) for the pairs of sites (i < j) that
+    interact more strongly than cutoff (kcal/mol).  w may be a SparseMatrix.
+    """
+
+    if isinstance(w,UhbdPotentials.SparseMatrix):
+        rows, cols, values = w.rows(), w.indices, w.data
+        keep = (rows < cols) & (abs(values) > cutoff)
+        return zip(rows[keep],cols[keep],values[keep])
+
+    rows, cols = numpy.nonzero(numpy.triu(abs(w) > cutoff,1))
+    return zip(rows,cols,w[rows,cols])
+
+
+def runChain(pk_int,z,w,ph,temperature,sweeps,seed):
+    """
+    Run one Metropolis chain of sweeps sweeps at every pH in ph.  pk_int, z
+    and w are the intrinsic pKa, charge and interaction matrix (kcal/mol,
+    dense or SparseMatrix) of the sites.  Returns the average charged state
+    of every site in each of NUM_BLOCKS blocks (blocks x pH x site).
+    """
+
+    rng = numpy.random.RandomState(seed)
+    kT = UhbdHybrid.R*temperature
+    num_ph = len(ph)
+    num_sites = len(z)
+
+    # Energy of charging each isolated site at each pH
+    g = z*numpy.log(10)*kT*(ph[:,None] - pk_int[None,:])
+
+    # Start from the independent-site populations
+    p = 1./(1. + numpy.exp(numpy.clip(g/kT,-500,500)))
+    x = (rng.rand(num_ph,num_sites) < p).astype(float)
+    field = UhbdPotentials.matrixDot(x,w)
+
+    pairs = strongPairs(w,PAIR_CUTOFF*numpy.log(10)*kT)
+    rows = [UhbdPotentials.rowEntries(w,i) for i in range(num_sites)]
+
+    equilibration = int(sweeps*EQUILIBRATION)
+    block_length = (sweeps - equilibration)/NUM_BLOCKS
+    equilibration = sweeps - block_length*NUM_BLOCKS
+    blocks = numpy.zeros((NUM_BLOCKS,num_ph,num_sites),dtype=float)
+
+    for sweep in range(sweeps):
+
+        # Single site moves, in random order
+        order = rng.permutation(num_sites)
+        chance = rng.rand(num_sites,num_ph)
+        for k in range(num_sites):
+            i = order[k]
+            d = 1. - 2.*x[:,i]
+            dE = d*(g[:,i] + field[:,i])
+            accept = numpy.nonzero(chance[k] <
+                                   numpy.exp(-numpy.clip(dE/kT,0,500)))[0]
+            if len(accept) > 0:
+                cols, values = rows[i]
+                x[accept,i] += d[accept]
+                field[numpy.ix_(accept,cols)] += d[accept][:,None]*values
+
+        # Pair moves
+        if len(pairs) > 0:
+            chance = rng.rand(len(pairs),num_ph)
+            for k in range(len(pairs)):
+                i, j, wij = pairs[k]
+                di = 1. - 2.*x[:,i]
+                dj = 1. - 2.*x[:,j]
+                dE = di*(g[:,i] + field[:,i]) + dj*(g[:,j] + field[:,j]) + \
+                     di*dj*wij
+                accept = numpy.nonzero(chance[k] <
+                                       numpy.exp(-numpy.clip(dE/kT,0,500)))[0]
+                if len(accept) > 0:
+                    x[accept,i] += di[accept]
+                    x[accept,j] += dj[accept]
+                    for site, d in [(i,di),(j,dj)]:
+                        cols, values = rows[site]
+                        field[numpy.ix_(accept,cols)] += \
+                            d[accept][:,None]*values
+
+        if sweep >= equilibration:
+            blocks[(sweep - equilibration)/block_length] += x
+
+    return blocks/block_length
+
+
+def sample(potentials,ph,temperature,sweeps,chains,num_processes=None,
+           seed=0):
+    """
+    Sample the charge states of the sites in potentials with chains
+    independent chains of sweeps sweeps each, run in num_processes worker
+    processes (default one per chain).  Chain i is seeded with seed + i, so
+    results are reproducible.  Returns the block averages of all chains
+    (blocks x pH x site).
+    """
+
+    if sweeps < MIN_SWEEPS:
+        err = "Monte Carlo needs at least %i sweeps!" % MIN_SWEEPS
+        raise Error.UhbdError(err)
+    if num_processes == None:
+        num_processes = chains
+
+    pk_int = UhbdHybrid.intrinsicPKa(potentials,temperature)
+    z = potentials.charge.astype(float)
+    w = UhbdHybrid.interactionMatrix(potentials)
+
+    arg_list = [(pk_int,z,w,ph,temperature,sweeps,seed + i)
+                for i in range(chains)]
+    results = JobPool.mapProcesses(runChain,arg_list,num_processes)
+
+    return numpy.concatenate(results)
+
+
+def standardError(values):
+    """
+    Return the standard error of the mean of values along the first axis.
+    """
+
+    return values.std(0,ddof=1)/numpy.sqrt(len(values))
+
+
+def fractionReport(potentials,ph,fraction,fraction_err):
+    """
+    Create a table of the protonated fraction (and its standard error) of
+    every site at every pH.  Returns a list of lines.
+    """
+
+    out = ["%5s %-5s %5s %8s %8s %8s\n" % ("site","type","resid","pH",
+                                           "frac","err")]
+    for i, site in enumerate(potentials.sites):
+        for j in range(len(ph)):
+            out.append("%5i %-5s %5i %8.3F %8.4F %8.4F\n" % \
+                       (i+1,site[0],site[1],ph[j],fraction[j,i],
+                        fraction_err[j,i]))
+
+    return out
+
+
+def runMonteCarlo(potential_file,ph_param,temperature,output_file,sweeps,
+                  chains,fraction_file=None,potentials=None,
+                  num_processes=None):
+    """
+    Titrate the sites in potential_file (a potentials or sparse .npz file, or
+    the Potentials instance potentials, if given) over ph_param by Monte Carlo
+    and write a UhbdHybrid style report to output_file.  If fraction_file is
+    given, the protonated fraction of every site at every pH is written there.
+    """
+
+    if potentials == None:
+        potentials = UhbdPotentials.loadPotentials(potential_file)
+
+    ph = UhbdHybrid.phValues(ph_param)
+    blocks = sample(potentials,ph,temperature,sweeps,chains,num_processes)
+    theta = blocks.mean(0)
+
+    # Errors from the spread of the block averages
+    z = potentials.charge.astype(float)
+    charge_err = standardError(numpy.dot(blocks,z))
+    pk_blocks = numpy.array([UhbdHybrid.pKApp(ph,
+                             UhbdHybrid.protonated(potentials,b))
+                             for b in blocks])
+    pk_err = standardError(pk_blocks)
+
+    g = open(output_file,"w")
+    g.writelines(UhbdHybrid.hybridReport(potentials,ph,theta,temperature,
+                                         (charge_err,pk_err)))
+    g.close()
+
+    if fraction_file != None:
+        fraction = UhbdHybrid.protonated(potentials,theta)
+        fraction_err = standardError(blocks)
+        g = open(fraction_file,"w")
+        g.writelines(fractionReport(potentials,ph,fraction,fraction_err))
+        g.close()
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = "python -m uhbd.UhbdMonteCarlo [options] potentials_file(s)"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-q","--ph-param",action="store",type="float",nargs=3,
+                      default=(-5.0,20.0,0.25),
+                      help="pH titration parameters (3 values) " +
+                      "[default %default]")
+    parser.add_option("-T","--temperature",action="store",type="float",
+                      default=298.0,
+                      help="Temperature of calculation [default %default]")
+    parser.add_option("-s","--sweeps",action="store",type="int",
+                      default=2000,
+                      help="Monte Carlo sweeps per chain [default %default]")
+    parser.add_option("-c","--chains",action="store",type="int",default=4,
+                      help="Number of independent chains, each run in its " +
+                      "own process [default %default]")
+    parser.add_option("-o","--output",action="store",type="string",
+                      default=UhbdHybrid.REPORT_FILE,
+                      help="Name of output file written next to each " +
+                      "potentials file [default %default]")
+    options, args = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error("no potentials files given")
+    if numpy == None:
+        parser.error("numpy is required")
+    if options.chains < 1:
+        parser.error("--chains must be at least 1")
+
+    failed = []
+    for potential_file in args:
+        output_dir = os.path.split(potential_file)[0]
+        try:
+            runMonteCarlo(potential_file,options.ph_param,options.temperature,
+                          os.path.join(output_dir,options.output),
+                          options.sweeps,options.chains,
+                          os.path.join(output_dir,FRACTION_FILE))
+        except (Error.UhbdError, IOError, ValueError), value:
+            failed.append((potential_file,str(value)))
+
+    print "Titrated %i of %i files." % (len(args) - len(failed),len(args))
+    for f, err in failed:
+        print "   %s: %s" % (f,err)
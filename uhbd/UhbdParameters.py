@@ -0,0 +1,288 @@
+"""
+UhbdParameters.py
+
+Compiled uhbd charge/radius parameter files (pkaS.dat, ch22fjmb1.dat,
+qr_parse.dat).  A parameter file is parsed once into a ParameterDatabase:
+every atom entry of its MINE, NEUT and CHAR records, its EQUIVALENCE records
+and the table of atoms that differ between the neutral and charged forms of
+each residue (what prepareFull needs).  With the stage cache enabled, the
+compiled arrays are stored as .npy files in the parameters directory of the
+stage cache under the sha1 of the parameter file and are memory-mapped when
+loaded, so the processes of a job pool share one copy.  Each process loads a
+given parameter file at most once.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, shutil, tempfile
+from common import Error, StageCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bump if the compiled format changes
+COMPILED_VERSION = 1
+
+ATOM_RECORDS = ["mine","neut","char"]
+EQUIVALENCE_RECORD = "equi"
+
+ENTRY_FIELDS = ["record","resi","atom","charge","epsilon","sigma","radius"]
+EQUIVALENCE_FIELDS = ["resi","atom","equiv_resi","equiv_atom"]
+DIFFERENCE_FIELDS = ["resi","atom"]
+
+if numpy != None:
+    ENTRY_DTYPE = numpy.dtype([("record","S4"),("resi","S4"),("atom","S4"),
+                               ("charge","f8"),("epsilon","f8"),
+                               ("sigma","f8"),("radius","f8")])
+    EQUIVALENCE_DTYPE = numpy.dtype([(f,"S4") for f in EQUIVALENCE_FIELDS])
+    DIFFERENCE_DTYPE = numpy.dtype([(f,"S4") for f in DIFFERENCE_FIELDS])
+
+# Databases loaded by this process, keyed by parameter file hash
+_loaded = {}
+
+
+def parseParamFile(param_file):
+    """
+    Read a uhbd parameter file.  Returns entries (a list of (record, residue,
+    atom, charge, epsilon, sigma, radius)) and equivalences (a list of
+    (residue, atom, equivalent residue, equivalent atom)), in file order.
+    """
+
+    f = open(param_file,'r')
+    lines = f.readlines()
+    f.close()
+
+    entries, equivalences = [], []
+    record = None
+    for i, line in enumerate(lines):
+
+        # Strip comments and white space
+        line = line.split("!")[0]
+        if line.strip() == "":
+            continue
+
+        # Start of a new record
+        if line[0:4].lower() in ATOM_RECORDS + [EQUIVALENCE_RECORD]:
+            record = line[0:4].lower()
+            continue
+
+        columns = line.split()
+        if columns[0].lower() == "resi":
+            continue
+
+        try:
+            if record == EQUIVALENCE_RECORD:
+                if len(columns) != 4 or max([len(c) for c in columns]) > 4:
+                    raise ValueError
+                equivalences.append(tuple(columns))
+            elif record != None:
+                if len(columns) < 6 or max([len(c) for c in columns[:2]]) > 4:
+                    raise ValueError
+                entries.append(tuple([record] + columns[:2] +
+                                     [float(c) for c in columns[2:6]]))
+            else:
+                raise ValueError
+        except ValueError:
+            err = "%s: mangled parameter entry (line %i):\n%s" % \
+                  (param_file,i+1,lines[i])
+            raise Error.UhbdError(err)
+
+    return entries, equivalences
+
+
+def findDifferences(entries):
+    """
+    Determine which atoms have different charge or Lennard-Jones parameters in
+    the neutral and charged forms of each residue.  Returns a list of
+    (residue, atom), in the order of the neutral entries.  Residues without
+    both a neutral and a charged entry are skipped (with a warning).
+    """
+
+    neutral, charged = {}, {}
+    order = []
+    for e in entries:
+        if e[0] == "neut":
+            atoms = neutral.setdefault(e[1],{})
+            if e[2] not in atoms:
+                order.append((e[1],e[2]))
+            atoms[e[2]] = e[3:6]
+        elif e[0] == "char":
+            charged.setdefault(e[1],{})[e[2]] = e[3:6]
+
+    for residue in charged:
+        if residue not in neutral:
+            print "   %s has a charged entry but no neutral entry!  " \
+                  "Skipping..." % residue
+    for residue in neutral:
+        if residue not in charged:
+            print "   %s has neutral entry but no charged entry!  " \
+                  "Skipping..." % residue
+
+    differences = [(r,a) for r, a in order
+                   if r in charged and charged[r].get(a) != neutral[r][a]]
+
+    return differences
+
+
+class ParameterDatabase:
+    """
+    Class that holds a compiled parameter file.  entries, equivalences and
+    differences are NumPy record arrays (possibly memory-mapped) or, without
+    NumPy, lists of tuples with the fields in ENTRY_FIELDS,
+    EQUIVALENCE_FIELDS and DIFFERENCE_FIELDS.
+    """
+
+    def __init__(self,entries,equivalences,differences):
+        """
+        Initialize class and index the entries by record and residue.
+        """
+
+        self.entries = entries
+        self.equivalences = equivalences
+
+        if numpy != None:
+            records = entries["record"].tolist()
+            residues = entries["resi"].tolist()
+            differences = zip(differences["resi"].tolist(),
+                              differences["atom"].tolist())
+        else:
+            records = [e[0] for e in entries]
+            residues = [e[1] for e in entries]
+
+        # (record, residue) -> indices of its entries
+        self.index = {}
+        for i, key in enumerate(zip(records,residues)):
+            self.index.setdefault(key,[]).append(i)
+
+        # Residue -> atoms different between neutral and charged forms
+        self.differences = {}
+        for residue, atom in differences:
+            self.differences.setdefault(residue,[]).append(atom)
+        for record, residue in self.index:
+            if record == "char" and ("neut",residue) in self.index:
+                self.differences.setdefault(residue,[])
+
+    def residue(self,record,residue):
+        """
+        Return the entries of residue in record (e.g. "neut") as a list of
+        (atom, charge, epsilon, sigma, radius).
+        """
+
+        try:
+            index = self.index[(record,residue)]
+        except KeyError:
+            err = "No %s entry for %s in parameter file!" % (record,residue)
+            raise Error.UhbdError(err)
+
+        return [tuple(self.entries[i])[2:] for i in index]
+
+
+def compileParamFile(param_file):
+    """
+    Parse param_file into a ParameterDatabase (held in memory).
+    """
+
+    print "Reading parameter file %s" % param_file
+
+    entries, equivalences = parseParamFile(param_file)
+    differences = findDifferences(entries)
+
+    if numpy != None:
+        entries = numpy.array(entries,dtype=ENTRY_DTYPE)
+        equivalences = numpy.array(equivalences,dtype=EQUIVALENCE_DTYPE)
+        differences = numpy.array(differences,dtype=DIFFERENCE_DTYPE)
+
+    return ParameterDatabase(entries,equivalences,differences)
+
+
+def writeCompiled(database,compiled_dir):
+    """
+    Write the arrays of database to compiled_dir.  The arrays are written to a
+    temporary directory that is then renamed, so a compiled directory is
+    always complete.
+    """
+
+    parent = os.path.split(compiled_dir)[0]
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    for name in ["entries","equivalences"]:
+        numpy.save(os.path.join(tmp_dir,"%s.npy" % name),
+                   getattr(database,name))
+    differences = [(r,a) for r in database.differences
+                   for a in database.differences[r]]
+    numpy.save(os.path.join(tmp_dir,"differences.npy"),
+               numpy.array(differences,dtype=DIFFERENCE_DTYPE))
+
+    try:
+        os.rename(tmp_dir,compiled_dir)
+    except OSError:
+        # Another process compiled it first
+        shutil.rmtree(tmp_dir)
+
+
+def readCompiled(compiled_dir):
+    """
+    Load a ParameterDatabase from compiled_dir, memory-mapping the arrays.
+    """
+
+    arrays = [numpy.load(os.path.join(compiled_dir,"%s.npy" % name),
+                         mmap_mode="r")
+              for name in ["entries","equivalences","differences"]]
+
+    return ParameterDatabase(*arrays)
+
+
+def cacheDir(calc_param):
+    """
+    Return the directory compiled parameter files are stored in: the
+    parameters directory of the stage cache (calc_param.cache_dir), or None
+    if the stage cache is not used (calc_param.cache).
+    """
+
+    if calc_param.cache:
+        return os.path.join(calc_param.cache_dir,"parameters")
+    return None
+
+
+def loadParameters(param_file,cache_dir=None):
+    """
+    Return the ParameterDatabase for param_file.  It is taken from this
+    process if it has loaded the same file before, otherwise from the
+    compiled copy in cache_dir, otherwise it is compiled (and stored in
+    cache_dir if NumPy is available and cache_dir is given and writable).
+    A compiled copy that cannot be read is removed and compiled again.
+    """
+
+    key = "%s-%i" % (StageCache.hashFile(param_file),COMPILED_VERSION)
+    if key in _loaded:
+        return _loaded[key]
+
+    database = None
+    use_cache = numpy != None and cache_dir != None
+    if use_cache:
+        compiled_dir = os.path.join(cache_dir,key)
+        if os.path.isdir(compiled_dir):
+            try:
+                database = readCompiled(compiled_dir)
+            except (IOError, ValueError):
+                print "Removing unreadable compiled parameters %s" % \
+                      compiled_dir
+                shutil.rmtree(compiled_dir,ignore_errors=True)
+
+    if database == None:
+        database = compileParamFile(param_file)
+        if use_cache:
+            try:
+                writeCompiled(database,compiled_dir)
+                database = readCompiled(compiled_dir)
+            except (IOError, OSError, ValueError):
+                # Keep the copy compiled in memory
+                pass
+
+    _loaded[key] = database
+
+    return database
@@ -0,0 +1,636 @@
+"""
+UhbdPotentials.py
+
+A python implementation of the UHBD fortran "getpots.f" (single-site,
+--python-getpots) and functions to read single-site potentials files for the
+python titration engines.  The potentials of a calculation are held in memory
+as a Potentials instance: per-site model pKa, charge and self energies, and the
+site-site interaction matrix as a NumPy array.
+
+A potentials file has one block per site, in the order of the sites in
+pkaS-sitesinpr.pdb (SITE_FILE):
+
+    site  resname  resid  atom  pK(model)  charge  Gself  Gborn  Gback
+    N interaction potentials, VALUES_PER_LINE per line
+
+written with SITE_FORMAT and VALUE_FORMAT (read back in the fixed columns of
+SITE_COLUMNS and VALUE_WIDTH).  Energies are in kcal/mol; the interaction
+potential is the potential (for a unit charge on the site) at the titratable
+atom of every other site.  This layout comes from the documentation, not from
+the getpots source, so it is checked wherever it is used: the python getpots
+is run next to the getpots binary and must write the same bytes (see
+UhbdInterface.PythonGetpots), and every file the readers take is checked as it
+is read: the sites must match SITE_FILE, every line must have exactly the
+expected columns and the interaction matrix must be symmetric.  A file that
+does not pass raises Error.UhbdError instead of being misread; titrate it with
+the hybrids binary.
+
+For very large systems the interaction matrix can be held as a SparseMatrix
+(compressed sparse rows), keeping only pairs of sites whose titratable atoms
+are within a cutoff distance.  Sparse potentials are stored as a NumPy .npz
+file (SPARSE_FILE) and can be titrated without ever building the full matrix.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os
+import UhbdFullFunctions
+from common import Error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Format of the site line of a block and of each interaction potential, and
+# the column widths they give (site, blank, resname, resid, blank, atom,
+# pK(model), charge, Gself, Gborn, Gback)
+SITE_FORMAT = "%5i %-4s%5i %-4s%8.2F%3i%14.6E%14.6E%14.6E\n"
+VALUE_FORMAT = "%14.6E"
+SITE_COLUMNS = [5,1,4,5,1,4,8,3,14,14,14]
+VALUE_WIDTH = 14
+VALUES_PER_LINE = 5
+
+# Lines of uhbd output holding the energies of mol 2 (the site) and the
+# header of the potentials at the titratable sites
+SELF_MARKER = "Self energy of mol 2"
+BACK_MARKER = "Interaction energy of mol 2"
+SITE_POTENTIAL_MARKER = "Potential at titratable sites"
+
+# Relative (and absolute, for potentials near zero) difference allowed
+# between the potentials i,j and j,i.  The finite difference potentials are
+# not exactly symmetric, but a misread file is far from it.
+SYMMETRY_TOLERANCE = 0.2
+SYMMETRY_FLOOR = 1e-4
+
+SITE_FILE = "pkaS-sitesinpr.pdb"
+SPARSE_FILE = "pkaS-potentials.npz"
+
+
+class SparseMatrix:
+    """
+    Class that holds a square matrix in compressed sparse row form: the
+    non-zero entries of row i are data[indptr[i]:indptr[i+1]] in the columns
+    indices[indptr[i]:indptr[i+1]].
+    """
+
+    def __init__(self,indptr,indices,data,size):
+        """
+        Initialize class.
+        """
+
+        self.indptr = numpy.array(indptr,dtype=int)
+        self.indices = numpy.array(indices,dtype=int)
+        self.data = numpy.array(data,dtype=float)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def rows(self):
+        """
+        Return the row of every stored entry.
+        """
+
+        return numpy.repeat(numpy.arange(self.size),numpy.diff(self.indptr))
+
+    def rowEntries(self,i):
+        """
+        Return the columns and values of the entries in row i.
+        """
+
+        start, end = self.indptr[i], self.indptr[i+1]
+        return self.indices[start:end], self.data[start:end]
+
+    def dot(self,x):
+        """
+        Return x times the matrix, where x is a vector or a 2D array with one
+        vector per row.
+        """
+
+        x2 = numpy.atleast_2d(x)
+        m = len(x2)
+        contrib = x2[:,self.rows()]*self.data
+        flat = self.indices[None,:] + self.size*numpy.arange(m)[:,None]
+        out = numpy.bincount(flat.ravel(),weights=contrib.ravel(),
+                             minlength=m*self.size).reshape(m,self.size)
+
+        if numpy.ndim(x) == 1:
+            return out[0]
+        return out
+
+    def subMatrix(self,index):
+        """
+        Return the (dense) block of the matrix for the rows and columns in
+        index.
+        """
+
+        position = -numpy.ones(self.size,dtype=int)
+        position[index] = numpy.arange(len(index))
+        out = numpy.zeros((len(index),len(index)),dtype=float)
+        for k, i in enumerate(index):
+            cols, vals = self.rowEntries(i)
+            keep = position[cols] >= 0
+            out[k,position[cols[keep]]] = vals[keep]
+
+        return out
+
+    def toDense(self):
+        """
+        Return the matrix as a dense array.
+        """
+
+        out = numpy.zeros((self.size,self.size),dtype=float)
+        out[self.rows(),self.indices] = self.data
+
+        return out
+
+
+def fromTriplets(rows,cols,values,size):
+    """
+    Create a SparseMatrix from (row, column, value) triplets.  Values of
+    repeated (row, column) pairs are summed.
+    """
+
+    rows = numpy.asarray(rows,dtype=int)
+    cols = numpy.asarray(cols,dtype=int)
+    values = numpy.asarray(values,dtype=float)
+
+    key = rows*size + cols
+    order = numpy.argsort(key,kind="mergesort")
+    key = key[order]
+    if len(key) > 0:
+        first = numpy.concatenate(([0],numpy.nonzero(numpy.diff(key))[0] + 1))
+        data = numpy.add.reduceat(values[order],first)
+        key = key[first]
+    else:
+        data = values
+
+    counts = numpy.bincount(key/size,minlength=size)
+    indptr = numpy.concatenate(([0],numpy.cumsum(counts)))
+
+    return SparseMatrix(indptr,key % size,data,size)
+
+
+def matrixDot(x,w):
+    """
+    Return x times the interaction matrix w (dense or SparseMatrix).
+    """
+
+    if isinstance(w,SparseMatrix):
+        return w.dot(x)
+    return numpy.dot(x,w)
+
+
+def rowEntries(w,i):
+    """
+    Return the columns and values of row i of w (dense or SparseMatrix).
+    """
+
+    if isinstance(w,SparseMatrix):
+        return w.rowEntries(i)
+    return numpy.arange(len(w)), w[i]
+
+
+def subMatrix(w,index):
+    """
+    Return the dense block of w (dense or SparseMatrix) for the rows and
+    columns in index.
+    """
+
+    if isinstance(w,SparseMatrix):
+        return w.subMatrix(index)
+    return w[numpy.ix_(index,index)]
+
+
+class Potentials:
+    """
+    Class that holds the potentials of every titratable site.
+    """
+
+    def __init__(self,sites,pk_model,charge,g_self,g_born,g_back,w):
+        """
+        Initialize class.  sites is a list of (resname, resid, atom) tuples;
+        the other arguments are sequences in site order, w is the N x N
+        interaction matrix (or a SparseMatrix).
+        """
+
+        self.sites = sites
+        self.pk_model = numpy.array(pk_model,dtype=float)
+        self.charge = numpy.array(charge,dtype=int)
+        self.g_self = numpy.array(g_self,dtype=float)
+        self.g_born = numpy.array(g_born,dtype=float)
+        self.g_back = numpy.array(g_back,dtype=float)
+        if isinstance(w,SparseMatrix):
+            self.w = w
+        else:
+            self.w = numpy.array(w,dtype=float)
+
+    def __len__(self):
+        return len(self.sites)
+
+
+def readSites(site_file):
+    """
+    Read the titratable sites (in site order) from a sitesinpr.pdb file.
+    Returns a list of (resname, resid, atom) tuples and an N x 3 array of the
+    coordinates of their titratable atoms.
+    """
+
+    f = open(site_file,"r")
+    lines = [l for l in f.readlines() if l[0:4] == "ATOM"]
+    f.close()
+
+    sites = [(l[17:21].strip(),int(l[22:26]),l[12:16].strip()) for l in lines]
+    coord = [[float(l[30+8*i:38+8*i]) for i in range(3)] for l in lines]
+
+    return sites, numpy.array(coord,dtype=float).reshape(-1,3)
+
+
+def siteGroup(resname):
+    """
+    Return the UhbdFullFunctions.GROUP_PKAS key for a site with residue name
+    resname (i.e. LYSN -> LYS, HISC -> HISB, ALAN -> TERN, ALAC -> TERC).
+    Follows the rules prepares uses to pick the titratable atom.
+    """
+
+    groups = UhbdFullFunctions.GROUP_PKAS
+    if resname in groups:
+        return resname
+    if resname[:3] == "HIS":
+        return "HISB"
+    if resname[:3] in groups:
+        return resname[:3]
+    if resname[3:4] == "N":
+        return "TERN"
+    if resname[3:4] == "C":
+        return "TERC"
+
+    raise Error.UhbdError("%s is not a titratable residue!" % resname)
+
+
+def readEnergies(out_file,num_sites):
+    """
+    Read the self energy, background interaction energy and (if present) the
+    potentials at the num_sites titratable sites from a uhbd output file.
+    Returns self energy, background energy and a list of potentials (None if
+    the output has no potentials).
+    """
+
+    f = open(out_file,"r")
+    out = f.readlines()
+    f.close()
+
+    g_self = None
+    g_back = None
+    potentials = None
+    for i, line in enumerate(out):
+        if SELF_MARKER in line:
+            g_self = float(line.split()[-1])
+        elif BACK_MARKER in line:
+            g_back = float(line.split()[-1])
+        elif SITE_POTENTIAL_MARKER in line:
+            block = out[i+1:i+1+num_sites]
+            try:
+                potentials = [float(l.split()[-1]) for l in block]
+            except (ValueError, IndexError):
+                potentials = []
+            if len(potentials) != num_sites:
+                err = "Expected %i site potentials in %s!" % (num_sites,
+                                                              out_file)
+                raise Error.UhbdError(err)
+
+    if g_self == None or g_back == None:
+        err = "Could not find site energies in %s!" % out_file
+        raise Error.UhbdError(err)
+
+    return g_self, g_back, potentials
+
+
+def formatSite(index,site,values,row):
+    """
+    Return the lines of the potentials block of one site (index is counted
+    from 1); values are its (pK(model), charge, Gself, Gborn, Gback) and row
+    its interaction potentials.
+    """
+
+    out = [SITE_FORMAT % ((index,) + tuple(site) + tuple(values))]
+    for i in range(0,len(row),VALUES_PER_LINE):
+        out.append("".join([VALUE_FORMAT % v
+                            for v in row[i:i+VALUES_PER_LINE]]) + "\n")
+
+    return out
+
+
+def siteBlock(site_dir,sites):
+    """
+    Build the potentials block getpots writes for the site in site_dir: the
+    site number is read from howmuch.dat, the energies of the site in the
+    protein from uhbdpr.out and as a model compound from uhbdaa.out.  sites
+    is the list of sites (from readSites).  Returns the site number and the
+    lines of its block.
+    """
+
+    f = open(os.path.join(site_dir,"howmuch.dat"),"r")
+    index = int(f.read().split()[0])
+    f.close()
+    if index < 1 or index > len(sites):
+        err = "howmuch.dat in %s names site %i of %i!" % (site_dir,index,
+                                                          len(sites))
+        raise Error.UhbdError(err)
+
+    site = sites[index-1]
+    group = siteGroup(site[0])
+
+    pr_file = os.path.join(site_dir,"uhbdpr.out")
+    self_pr, back_pr, row = readEnergies(pr_file,len(sites))
+    self_aa, back_aa, ignore = readEnergies(os.path.join(site_dir,
+                                                         "uhbdaa.out"),
+                                            len(sites))
+    if row == None:
+        raise Error.UhbdError("No site potentials in %s!" % pr_file)
+
+    # Desolvation (Born) and background terms are protein minus model compound
+    g_born = self_pr - self_aa
+    g_back = back_pr - back_aa
+    values = (UhbdFullFunctions.GROUP_PKAS[group],
+              UhbdFullFunctions.GROUP_CHARGES[group],g_born + g_back,g_born,
+              g_back)
+
+    return index, formatSite(index,site,values,row)
+
+
+def getpots(site_dir,sites):
+    """
+    A python implementation of UHBD fortran "getpots.f".  Appends the block of
+    the site in site_dir (see siteBlock) to site_dir/potentials.  Returns the
+    site number.
+    """
+
+    index, block = siteBlock(site_dir,sites)
+
+    g = open(os.path.join(site_dir,"potentials"),"a")
+    g.writelines(block)
+    g.close()
+
+    return index
+
+
+def neighborMask(coordinates,index,cutoff):
+    """
+    Return a boolean array (len(index) x N) that is True for the sites within
+    cutoff (Angstroms) of each site in index.
+    """
+
+    d = coordinates[index][:,None,:] - coordinates[None,:,:]
+    return numpy.sum(d*d,2) <= cutoff*cutoff
+
+
+def splitColumns(line,widths):
+    """
+    Split line into fields of the given widths.  Returns None if the line is
+    not exactly that long.
+    """
+
+    line = line.rstrip("\r\n")
+    if len(line) != sum(widths):
+        return None
+
+    fields = []
+    start = 0
+    for w in widths:
+        fields.append(line[start:start+w])
+        start += w
+
+    return fields
+
+
+def parseSiteLine(line):
+    """
+    Parse the site line of a potentials block (SITE_COLUMNS).  Returns the
+    site number, the site and its (pK(model), charge, Gself, Gborn, Gback).
+    Raises ValueError if the line does not have that layout.
+    """
+
+    c = splitColumns(line,SITE_COLUMNS)
+    if c == None or c[1] != " " or c[4] != " ":
+        raise ValueError
+
+    site = (c[2].strip(),int(c[3]),c[5].strip())
+    values = (float(c[6]),int(c[7]),float(c[8]),float(c[9]),float(c[10]))
+
+    return int(c[0]), site, values
+
+
+def formatError(problem):
+    """
+    Return the Error.UhbdError raised for a potentials file that does not have
+    the layout the python readers expect.
+    """
+
+    err = "%s.  The python titration engines only read potentials in the " % \
+          problem
+    err += "layout described in uhbd/UhbdPotentials.py; titrate with the "
+    err += "hybrids binary instead."
+
+    return Error.UhbdError(err)
+
+
+def lineError(potential_file,line_number,problem):
+    """
+    Return the formatError for line line_number of potential_file.
+    """
+
+    return formatError("%s line %i: %s" % (potential_file,line_number,
+                                           problem))
+
+
+def iterPotentials(potential_file,sites):
+    """
+    Read a potentials file one site at a time, checking that it has exactly
+    the layout described above for sites (from readSites): each block starts
+    with the site line of the next site and holds one potential for every
+    site.  Yields the site, its (pK(model), charge, Gself, Gborn, Gback) and
+    its row of interaction potentials.  Raises Error.UhbdError at the first
+    line that does not match.
+    """
+
+    num_sites = len(sites)
+    num_rows = (num_sites + VALUES_PER_LINE - 1)/VALUES_PER_LINE
+
+    f = open(potential_file,"r")
+    line_number = 0
+    try:
+        for i in range(num_sites):
+            line = f.readline()
+            line_number += 1
+            if line == "":
+                problem = "file ends after %i of %i sites" % (i,num_sites)
+                raise lineError(potential_file,line_number,problem)
+            try:
+                index, site, values = parseSiteLine(line)
+            except ValueError:
+                raise lineError(potential_file,line_number,
+                                  "not a site line")
+            if index != i + 1 or site != sites[i]:
+                problem = "site %i is %s %i %s, but site %i in %s is " % \
+                          ((index,) + site + (i + 1,SITE_FILE))
+                problem += "%s %i %s" % sites[i]
+                raise lineError(potential_file,line_number,problem)
+
+            row = []
+            for k in range(num_rows):
+                line = f.readline()
+                line_number += 1
+                n = min(VALUES_PER_LINE,num_sites - k*VALUES_PER_LINE)
+                fields = splitColumns(line,n*[VALUE_WIDTH])
+                try:
+                    row.extend([float(v) for v in fields])
+                except (TypeError, ValueError):
+                    problem = "expected %i potentials of site %i" % (n,i + 1)
+                    raise lineError(potential_file,line_number,problem)
+
+            yield site, values, numpy.array(row,dtype=float)
+
+        if f.readline() != "":
+            problem = "more lines than the %i sites in %s" % (num_sites,
+                                                              SITE_FILE)
+            raise lineError(potential_file,line_number + 1,problem)
+    finally:
+        f.close()
+
+
+def checkSymmetric(w,potential_file):
+    """
+    Make sure that the interaction matrix w (dense or SparseMatrix) read from
+    potential_file is symmetric to within SYMMETRY_TOLERANCE.  A potentials
+    file that was misread (i.e. rows shifted against sites) is not.  Raises
+    Error.UhbdError if it is not.
+    """
+
+    if isinstance(w,SparseMatrix):
+        rows, cols, data = w.rows(), w.indices, w.data
+        if len(data) == 0:
+            return
+        key = rows*w.size + cols
+        order = numpy.argsort(key)
+        position = numpy.searchsorted(key[order],cols*w.size + rows)
+        position = numpy.minimum(position,len(key) - 1)
+        found = key[order][position] == cols*w.size + rows
+        transposed = numpy.where(found,data[order][position],0.)
+
+        diff = abs(data - transposed)
+        limit = SYMMETRY_TOLERANCE*numpy.maximum(abs(data),abs(transposed))
+        limit += SYMMETRY_FLOOR
+        worst = numpy.argmax(diff - limit)
+        if diff[worst] <= limit[worst]:
+            return
+        i, j = rows[worst], cols[worst]
+        value, transposed_value = data[worst], transposed[worst]
+    else:
+        if w.size == 0:
+            return
+        diff = abs(w - w.T)
+        limit = abs(w)
+        limit = numpy.maximum(limit,limit.T)
+        limit *= SYMMETRY_TOLERANCE
+        limit += SYMMETRY_FLOOR
+        if not (diff > limit).any():
+            return
+        diff -= limit
+        i, j = numpy.unravel_index(numpy.argmax(diff),w.shape)
+        value, transposed_value = w[i,j], w[j,i]
+
+    problem = "%s is not symmetric (potential %i,%i is %.6E, " % \
+              (potential_file,i + 1,j + 1,value)
+    problem += "%i,%i is %.6E)" % (j + 1,i + 1,transposed_value)
+    raise formatError(problem)
+
+
+def readPotentials(potential_file,site_file=None,cutoff=None):
+    """
+    Read a potentials file into a Potentials instance.  The sites (and their
+    coordinates) come from site_file (by default SITE_FILE next to
+    potential_file); the file must hold exactly these sites in the layout
+    described above, with a symmetric interaction matrix (see iterPotentials
+    and checkSymmetric).  If cutoff is given, only the interactions of sites
+    within cutoff Angstroms of each other are kept, in a SparseMatrix; the
+    full matrix is never built.
+    """
+
+    if site_file == None:
+        site_file = os.path.join(os.path.dirname(potential_file),SITE_FILE)
+    sites, coordinates = readSites(site_file)
+    if len(sites) == 0:
+        raise Error.UhbdError("No titratable sites in %s!" % site_file)
+
+    values = []
+    w, rows, cols, data = [], [], [], []
+    for i, (site, v, row) in enumerate(iterPotentials(potential_file,sites)):
+        values.append(v)
+        if cutoff == None:
+            w.append(row)
+        else:
+            keep = numpy.nonzero(neighborMask(coordinates,[i],cutoff)[0])[0]
+            rows.append(i*numpy.ones(len(keep),dtype=int))
+            cols.append(keep)
+            data.append(row[keep])
+
+    if cutoff != None:
+        w = SparseMatrix(numpy.concatenate(([0],numpy.cumsum([len(c) for c
+                                                               in cols]))),
+                         numpy.concatenate(cols),numpy.concatenate(data),
+                         len(sites))
+    else:
+        w = numpy.array(w,dtype=float)
+    checkSymmetric(w,potential_file)
+
+    return Potentials(sites,[v[0] for v in values],[v[1] for v in values],
+                      [v[2] for v in values],[v[3] for v in values],
+                      [v[4] for v in values],w)
+
+
+def writeSparsePotentials(sparse_file,potentials,cutoff):
+    """
+    Write a Potentials instance with a SparseMatrix interaction matrix to a
+    NumPy .npz file.
+    """
+
+    w = potentials.w
+    f = open(sparse_file,"wb")
+    numpy.savez(f,
+                resname=numpy.array([s[0] for s in potentials.sites]),
+                resid=numpy.array([s[1] for s in potentials.sites]),
+                atom=numpy.array([s[2] for s in potentials.sites]),
+                pk_model=potentials.pk_model,charge=potentials.charge,
+                g_self=potentials.g_self,g_born=potentials.g_born,
+                g_back=potentials.g_back,indptr=w.indptr,indices=w.indices,
+                data=w.data,cutoff=numpy.array(cutoff))
+    f.close()
+
+
+def readSparsePotentials(sparse_file):
+    """
+    Read a Potentials instance written by writeSparsePotentials.
+    """
+
+    f = open(sparse_file,"rb")
+    d = numpy.load(f)
+    sites = zip([str(s) for s in d["resname"]],[int(s) for s in d["resid"]],
+                [str(s) for s in d["atom"]])
+    w = SparseMatrix(d["indptr"],d["indices"],d["data"],len(sites))
+    potentials = Potentials(sites,d["pk_model"],d["charge"],d["g_self"],
+                            d["g_born"],d["g_back"],w)
+    f.close()
+
+    return potentials
+
+
+def loadPotentials(potential_file):
+    """
+    Read a potentials file, or a sparse potentials (.npz) file.
+    """
+
+    if potential_file.endswith(".npz"):
+        return readSparsePotentials(potential_file)
+    return readPotentials(potential_file)
@@ -0,0 +1,237 @@
+"""
+UhbdPreflight.py
+
+Checks run over every pdb file of a batch before any uhbd process starts
+(--preflight).  Each file is parsed and checked for problems that uhbd would
+otherwise only hit partway through a calculation: atoms with no entry in the
+parameter file, his_tautomers/cys_titrate files that do not match the
+structure, bad grid levels and atoms outside the coarsest grid.  A report is
+made for every file.
+"""
+
+__author__ = "Michael J. Harms"
+
+import os
+import UhbdParameters, UhbdFullFunctions, UhbdGridFunctions
+import UhbdSingleFunctions
+from common import Error, Structure, ProcessInputFiles
+
+# Records of the parameter file used by each type of calculation
+PARAM_RECORDS = {"single":["mine"],"full":["neut","char"]}
+
+# Maximum number of residue types with missing atoms listed for a file
+MAX_LISTED = 10
+
+
+class PreflightReport:
+    """
+    Class that holds the result of the checks on one pdb file.
+    """
+
+    def __init__(self,filename):
+        """
+        Initialize class.
+        """
+
+        self.filename = filename
+        self.num_atoms = 0
+        self.problems = []
+
+    def add(self,problem):
+        """
+        Record a problem with the file.
+        """
+
+        self.problems.append(problem)
+
+    def success(self):
+        return len(self.problems) == 0
+
+    def report(self):
+        """
+        Return a description of the checks as a list of lines.
+        """
+
+        if self.success():
+            return ["   %s: ok (%i atoms)\n" % (self.filename,self.num_atoms)]
+
+        out = ["   %s: FAILED\n" % self.filename]
+        for p in self.problems:
+            lines = p.strip().split("\n")
+            out.append("      %s\n" % lines[0])
+            out.extend(["        %s\n" % l for l in lines[1:]])
+
+        return out
+
+
+def knownAtoms(database,records):
+    """
+    Return the set of (residue, atom) names that have an entry in every one of
+    records in database (a UhbdParameters.ParameterDatabase), including names
+    that are equivalent to a name with an entry.
+    """
+
+    known = None
+    for record in records:
+        names = set()
+        for key, index in database.index.items():
+            if key[0] == record:
+                names.update([(key[1],database.entries[i][2])
+                              for i in index])
+        if known == None:
+            known = names
+        else:
+            known &= names
+
+    for e in database.equivalences:
+        e = tuple(e)
+        if e[2:4] in known:
+            known.add(e[0:2])
+
+    return known
+
+
+def missingAtoms(structure,known):
+    """
+    Find the atoms of structure whose residue/atom names are not in known.
+    Returns a list of (residue name, first residue number, [atom names]) in the
+    order of the file.  Each distinct pair of names is only looked up once.
+    """
+
+    checked = set()
+    missing = {}
+    order = []
+    for i in range(len(structure)):
+        key = (structure.resname[i].strip(),structure.name[i].strip())
+        if key in checked:
+            continue
+        checked.add(key)
+        if key not in known:
+            if key[0] not in missing:
+                missing[key[0]] = (key[0],structure.resid[i],[])
+                order.append(key[0])
+            missing[key[0]][2].append(key[1])
+
+    return [missing[r] for r in order]
+
+
+def gridOverhang(structure,grid):
+    """
+    Return the amount (A) that the atoms of structure extend past the coarsest
+    level of grid (centered on the centroid of the atoms) along x, y and z.
+    Values less than or equal to zero mean the atoms fit.
+    """
+
+    c = structure.coord
+    size = len(structure)
+    spacing, dime = grid[0][0], grid[0][1:]
+
+    overhang = []
+    for k in range(3):
+        axis = c[k::3]
+        center = sum(axis)/size
+        half_edge = spacing*(dime[k] - 1)/2.
+        overhang.append(max(max(axis) - center,center - min(axis)) - half_edge)
+
+    return overhang
+
+
+def checkFile(filename,calc_param,database,known):
+    """
+    Run every check on filename.  Returns a PreflightReport.
+    """
+
+    report = PreflightReport(filename)
+
+    try:
+        structure = Structure.readStructure(filename)
+    except (IOError, Error.UhbdError), value:
+        report.add(str(value))
+        return report
+    report.num_atoms = len(structure)
+    if len(structure) == 0:
+        report.add("no ATOM records")
+        return report
+
+    # his and cys input files
+    try:
+        ProcessInputFiles.processHis(structure,calc_param.his_tautomers)
+    except (IOError, ValueError, ProcessInputFiles.MangledFileError), value:
+        report.add("his_tautomers: %s" % value)
+    try:
+        ProcessInputFiles.processCys(structure,calc_param.cys_titrate)
+    except (IOError, ValueError, ProcessInputFiles.MangledFileError), value:
+        report.add("cys_titrate: %s" % value)
+
+    # Grid levels, and whether the structure fits in the coarsest
+    try:
+        if calc_param.plan_grid != None:
+            sites = UhbdSingleFunctions.siteAtoms(structure)
+        else:
+            sites = None
+        grid = ProcessInputFiles.processGrid(structure,calc_param.grid,
+                                             calc_param.plan_grid,sites)
+        UhbdGridFunctions.checkGrid(grid)
+    except (IOError, ValueError, ProcessInputFiles.MangledFileError,
+            Error.UhbdError), value:
+        report.add("grid: %s" % value)
+        grid = None
+    if grid != None:
+        overhang = gridOverhang(structure,grid)
+        if max(overhang) > 0:
+            err = "atoms extend %.1F, %.1F, %.1F A (x, y, z) past the " % \
+                  tuple([max(o,0.) for o in overhang])
+            err += "coarsest grid (%.2F A, %i x %i x %i)" % tuple(grid[0])
+            report.add(err)
+
+    # Atoms without parameters
+    missing = missingAtoms(structure,known)
+    if len(missing) > 0:
+        err = ["atoms of %i residue types not in %s (%s):" % \
+               (len(missing),os.path.split(calc_param.param_file)[-1],
+                ", ".join(PARAM_RECORDS[calc_param.calc_type]))]
+        err.extend(["%-4s (first in residue %i): %s" % (m[0],m[1],
+                    " ".join(m[2])) for m in missing[:MAX_LISTED]])
+        if len(missing) > MAX_LISTED:
+            err.append("...")
+        report.add("\n".join(err))
+
+    # Titratable groups prepareFull cannot find a neutral/charged pair for
+    if calc_param.full:
+        groups = set([r.strip() for r in structure.resname
+                      if r.strip() in UhbdFullFunctions.GROUP_PKAS])
+        no_pair = [g for g in groups if g not in database.differences]
+        if len(no_pair) > 0:
+            no_pair.sort()
+            err = "no neutral and charged entries for %s" % ", ".join(no_pair)
+            report.add(err)
+
+    return report
+
+
+def preflight(file_list,calc_param):
+    """
+    Check every file in file_list.  The parameter file is loaded once for the
+    whole batch.  Returns a list of PreflightReport instances.
+    """
+
+    cache_dir = UhbdParameters.cacheDir(calc_param)
+    database = UhbdParameters.loadParameters(calc_param.param_file,cache_dir)
+    known = knownAtoms(database,PARAM_RECORDS[calc_param.calc_type])
+
+    return [checkFile(f,calc_param,database,known) for f in file_list]
+
+
+def preflightReport(reports):
+    """
+    Create a report of the preflight checks on a batch.  Returns a string.
+    """
+
+    failed = [r for r in reports if not r.success()]
+
+    out = ["Preflight checks passed for %i of %i files.\n" % \
+           (len(reports) - len(failed),len(reports))]
+    for r in reports:
+        out.extend(r.report())
+
+    return "".join(out)
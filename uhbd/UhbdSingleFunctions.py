@@ -2,10 +2,11 @@
 UhbdSingleFunctions.py
 
 Functions for running single-site calculations using UHBD.  Replaces the
-prepares and doinps binaries.
+prepares binary.
 """
 
 import os
+from common import Error, Structure
 
 TITRATABLE = {"HISA":"NE2","HISB":"ND1","HISN":"ND1","HISC":"ND1",
               "LYS":"NZ","LYSN":"NZ","LYSC":"NZ",
@@ -26,89 +27,107 @@ def writeOutput(output_file,data_list):
     g.close()
 
 
-def prepareSingle():
+def siteAtoms(structure):
     """
-    A python implementation of UHBD fortran "prepares.f"  It does not direclty
-    write out uhbdini.inp.  See the makeUhbdini function for that.
+    Return the indices of the titratable atoms of structure (the atoms
+    prepareSingle writes to sitesinpr.pdb).
     """
 
-    # Open pdb file and read it
-    f = open("proteinH.pdb","r")
-    pdb = f.readlines()
-    f.close()
+    s = structure
+    out = []
+    for i in range(len(s)):
+        resname, name = s.resname[i].strip(), s.name[i].strip()
+        if TITRATABLE.get(resname) == name or \
+           (resname[3:4] in ["N","C"] and name == resname[3:4]):
+            out.append(i)
+
+    return out
+
+
+def prepareSingle(job_dir,structure=None):
+    """
+    A python implementation of UHBD fortran "prepares.f"  It does not direclty
+    write out uhbdini.inp.  See the makeUhbdini function for that.  Works from
+    structure (the Structure written to proteinH.pdb); if it is not given,
+    proteinH.pdb is read.  Writes files in job_dir.
+    """
 
-    # Pull only titratable atoms from the pdb
-    n_terminus = [l for l in pdb if l[0:4] == "ATOM" 
-                  and l[20:21] == "N"]
-    titr_groups = [l for l in pdb if l[0:4] == "ATOM"
-                   and l[17:21].strip() in TITRATABLE.keys()]
-    c_terminus = [l for l in pdb if l[0:4] == "ATOM" 
-                  and l[20:21] == "C"]
-
-    # Create list of all titratable groups in the pdb file
-    titr_resid = []
-    titr_resid.extend(n_terminus)
-    titr_resid.extend(titr_groups)
-    titr_resid.extend(c_terminus)
-    titr_resid = ["%s\n" % l[:54] for l in titr_resid]
-   
-    # Grab list of all unique residues
-    resid_list = [titr_resid[0][21:26]]
-    for l in titr_resid:
-        if resid_list[-1] != l[21:26]:
-            resid_list.append(l[21:26])  
-
-    # Create tempor output file, listing all atoms of all titratable residues
-    # in the order of the original file
-    tempor = [] 
-    for residue in resid_list:
-        residue_atoms = [l for l in titr_resid if l[21:26] == residue]
-        residue_atoms = ["%6s%5i%s" % (a[0:6],i+1,a[11:]) 
-                         for i, a in enumerate(residue_atoms)]
-        tempor.extend(residue_atoms)
-
-    # Create sitesinpr and titraa files, which list all titratable atoms and
-    # all titratable residues with titratable atom in first position.
+    if structure == None:
+        structure = Structure.readStructure(os.path.join(job_dir,
+                                                         "proteinH.pdb"))
+    s = structure
+
+    # Pull only titratable atoms from the pdb in one pass: N-terminal, then
+    # titratable, then C-terminal atoms (an atom may be in more than one)
+    n_terminus, titr_groups, c_terminus = [], [], []
+    for i in range(len(s)):
+        resname = s.resname[i]
+        line = "%s\n" % s.lines[i][:54]
+        if resname[3:4] == "N":
+            n_terminus.append(line)
+        if resname.strip() in TITRATABLE:
+            titr_groups.append(line)
+        if resname[3:4] == "C":
+            c_terminus.append(line)
+    titr_resid = n_terminus + titr_groups + c_terminus
+    if len(titr_resid) == 0:
+        err = "No titratable groups in %s!" % job_dir
+        raise Error.UhbdError(err)
+
+    # Group atoms by residue: each run of a residue in titr_resid lists all of
+    # the atoms of that residue
+    runs = Structure.groupRuns([l[21:26] for l in titr_resid])
+    residues = {}
+    for residue, index in runs:
+        residues.setdefault(residue,[]).extend([titr_resid[i] for i in index])
+
+    # Create tempor (all atoms of all titratable residues in the order of the
+    # original file), sitesinpr and titraa files (all titratable atoms and
+    # all titratable residues with titratable atom in first position).
+    tempor = []
     sitesinpr = []
     titraa = []
-    for residue in resid_list:
-        residue_atoms = [l for l in titr_resid if l[21:26] == residue]
-    
-        # Figure out what the titratable atom is for this residue 
-        try: 
+    for residue, index in runs:
+        residue_atoms = residues[residue]
+        tempor.extend(["%6s%5i%s" % (a[0:6],i+1,a[11:])
+                       for i, a in enumerate(residue_atoms)])
+
+        # Figure out what the titratable atom is for this residue
+        try:
             titr_atom = TITRATABLE[residue_atoms[0][17:21].strip()]
         except KeyError:
-            if residue_atoms[0][20] == "N":
-                titr_atom = "N"
-            elif residue_atoms[0][20] == "C":
-                titr_atom = "C"
-
-        titr_line = [l for l in residue_atoms 
-                     if l[12:16].strip() == titr_atom][0]
+            # Termini titrate on their N or C atom
+            titr_atom = residue_atoms[0][20]
+
+        titr_line = [l for l in residue_atoms
+                     if l[12:16].strip() == titr_atom]
+        if len(titr_line) == 0:
+            err = "Residue %s has no titratable atom (%s)!" % \
+                  (residue.strip(),titr_atom)
+            raise Error.UhbdError(err)
+        titr_line = titr_line[0]
         sitesinpr.append(titr_line)
 
         residue_atoms = [l for l in residue_atoms if l != titr_line]
         residue_atoms.insert(0,titr_line)
-        residue_atoms = ["%6s%5i%s" % (a[0:6],i+1,a[11:]) 
-                         for i, a in enumerate(residue_atoms)]
-       
-        titraa.extend(residue_atoms) 
+        titraa.extend(["%6s%5i%s" % (a[0:6],i+1,a[11:])
+                       for i, a in enumerate(residue_atoms)])
 
     # Close sitesinpr file
-    sitesinpr.insert(0,"%-54s\n" % (pdb[0].strip()))
+    sitesinpr.insert(0,"%-54s\n" % (structure.header.strip()))
     sitesinpr.append("END")
 
     
     # Write output files         
-    writeOutput("tempor.pdb",tempor)
-    writeOutput("sitesinpr.pdb",sitesinpr)
-    writeOutput("titraa.pdb",titraa)
+    writeOutput(os.path.join(job_dir,"tempor.pdb"),tempor)
+    writeOutput(os.path.join(job_dir,"sitesinpr.pdb"),sitesinpr)
+    writeOutput(os.path.join(job_dir,"titraa.pdb"),titraa)
 
 
 
-def makeUhbdini(calc_param):
+def makeUhbdini(calc_param,job_dir):
     """
-    Write out uhbdini.inp.
+    Write out uhbdini.inp in job_dir.
     """
 
     short_param_file = os.path.split(calc_param.param_file)[-1]
@@ -131,12 +150,32 @@ def makeUhbdini(calc_param):
     "write grid epsk binary file  \"coarse.epsk\" end\n\n"
     "stop\n"]
 
-    writeOutput("pkaS-uhbdini.inp",uhbdini)
+    writeOutput(os.path.join(job_dir,"pkaS-uhbdini.inp"),uhbdini)
 
-def runPrepares(calc_param):
+def runPrepares(calc_param,job_dir):
 
-    prepareSingle()
-    makeUhbdini(calc_param)
+    prepareSingle(job_dir,calc_param.structure)
+    makeUhbdini(calc_param,job_dir)
 
 
+def readSites(job_dir):
+    """
+    Split titraa.pdb into titratable sites.  Returns a list with one list of
+    atom lines per site (titratable atom first), in the order of the file.
+    """
+
+    f = open(os.path.join(job_dir,"titraa.pdb"),"r")
+    titraa = f.readlines()
+    f.close()
 
+    sites = []
+    current_residue = None
+    for line in titraa:
+        if line[0:4] != "ATOM":
+            continue
+        if line[21:26] != current_residue:
+            current_residue = line[21:26]
+            sites.append([])
+        sites[-1].append(line)
+
+    return sites
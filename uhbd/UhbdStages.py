@@ -0,0 +1,163 @@
+"""
+UhbdStages.py
+
+Dependency model for the stages of a uhbd calculation.  Each stage depends on
+a set of calc_param fields and on every stage before it.  A manifest of stage
+signatures is written to each output directory so that a later run with
+--incremental only reruns the stages whose inputs changed (i.e. only hybrid
+when the pH titration parameters change).
+"""
+
+__author__ = "Michael J. Harms"
+
+import os, hashlib
+
+MANIFEST = "pyUHBD-stages.dat"
+
+# Everything written into the doinp file (see GenerateUhbdInput.createDoinp),
+# which is read by getgrids and doinps.
+DOINP_FIELDS = ["num_chains","first_residues","last_residues","his_tautomers",
+                "grid","iterations","temperature","solvent_dielec",
+                "protein_dielec","ionic_strength","ionic_radius",
+                "added_residues","cys_titrate","map_sphere","map_sample",
+                "change_acid"]
+
+# Stages in the order they are run and the calc_param fields each reads.  The
+# structure and parameter file contents are inputs of prepares.
+STAGES = ["prepares","uhbdini","getgrids","sites","hybrid"]
+STAGE_FIELDS = {"prepares":[],
+                "uhbdini":["grid","map_sphere","map_sample","solvent_dielec",
+                           "protein_dielec"],
+                "getgrids":DOINP_FIELDS,
+                "sites":DOINP_FIELDS,
+                "hybrid":["ph_param","python_hybrid","monte_carlo",
+                           "sparse_cutoff"]}
+
+# Files that must already be in the output directory to start a calculation
+# at a given stage.  prepares is cheap and always run; None means the stage
+# cannot be started on its own (the outputs of getgrids are not kept).
+SINGLE_REQUIRES = {"prepares":[],
+                   "uhbdini":[],
+                   "getgrids":["pkaS-uhbdini.out","coarse.epsi","coarse.epsj",
+                               "coarse.epsk"],
+                   "sites":None,
+                   "hybrid":["pkaS-potentials","pkaS-sitesinpr.pdb"]}
+FULL_REQUIRES = {"prepares":[],
+                 "uhbdini":[],
+                 "getgrids":["uhbdini.out"],
+                 "sites":None,
+                 "hybrid":["pkaF-potentials","sites.dat"]}
+
+
+def stageSignatures(calc_param,job_dir):
+    """
+    Calculate the signature of every stage: a hash of the calc_param fields the
+    stage reads and the signature of the stage before it.  The signature of
+    prepares includes the contents of the structure and parameter file.
+    Returns a dictionary keyed to stage name.
+    """
+
+    h = hashlib.sha1()
+    for f in ["proteinH.pdb",os.path.split(calc_param.param_file)[-1]]:
+        g = open(os.path.join(job_dir,f),"rb")
+        h.update(g.read())
+        g.close()
+
+    signatures = {}
+    previous = h.hexdigest()
+    for stage in STAGES:
+        h = hashlib.sha1(previous)
+        for field in STAGE_FIELDS[stage]:
+            h.update("\n%s %r" % (field,calc_param.__dict__.get(field)))
+        signatures[stage] = h.hexdigest()
+        previous = signatures[stage]
+
+    return signatures
+
+
+def readManifest(job_dir):
+    """
+    Read the stage signatures recorded by a previous run in job_dir.  Returns
+    an empty dictionary if there is no manifest.
+    """
+
+    manifest_file = os.path.join(job_dir,MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return {}
+
+    f = open(manifest_file,"r")
+    lines = f.readlines()
+    f.close()
+
+    return dict([l.split() for l in lines if len(l.split()) == 2])
+
+
+class StageManifest:
+    """
+    Class that decides which stages of a calculation in job_dir need to run and
+    records the stages that finish.
+    """
+
+    def __init__(self,calc_param,job_dir):
+        """
+        Initialize class.  Must be called after prepares has written its
+        output (the structure and parameter file must be in job_dir).
+        """
+
+        self.job_dir = job_dir
+        self.signatures = stageSignatures(calc_param,job_dir)
+        self.completed = {}
+
+        if calc_param.full:
+            requires = FULL_REQUIRES
+        else:
+            requires = SINGLE_REQUIRES
+
+        # Without --incremental, everything is run
+        self.first = 0
+        if calc_param.incremental:
+            previous = readManifest(job_dir)
+            while self.first < len(STAGES):
+                stage = STAGES[self.first]
+                if previous.get(stage) != self.signatures[stage]:
+                    break
+                self.first += 1
+
+            # Step back to a stage whose required files are present
+            while self.first > 0 and self.first < len(STAGES):
+                needed = requires[STAGES[self.first]]
+                if needed != None:
+                    missing = [f for f in needed
+                               if not os.path.isfile(os.path.join(job_dir,f))]
+                    if len(missing) == 0:
+                        break
+                self.first -= 1
+
+            if self.first == len(STAGES):
+                print "All stages up to date."
+            elif self.first > 0:
+                print "Stages up to date: %s" % " ".join(STAGES[:self.first])
+
+        # Stages that are skipped keep their previous signature
+        for stage in STAGES[:self.first]:
+            self.completed[stage] = self.signatures[stage]
+
+    def run(self,stage):
+        """
+        Return True if stage needs to be run.
+        """
+
+        return STAGES.index(stage) >= self.first
+
+    def done(self,stage):
+        """
+        Record that stage finished and write the manifest.
+        """
+
+        self.completed[stage] = self.signatures[stage]
+
+        out = ["%s %s\n" % (s,self.completed[s]) for s in STAGES
+               if self.completed.has_key(s)]
+        g = open(os.path.join(self.job_dir,MANIFEST),"w")
+        g.writelines(out)
+        g.close()
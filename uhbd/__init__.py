@@ -1,2 +1,4 @@
 __all__ = ['GenerateUhbdInput.py','ParseUhbd.py','UhbdFullFunctions.py',
-           'UhbdInterface.py','UhbdSingleFunctions.py','UhbdErrorCheck.py']
+           'UhbdInterface.py','UhbdSingleFunctions.py','UhbdErrorCheck.py',
+           'UhbdStages.py','UhbdPotentials.py','UhbdHybrid.py',
+           'UhbdMonteCarlo.py','UhbdGridFunctions.py','UhbdParameters.py']